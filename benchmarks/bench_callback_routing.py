@@ -0,0 +1,91 @@
+"""Dispatch synthetic callback queries through the old handler chain and CallbackRouter.
+
+Usage: python benchmarks/bench_callback_routing.py [count]
+
+The old routing is rebuilt from the router's own routes as one CallbackQueryHandler per
+route, tried in registration order the way python-telegram-bot walks a handler group.
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DB_NAME', os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bench.db'))
+os.environ.setdefault('BOT_TOKEN', '1:bench')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from telegram import CallbackQuery, Update, User  # noqa: E402
+from telegram.ext import CallbackQueryHandler  # noqa: E402
+
+from bot.app import build_application  # noqa: E402
+from bot.callback_router import CallbackRouter, _literal_prefix  # noqa: E402
+
+
+def _routes(router: CallbackRouter):
+    routes = [r for bucket in router._exact.values() for r in bucket]
+    routes += [r for bucket in router._prefixed.values() for r in bucket]
+    routes += router._unindexed
+    return sorted(routes, key=lambda route: route[0])
+
+
+def _sample_data(routes):
+    data = ['unknown_button', 'noop']
+    for _, regex, _ in routes:
+        literal = _literal_prefix(regex.pattern)
+        if literal is None:
+            continue
+        prefix, exact = literal
+        data.append(prefix if exact else f"{prefix}{random.randint(1, 99999)}")
+    return data
+
+
+def _update(n: int, data: str) -> Update:
+    user = User(1000 + n % 500, 'user', False)
+    return Update(n, callback_query=CallbackQuery(str(n), user, 'chat', data=data))
+
+
+def _old_dispatch(handlers, update):
+    for handler in handlers:
+        check = handler.check_update(update)
+        if check is not None and check is not False:
+            return handler.callback
+    return None
+
+
+def _new_dispatch(router, update):
+    check = router.check_update(update)
+    return check[0] if check else None
+
+
+def main(count: int = 100_000) -> None:
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        application = build_application()
+    router = next(h for h in application.handlers[3] if isinstance(h, CallbackRouter))
+    routes = _routes(router)
+    old_handlers = [CallbackQueryHandler(callback, pattern=regex.pattern) for _, regex, callback in routes]
+    data = _sample_data(routes)
+    random.seed(1)
+    updates = [_update(n, random.choice(data)) for n in range(count)]
+
+    mismatches = sum(_old_dispatch(old_handlers, u) is not _new_dispatch(router, u) for u in updates[:5000])
+
+    results = {}
+    for name, dispatch, target in (('old handler chain', _old_dispatch, old_handlers), ('CallbackRouter', _new_dispatch, router)):
+        start = time.perf_counter()
+        for update in updates:
+            dispatch(target, update)
+        results[name] = time.perf_counter() - start
+
+    print(f"{len(routes)} routes, {len(set(data))} distinct callback shapes, {count} callbacks")
+    for name, elapsed in results.items():
+        print(f"  {name:<18} {elapsed:7.3f} s  {count / elapsed:12,.0f} callbacks/s  {elapsed / count * 1e6:7.2f} us each")
+    print(f"  speed-up          {results['old handler chain'] / results['CallbackRouter']:.1f}x")
+    print(f"  routing mismatches in the first 5000: {mismatches}")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
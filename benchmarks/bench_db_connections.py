@@ -0,0 +1,108 @@
+"""Compare ops/sec of the pooled WAL connections in db.py with the old open-per-call path.
+
+Usage: python benchmarks/bench_db_connections.py [ops]
+
+Each path gets its own database file with the same schema and 10k users/wallets. The old
+path opens a fresh sqlite3 connection per call in the default rollback-journal mode, as
+query_db/execute_db used to.
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_tmp = tempfile.mkdtemp(prefix='bench-')
+os.environ['DB_NAME'] = os.path.join(_tmp, 'pooled.db')
+os.environ.setdefault('BOT_TOKEN', '1:bench')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from bot import db  # noqa: E402
+
+OLD_DB = os.path.join(_tmp, 'per_call.db')
+USERS = 10_000
+
+
+def old_query_db(query, args=(), one=False):
+    conn = sqlite3.connect(OLD_DB)
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute(query, args).fetchall()
+        if one:
+            return dict(rows[0]) if rows else None
+        return [dict(row) for row in rows]
+    finally:
+        conn.close()
+
+
+def old_execute_db(query, args=()):
+    conn = sqlite3.connect(OLD_DB)
+    try:
+        cursor = conn.execute(query, args)
+        conn.commit()
+        return cursor.lastrowid
+    finally:
+        conn.close()
+
+
+def _seed(execute_many):
+    execute_many("INSERT OR IGNORE INTO users (user_id, first_name, join_date) VALUES (?, 'u', '2024-01-01')",
+                 [(uid,) for uid in range(1, USERS + 1)])
+    execute_many("INSERT OR IGNORE INTO user_wallets (user_id, balance) VALUES (?, 1000000)",
+                 [(uid,) for uid in range(1, USERS + 1)])
+
+
+def _setup():
+    db.db_setup()
+    db.run_transaction(lambda conn: _seed(conn.executemany))
+    # Same schema for the old path, copied without WAL
+    src = sqlite3.connect(db.DB_NAME)
+    dst = sqlite3.connect(OLD_DB)
+    src.backup(dst)
+    dst.execute("PRAGMA journal_mode = DELETE")
+    src.close()
+    dst.close()
+
+
+def _read(query):
+    query("SELECT user_id, first_name FROM users WHERE user_id = ?", (random.randint(1, USERS),), one=True)
+
+
+def _write(execute):
+    execute("UPDATE user_wallets SET balance = balance - 1 WHERE user_id = ?", (random.randint(1, USERS),))
+
+
+def _run(label, work, ops, threads=1):
+    per_thread = ops // threads
+    start = time.perf_counter()
+    workers = [threading.Thread(target=lambda: [work() for _ in range(per_thread)]) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<34} {per_thread * threads / elapsed:12,.0f} ops/s")
+    return per_thread * threads / elapsed
+
+
+def main(ops: int = 20_000) -> None:
+    _setup()
+    random.seed(1)
+    cases = [
+        ('reads', lambda q, e: _read(q), 1),
+        ('writes', lambda q, e: _write(e), 1),
+        ('90% reads / 10% writes, 8 threads', lambda q, e: _read(q) if random.random() < 0.9 else _write(e), 8),
+    ]
+    for name, op, threads in cases:
+        print(f"{name} ({ops} ops)")
+        old = _run('open-per-call, rollback journal', lambda: op(old_query_db, old_execute_db), ops, threads)
+        new = _run('pooled connections, WAL', lambda: op(db.query_db, db.execute_db), ops, threads)
+        print(f"  {'speed-up':<34} {new / old:11.1f}x")
+    db.close_all_connections()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20_000)
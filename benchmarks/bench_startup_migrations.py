@@ -0,0 +1,79 @@
+"""Startup cost of db_setup() on a large existing database.
+
+Usage: python benchmarks/bench_startup_migrations.py [orders]
+
+Builds a migrated database with `orders` orders (default 300k) and a user per 5 orders,
+then times three startups, each on a fresh connection as after a restart:
+  - every migration re-run (schema_version emptied), which is the probing and
+    INSERT OR IGNORE work the old db_setup did on every boot
+  - an already current database, which should only read schema_version
+  - the first migration of an empty database, for reference
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_tmp = tempfile.mkdtemp(prefix='bench-')
+os.environ['DB_NAME'] = os.path.join(_tmp, 'large.db')
+os.environ.setdefault('BOT_TOKEN', '1:bench')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from bot import db  # noqa: E402
+
+
+def _fill(conn, orders: int) -> None:
+    users = max(1, orders // 5)
+    conn.executemany(
+        "INSERT OR IGNORE INTO users (user_id, first_name, join_date) VALUES (?, 'u', '2024-01-01 00:00:00')",
+        ((uid,) for uid in range(1, users + 1)),
+    )
+    conn.executemany(
+        "INSERT INTO orders (user_id, plan_id, status, marzban_username, panel_id, timestamp, final_price) "
+        "VALUES (?, 1, 'approved', ?, 1, '2024-01-01 00:00:00', 100000)",
+        ((n % users + 1, f"user_{n}") for n in range(orders)),
+    )
+
+
+def _startup(runs: int = 5) -> float:
+    best = None
+    for _ in range(runs):
+        db.close_all_connections()
+        start = time.perf_counter()
+        db.db_setup()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _forget_versions() -> None:
+    db.execute_db("DELETE FROM schema_version")
+
+
+def main(orders: int = 300_000) -> None:
+    db.close_all_connections()
+    start = time.perf_counter()
+    db.db_setup()
+    fresh = time.perf_counter() - start
+    db.run_transaction(_fill, orders)
+    db.get_connection().execute("ANALYZE")
+
+    rerun = None
+    for _ in range(5):
+        _forget_versions()
+        took = _startup(runs=1)
+        rerun = took if rerun is None else min(rerun, took)
+    current = _startup()
+
+    size_mb = os.path.getsize(db.DB_NAME) / 1e6
+    print(f"{orders:,} orders, {max(1, orders // 5):,} users, {size_mb:.0f} MB database, {len(db.MIGRATIONS)} migrations")
+    print(f"  empty database, all migrations     {fresh * 1000:9.2f} ms")
+    print(f"  large database, all migrations     {rerun * 1000:9.2f} ms  (old boot-time probing)")
+    print(f"  large database, already current    {current * 1000:9.2f} ms")
+    print(f"  speed-up on a current database     {rerun / current:9.0f}x")
+    db.close_all_connections()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 300_000)
@@ -0,0 +1,205 @@
+import asyncio
+import json
+from datetime import datetime
+
+from .config import ACCOUNT_POOL_REFILL_BATCH, logger
+from .db import aexecute_db, aquery_db, arun_transaction, execute_db, query_db
+from .panel import VpnPanelAPI
+from .panel_http import run_blocking
+
+# Warm pools of pre-created X-UI clients, for delivery without waiting on the panel.
+#
+# For each (panel, inbound) given a depth by an admin, a background job keeps that many
+# disabled clients on the panel, with their configs built once when they are created. A
+# sale or free trial on that inbound claims one (in a transaction, so a client never goes to
+# two buyers) and a single updateClient enables it with the plan's traffic and expiry
+# counted from now; the pool is then topped up in the background. Since limits are applied
+# on claim, pooled clients are not tied to a plan and one pool serves every plan and trials
+# on its inbound. When a pool is empty or activation fails, callers create the client as before.
+
+XUI_POOL_TYPES = ('xui', 'x-ui', 'sanaei', 'alireza', '3xui', '3x-ui', 'txui', 'tx-ui', 'tx ui')
+
+# Pool clients are created unlimited and disabled; the real limits are set on claim
+_POOL_PLAN = {'traffic_gb': 0, 'duration_days': 0}
+
+_refilling: set = set()  # (panel_id, inbound_id) being topped up
+_tasks: set = set()
+
+
+def _now() -> str:
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def pool_overview(panel_id: int) -> dict:
+    """inbound_id -> {'depth', 'ready'} for every inbound of the panel with a target or ready clients."""
+    overview = {}
+    for row in query_db("SELECT inbound_id, depth FROM account_pool_targets WHERE panel_id = ?", (panel_id,)) or []:
+        overview[int(row['inbound_id'])] = {'depth': int(row['depth']), 'ready': 0}
+    for row in query_db(
+        "SELECT inbound_id, COUNT(*) AS ready FROM account_pool WHERE panel_id = ? AND status = 'ready' GROUP BY inbound_id",
+        (panel_id,),
+    ) or []:
+        overview.setdefault(int(row['inbound_id']), {'depth': 0, 'ready': 0})['ready'] = int(row['ready'])
+    return overview
+
+
+def set_pool_depth(panel_id: int, inbound_id: int, depth: int) -> None:
+    """Keep `depth` ready clients on the inbound; 0 stops refilling (ready clients stay claimable)."""
+    depth = max(0, int(depth))
+    if depth == 0:
+        execute_db("DELETE FROM account_pool_targets WHERE panel_id = ? AND inbound_id = ?", (panel_id, inbound_id))
+    else:
+        execute_db(
+            "INSERT INTO account_pool_targets (panel_id, inbound_id, depth) VALUES (?, ?, ?) "
+            "ON CONFLICT(panel_id, inbound_id) DO UPDATE SET depth = excluded.depth",
+            (panel_id, inbound_id, depth),
+        )
+        schedule_refill(panel_id, inbound_id)
+
+
+def _take(conn, panel_id: int, inbound_id: int):
+    row = conn.execute(
+        "SELECT id, username, sub_link, configs FROM account_pool "
+        "WHERE panel_id = ? AND inbound_id = ? AND status = 'ready' ORDER BY id LIMIT 1",
+        (panel_id, inbound_id),
+    ).fetchone()
+    if not row:
+        return None
+    conn.execute("UPDATE account_pool SET status = 'claimed', claimed_at = ? WHERE id = ?", (_now(), row['id']))
+    return dict(row)
+
+
+async def _discard_claimed(api, panel_id: int, inbound_id: int, account: dict) -> None:
+    # A client that failed to activate is removed from the panel, so a flaky panel doesn't
+    # collect orphan disabled clients; if it can't be removed it goes back to the pool
+    try:
+        gone, msg = await run_blocking(api.delete_client_on_inbound, inbound_id, account['username'])
+    except Exception as e:
+        gone, msg = False, str(e)
+    if gone:
+        await aexecute_db("UPDATE account_pool SET status = 'failed' WHERE id = ?", (account['id'],))
+        logger.info(f"Account pool {panel_id}/{inbound_id}: removed {account['username']} from the panel")
+    else:
+        await aexecute_db("UPDATE account_pool SET status = 'ready', claimed_at = NULL WHERE id = ?", (account['id'],))
+        logger.warning(f"Account pool {panel_id}/{inbound_id}: could not remove {account['username']} ({msg}); returned it to the pool")
+
+
+async def claim_pool_account(panel_id: int, inbound_id: int, plan):
+    """Claim a ready client on the inbound and activate it with the plan's limits.
+
+    Returns {'username', 'sub_link', 'configs'}, or None when the pool is empty or the panel
+    rejected the activation (the caller then creates a client itself)."""
+    panel_id, inbound_id = int(panel_id), int(inbound_id)
+    # Cheap read first, so sales on inbounds without a pool don't queue a write transaction
+    if not await aquery_db(
+        "SELECT 1 FROM account_pool WHERE panel_id = ? AND inbound_id = ? AND status = 'ready' LIMIT 1",
+        (panel_id, inbound_id), one=True,
+    ):
+        return None
+    try:
+        account = await arun_transaction(_take, panel_id, inbound_id)
+    except Exception as e:
+        logger.error(f"Account pool {panel_id}/{inbound_id}: claim failed: {e}")
+        return None
+    if not account:
+        return None
+    schedule_refill(panel_id, inbound_id)
+    api = VpnPanelAPI(panel_id=panel_id)
+    try:
+        ok, msg = await run_blocking(api.activate_client_on_inbound, inbound_id, account['username'], plan)
+    except Exception as e:
+        ok, msg = False, str(e)
+    if not ok:
+        logger.warning(f"Account pool {panel_id}/{inbound_id}: activating {account['username']} failed: {msg}")
+        await _discard_claimed(api, panel_id, inbound_id, account)
+        return None
+    try:
+        configs = json.loads(account.get('configs') or '[]')
+    except Exception:
+        configs = []
+    logger.info(f"Account pool {panel_id}/{inbound_id}: delivered {account['username']}")
+    return {'username': account['username'], 'sub_link': account['sub_link'], 'configs': configs}
+
+
+def _store(conn, panel_id: int, inbound_id: int, accounts: list) -> None:
+    now = _now()
+    conn.executemany(
+        "INSERT INTO account_pool (panel_id, inbound_id, username, sub_link, configs, status, created_at) "
+        "VALUES (?, ?, ?, ?, ?, 'ready', ?)",
+        [(panel_id, inbound_id, username, sub_link, json.dumps(configs), now) for username, sub_link, configs in accounts],
+    )
+
+
+async def _build_configs(api, panel_id: int, inbound_id: int, usernames: list) -> dict:
+    # One inbound fetch for the whole batch; the client's uuid/password never changes, so the
+    # configs stay valid once the client is enabled
+    from .handlers.admin import _build_configs_from_inbound
+    configs = {}
+    try:
+        inbound = await run_blocking(api._fetch_inbound_detail, inbound_id) if hasattr(api, '_fetch_inbound_detail') else None
+        panel_row = await aquery_db("SELECT * FROM panels WHERE id = ?", (panel_id,), one=True) or {}
+        if inbound:
+            for username in usernames:
+                try:
+                    configs[username] = _build_configs_from_inbound(inbound, username, panel_row) or []
+                except Exception:
+                    configs[username] = []
+    except Exception as e:
+        logger.warning(f"Account pool {panel_id}/{inbound_id}: building configs failed: {e}")
+    return configs
+
+
+async def _refill(panel_id: int, inbound_id: int) -> None:
+    try:
+        target = await aquery_db(
+            "SELECT depth FROM account_pool_targets WHERE panel_id = ? AND inbound_id = ?", (panel_id, inbound_id), one=True
+        )
+        ready = await aquery_db(
+            "SELECT COUNT(*) AS c FROM account_pool WHERE panel_id = ? AND inbound_id = ? AND status = 'ready'",
+            (panel_id, inbound_id), one=True,
+        )
+        missing = min((target or {}).get('depth', 0) - (ready or {}).get('c', 0), ACCOUNT_POOL_REFILL_BATCH)
+        if missing <= 0:
+            return
+        api = VpnPanelAPI(panel_id=panel_id)
+        created = []
+        for _ in range(missing):
+            username, sub_link, msg = await run_blocking(api.create_user_on_inbound, inbound_id, 'pool', _POOL_PLAN, False)
+            if not (username and sub_link):
+                logger.warning(f"Account pool {panel_id}/{inbound_id}: creating a client failed: {msg}")
+                break
+            created.append((username, sub_link))
+        if not created:
+            return
+        configs = await _build_configs(api, panel_id, inbound_id, [username for username, _ in created])
+        await arun_transaction(
+            _store, panel_id, inbound_id,
+            [(username, sub_link, configs.get(username, [])) for username, sub_link in created],
+        )
+        logger.info(f"Account pool {panel_id}/{inbound_id}: added {len(created)} clients")
+    except Exception as e:
+        logger.error(f"Account pool {panel_id}/{inbound_id}: refill failed: {e}")
+    finally:
+        _refilling.discard((panel_id, inbound_id))
+
+
+def schedule_refill(panel_id: int, inbound_id: int) -> None:
+    """Top the pool up in the background, unless a top-up of it is already running."""
+    key = (int(panel_id), int(inbound_id))
+    if key in _refilling:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    _refilling.add(key)
+    task = loop.create_task(_refill(*key))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def refill_account_pools(context) -> None:
+    """Job: top every configured pool up to its depth."""
+    rows = await aquery_db("SELECT panel_id, inbound_id FROM account_pool_targets WHERE depth > 0") or []
+    for row in rows:
+        schedule_refill(row['panel_id'], row['inbound_id'])
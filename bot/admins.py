@@ -0,0 +1,58 @@
+import threading
+
+from .db import execute_db, query_db
+from .config import ADMIN_ID, logger
+
+# In-memory set of additional admins (the `admins` table). Loaded on first use and kept in
+# step by add_admin/remove_admin, which are the only writers of the table, so admin checks
+# on the update path are a set lookup with no database access.
+_lock = threading.Lock()
+_extra_admins: frozenset[int] | None = None
+
+
+def _load() -> frozenset[int]:
+    global _extra_admins
+    with _lock:
+        if _extra_admins is None:
+            ids = set()
+            for row in query_db("SELECT user_id FROM admins") or []:
+                try:
+                    ids.add(int(row['user_id']))
+                except Exception:
+                    continue
+            _extra_admins = frozenset(ids)
+            logger.debug(f"Loaded {len(ids)} additional admins")
+        return _extra_admins
+
+
+def extra_admin_ids() -> list[int]:
+    """Additional admins (not the primary ADMIN_ID), sorted."""
+    extra = _extra_admins if _extra_admins is not None else _load()
+    return sorted(extra)
+
+
+def is_admin(user_id) -> bool:
+    try:
+        user_id = int(user_id)
+    except Exception:
+        return False
+    if ADMIN_ID and user_id == int(ADMIN_ID):
+        return True
+    extra = _extra_admins if _extra_admins is not None else _load()
+    return user_id in extra
+
+
+def add_admin(user_id: int) -> None:
+    global _extra_admins
+    execute_db("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (user_id,))
+    with _lock:
+        _extra_admins = None
+    _load()
+
+
+def remove_admin(user_id: int) -> None:
+    global _extra_admins
+    execute_db("DELETE FROM admins WHERE user_id = ?", (user_id,))
+    with _lock:
+        _extra_admins = None
+    _load()
@@ -8,16 +8,25 @@ from telegram.ext import (
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     ConversationHandler,
     ContextTypes,
     TypeHandler,
     filters,
 )
 
-from .config import BOT_TOKEN, DAILY_JOB_HOUR
+from .config import BOT_TOKEN, DAILY_JOB_HOUR, UNREACHABLE_REPROBE_DAYS, ACCOUNT_POOL_REFILL_SECONDS, BROADCAST_COUNTS_REFRESH_SECONDS
 from .db import db_setup
 from .jobs import check_expirations
+from .broadcast import refresh_segment_counts, resume_broadcasts
+from .provisioning import start_provisioning, stop_provisioning
+from .account_pool import refill_account_pools
+from .reachability import reprobe_unreachable
+from .callback_router import CallbackRouter
+from .update_processor import PerUserUpdateProcessor
+from .persistence import SqlitePersistence
 from .handlers.common import force_join_checker, dynamic_button_handler, start_command
+from .helpers.membership import get_channel_chat, is_channel_member, track_channel_membership
 from .handlers.admin import (
     send_admin_panel,
     admin_command,
@@ -130,6 +139,8 @@ from .handlers.admin_panels import (
     admin_panel_add_start,
     admin_panel_delete,
     admin_panel_inbounds_menu,
+    admin_panel_pool_menu,
+    admin_panel_pool_set,
     admin_panel_inbound_delete,
     admin_panel_inbound_add_start,
     admin_panel_inbound_receive_protocol,
@@ -194,7 +205,10 @@ from .handlers.admin_stats_broadcast import (
 from .handlers.admin_stats_broadcast import (
     admin_broadcast_menu as admin_broadcast_menu,
     admin_broadcast_ask_message as admin_broadcast_ask_message,
+    admin_broadcast_select_panel as admin_broadcast_select_panel,
+    admin_broadcast_receive_segment_value as admin_broadcast_receive_segment_value,
     admin_broadcast_execute as admin_broadcast_execute,
+    admin_broadcast_control as admin_broadcast_control,
 )
 
 
@@ -214,18 +228,44 @@ async def debug_text_logger(update: Update, context: ContextTypes.DEFAULT_TYPE)
         pass
 
 
+async def _post_init(application: Application) -> None:
+    # Continue broadcasts that were running when the bot stopped
+    await resume_broadcasts(application.bot)
+    # Settle provisioning jobs cut off by the restart and start running queued ones
+    await start_provisioning(application)
+
+
+async def _post_stop(application: Application) -> None:
+    await stop_provisioning()
+
+
+# Telegram's default update types plus chat_member, which feeds the channel membership cache
+_ALLOWED_UPDATES = [u for u in Update.ALL_TYPES if u not in (Update.MESSAGE_REACTION, Update.MESSAGE_REACTION_COUNT)]
+
+
 def build_application() -> Application:
     db_setup()
     application = (
         Application.builder()
         .token(BOT_TOKEN)
-        .concurrent_updates(True)
+        .concurrent_updates(PerUserUpdateProcessor())
+        .persistence(SqlitePersistence())
+        .post_init(_post_init)
+        .post_stop(_post_stop)
         .build()
     )
 
     if application.job_queue:
         application.job_queue.run_daily(check_expirations, time=time(hour=DAILY_JOB_HOUR, minute=0, second=0), name="daily_expiration_check")
-
+        if UNREACHABLE_REPROBE_DAYS > 0:
+            application.job_queue.run_daily(reprobe_unreachable, time=time(hour=(DAILY_JOB_HOUR + 12) % 24, minute=0, second=0), name="unreachable_reprobe")
+        # Keep warm account pools topped up (no-op until an admin sets a pool depth)
+        application.job_queue.run_repeating(refill_account_pools, interval=ACCOUNT_POOL_REFILL_SECONDS, first=60, name="account_pool_refill")
+        # Audience sizes for the broadcast menus, counted off the admin's request path
+        application.job_queue.run_repeating(refresh_segment_counts, interval=BROADCAST_COUNTS_REFRESH_SECONDS, first=5, name="broadcast_segment_counts")
+
+    # Channel join/leave events keep the membership cache current (needs the bot to be a channel admin)
+    application.add_handler(ChatMemberHandler(track_channel_membership, ChatMemberHandler.CHAT_MEMBER), group=-2)
     application.add_handler(TypeHandler(Update, force_join_checker), group=-1)
     # Early debug logger for text messages
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, debug_text_logger), group=-1)
@@ -296,6 +336,8 @@ def build_application() -> Application:
             # Panels Management
             ADMIN_PANELS_MENU: [
                 CallbackQueryHandler(admin_panel_inbounds_menu, pattern=r'^panel_inbounds_\d+$'),
+                CallbackQueryHandler(admin_panel_pool_menu, pattern=r'^panel_pool_\d+$'),
+                CallbackQueryHandler(admin_panel_pool_set, pattern=r'^pool_depth_\d+_\d+_(inc|dec)$'),
                 CallbackQueryHandler(admin_panel_delete, pattern=r'^panel_delete_\d+$'),
                 CallbackQueryHandler(admin_panel_add_start, pattern='^panel_add_start$'),
                 CallbackQueryHandler(admin_panels_menu, pattern='^admin_panels_menu$'),
@@ -340,10 +382,16 @@ def build_application() -> Application:
                 CallbackQueryHandler(admin_command, pattern='^admin_main$'),
             ],
             BROADCAST_SELECT_AUDIENCE: [
-                CallbackQueryHandler(admin_broadcast_ask_message, pattern=r'^broadcast_(all|buyers)$'),
+                CallbackQueryHandler(admin_broadcast_ask_message, pattern=r'^broadcast_seg_\w+$'),
+                CallbackQueryHandler(admin_broadcast_select_panel, pattern=r'^broadcast_panel_\d+$'),
+                CallbackQueryHandler(admin_broadcast_menu, pattern='^admin_broadcast_menu$'),
+            ],
+            BROADCAST_AWAIT_SEGMENT_VALUE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_broadcast_receive_segment_value),
             ],
             BROADCAST_SELECT_MODE: [
                 CallbackQueryHandler(admin_broadcast_set_mode, pattern=r'^broadcast_mode_(copy|forward)$'),
+                CallbackQueryHandler(admin_broadcast_menu, pattern='^admin_broadcast_menu$'),
             ],
             BROADCAST_AWAIT_MESSAGE: [
                 MessageHandler(filters.ALL & ~filters.COMMAND, admin_broadcast_execute),
@@ -413,6 +461,8 @@ def build_application() -> Application:
         ],
         allow_reentry=True,
         per_message=False,
+        name='admin_conv',
+        persistent=True,
     )
 
     purchase_conv = ConversationHandler(
@@ -435,6 +485,8 @@ def build_application() -> Application:
         fallbacks=[],
         allow_reentry=True,
         per_message=False,
+        name='purchase_conv',
+        persistent=True,
     )
 
     renewal_conv = ConversationHandler(
@@ -451,6 +503,8 @@ def build_application() -> Application:
         fallbacks=[CallbackQueryHandler(show_specific_service_details, pattern=r'^view_service_')],
         allow_reentry=True,
         per_message=False,
+        name='renewal_conv',
+        persistent=True,
     )
 
     application.add_handler(admin_conv, group=1)
@@ -459,36 +513,40 @@ def build_application() -> Application:
 
     application.add_handler(CommandHandler('start', start_command), group=2)
 
-    application.add_handler(CallbackQueryHandler(admin_ask_panel_for_approval, pattern=r'^approve_auto_'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_approve_on_panel, pattern=r'^approve_on_panel_'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_review_order_reject, pattern=r'^reject_order_'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_manual_send_start, pattern=r'^approve_manual_'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_approve_renewal, pattern=r'^approve_renewal_'), group=3)
-    application.add_handler(CallbackQueryHandler(get_free_config_handler, pattern=r'^get_free_config$'), group=3)
-    application.add_handler(CallbackQueryHandler(my_services_handler, pattern=r'^my_services$'), group=3)
-    application.add_handler(CallbackQueryHandler(show_specific_service_details, pattern=r'^view_service_\d+$'), group=3)
-    application.add_handler(CallbackQueryHandler(refresh_service_link, pattern=r'^refresh_service_link_\d+$'), group=3)
-    application.add_handler(CallbackQueryHandler(revoke_key, pattern=r'^revoke_key_\d+$'), group=3)
-    application.add_handler(CallbackQueryHandler(start_command, pattern='^start_main$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_xui_choose_inbound, pattern=r'^xui_inbound_'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_wallets_menu, pattern='^admin_wallets_menu$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_settings_manage, pattern='^admin_settings_manage$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_admins_menu, pattern='^admin_admins_menu$'), group=3)
+    # Global callback routes (group 3): one handler, routes matched first-registered-first
+    callback_router = CallbackRouter()
+    application.add_handler(callback_router, group=3)
+    callback_router.add(admin_ask_panel_for_approval, r'^approve_auto_')
+    callback_router.add(admin_broadcast_control, r'^bcast_(pause|resume|cancel)_\d+$')
+    callback_router.add(admin_approve_on_panel, r'^approve_on_panel_')
+    callback_router.add(admin_review_order_reject, r'^reject_order_')
+    callback_router.add(admin_manual_send_start, r'^approve_manual_')
+    callback_router.add(admin_approve_renewal, r'^approve_renewal_')
+    callback_router.add(get_free_config_handler, r'^get_free_config$')
+    callback_router.add(my_services_handler, r'^my_services$')
+    callback_router.add(show_specific_service_details, r'^view_service_\d+$')
+    callback_router.add(refresh_service_link, r'^refresh_service_link_\d+$')
+    callback_router.add(revoke_key, r'^revoke_key_\d+$')
+    callback_router.add(start_command, '^start_main$')
+    callback_router.add(admin_xui_choose_inbound, r'^xui_inbound_')
+    callback_router.add(admin_wallets_menu, '^admin_wallets_menu$')
+    callback_router.add(admin_settings_manage, '^admin_settings_manage$')
+    callback_router.add(admin_admins_menu, '^admin_admins_menu$')
     # Reseller approvals (global)
-    application.add_handler(CallbackQueryHandler(admin_reseller_approve, pattern=r'^reseller_approve_\d+$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_reseller_reject, pattern=r'^reseller_reject_\d+$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_reseller_menu, pattern='^admin_reseller_menu$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_reseller_delete_start, pattern=r'^admin_reseller_delete_start$'), group=3)
+    callback_router.add(admin_reseller_approve, r'^reseller_approve_\d+$')
+    callback_router.add(admin_reseller_reject, r'^reseller_reject_\d+$')
+    callback_router.add(admin_reseller_menu, '^admin_reseller_menu$')
+    callback_router.add(admin_reseller_delete_start, r'^admin_reseller_delete_start$')
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, admin_reseller_delete_receive), group=-2)
     # Reseller user flows
-    application.add_handler(CallbackQueryHandler(reseller_menu, pattern=r'^reseller_menu$'), group=3)
-    application.add_handler(CallbackQueryHandler(reseller_pay_start, pattern=r'^reseller_pay_start$'), group=3)
-    application.add_handler(CallbackQueryHandler(reseller_pay_card, pattern=r'^reseller_pay_card$'), group=3)
-    application.add_handler(CallbackQueryHandler(reseller_pay_crypto, pattern=r'^reseller_pay_crypto$'), group=3)
-    application.add_handler(CallbackQueryHandler(reseller_pay_gateway, pattern=r'^reseller_pay_gateway$'), group=3)
-    application.add_handler(CallbackQueryHandler(reseller_verify_gateway, pattern=r'^reseller_verify_gateway$'), group=3)
-    application.add_handler(CallbackQueryHandler(reseller_upload_start_card, pattern=r'^reseller_upload_start_card$'), group=3)
-    application.add_handler(CallbackQueryHandler(reseller_upload_start_crypto, pattern=r'^reseller_upload_start_crypto$'), group=3)
+    callback_router.add(reseller_menu, r'^reseller_menu$')
+    callback_router.add(reseller_pay_start, r'^reseller_pay_start$')
+    callback_router.add(reseller_pay_card, r'^reseller_pay_card$')
+    callback_router.add(reseller_pay_crypto, r'^reseller_pay_crypto$')
+    callback_router.add(reseller_pay_gateway, r'^reseller_pay_gateway$')
+    callback_router.add(reseller_verify_gateway, r'^reseller_verify_gateway$')
+    callback_router.add(reseller_upload_start_card, r'^reseller_upload_start_card$')
+    callback_router.add(reseller_upload_start_crypto, r'^reseller_upload_start_crypto$')
 
     # Route critical admin callbacks globally so buttons work from any state
     # application.add_handler(CallbackQueryHandler(admin_global_router, pattern=r'^admin_'), group=0)
@@ -497,40 +555,40 @@ def build_application() -> Application:
     application.add_handler(CommandHandler('setms', admin_setms_command), group=0)
 
     # Global settings callbacks so they work from any screen
-    application.add_handler(CallbackQueryHandler(admin_settings_manage, pattern='^admin_settings_manage$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_settings_ask, pattern=r'^set_(trial_days|payment_text)$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_toggle_trial_status, pattern=r'^set_trial_status_(0|1)$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_set_usd_rate_start, pattern='^set_usd_rate_start$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_toggle_usd_mode, pattern=r'^toggle_usd_mode_(manual|api)$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_toggle_pay_card, pattern=r'^toggle_pay_card_(0|1)$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_toggle_pay_crypto, pattern=r'^toggle_pay_crypto_(0|1)$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_toggle_pay_gateway, pattern=r'^toggle_pay_gateway_(0|1)$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_toggle_gateway_type, pattern=r'^toggle_gateway_type_(zarinpal|aghapay)$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_toggle_signup_bonus, pattern=r'^toggle_signup_bonus_(0|1)$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_set_signup_bonus_amount_start, pattern='^set_signup_bonus_amount$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_set_trial_panel_start, pattern='^set_trial_panel_start$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_set_trial_panel_choose, pattern=r'^set_trial_panel_\d+$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_set_ref_percent_start, pattern='^set_ref_percent_start$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_set_config_footer_start, pattern='^set_config_footer_start$'), group=3)
+    callback_router.add(admin_settings_manage, '^admin_settings_manage$')
+    callback_router.add(admin_settings_ask, r'^set_(trial_days|payment_text)$')
+    callback_router.add(admin_toggle_trial_status, r'^set_trial_status_(0|1)$')
+    callback_router.add(admin_set_usd_rate_start, '^set_usd_rate_start$')
+    callback_router.add(admin_toggle_usd_mode, r'^toggle_usd_mode_(manual|api)$')
+    callback_router.add(admin_toggle_pay_card, r'^toggle_pay_card_(0|1)$')
+    callback_router.add(admin_toggle_pay_crypto, r'^toggle_pay_crypto_(0|1)$')
+    callback_router.add(admin_toggle_pay_gateway, r'^toggle_pay_gateway_(0|1)$')
+    callback_router.add(admin_toggle_gateway_type, r'^toggle_gateway_type_(zarinpal|aghapay)$')
+    callback_router.add(admin_toggle_signup_bonus, r'^toggle_signup_bonus_(0|1)$')
+    callback_router.add(admin_set_signup_bonus_amount_start, '^set_signup_bonus_amount$')
+    callback_router.add(admin_set_trial_panel_start, '^set_trial_panel_start$')
+    callback_router.add(admin_set_trial_panel_choose, r'^set_trial_panel_\d+$')
+    callback_router.add(admin_set_ref_percent_start, '^set_ref_percent_start$')
+    callback_router.add(admin_set_config_footer_start, '^set_config_footer_start$')
 
     # Text handlers for settings flows (awaiting_admin flags)
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, admin_set_ref_percent_save), group=-2)
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, admin_set_config_footer_save), group=-2)
-    application.add_handler(CallbackQueryHandler(admin_set_payment_text_start, pattern='^set_payment_text$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_set_usd_rate_start_global, pattern='^set_usd_rate_start$'), group=3)
+    callback_router.add(admin_set_payment_text_start, '^set_payment_text$')
+    callback_router.add(admin_set_usd_rate_start_global, '^set_usd_rate_start$')
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, admin_settings_save_payment_text), group=-2)
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, admin_set_usd_rate_save), group=-2)
 
     # Tutorials (admin) handlers
-    application.add_handler(CallbackQueryHandler(admin_tutorial_add_start, pattern='^tutorial_add_start$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_tutorial_delete, pattern=r'^tutorial_delete_\d+$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_tutorial_view, pattern=r'^tutorial_view_\d+$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_tutorials_menu, pattern='^admin_tutorials_menu$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_tutorial_finish, pattern='^tutorial_finish$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_tutorial_media_page, pattern=r'^tutorial_media_page_(prev|next)$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_tutorial_edit_title_start, pattern='^tutorial_edit_title$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_tutorial_media_delete, pattern=r'^tmedia_del_\d+$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_tutorial_media_move, pattern=r'^tmedia_(up|down)_\d+$'), group=3)
+    callback_router.add(admin_tutorial_add_start, '^tutorial_add_start$')
+    callback_router.add(admin_tutorial_delete, r'^tutorial_delete_\d+$')
+    callback_router.add(admin_tutorial_view, r'^tutorial_view_\d+$')
+    callback_router.add(admin_tutorials_menu, '^admin_tutorials_menu$')
+    callback_router.add(admin_tutorial_finish, '^tutorial_finish$')
+    callback_router.add(admin_tutorial_media_page, r'^tutorial_media_page_(prev|next)$')
+    callback_router.add(admin_tutorial_edit_title_start, '^tutorial_edit_title$')
+    callback_router.add(admin_tutorial_media_delete, r'^tmedia_del_\d+$')
+    callback_router.add(admin_tutorial_media_move, r'^tmedia_(up|down)_\d+$')
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, admin_tutorial_receive_title), group=-3)
     application.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, admin_tutorial_receive_media), group=-3)
 
@@ -538,16 +596,10 @@ def build_application() -> Application:
     async def check_join_and_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Verify membership before proceeding
         from .config import CHANNEL_ID as _CID, CHANNEL_USERNAME as _CUN, logger as _logger
-        try:
-            from .config import CHANNEL_CHAT as _CHAT
-        except Exception:
-            _CHAT = None
-        chat_id = _CHAT if _CHAT is not None else (_CID or _CUN)
         is_member = False
         try:
-            member = await context.bot.get_chat_member(chat_id=chat_id, user_id=update.effective_user.id)
-            if getattr(member, 'status', None) in ['member', 'administrator', 'creator']:
-                is_member = True
+            # force_join_checker has just refreshed this user's entry for the check_join press
+            is_member = await is_channel_member(context.bot, update.effective_user.id)
         except Exception as e:
             # If cannot verify, treat as not joined to avoid bypass
             try:
@@ -561,7 +613,7 @@ def build_application() -> Application:
             join_url = None
             channel_hint = ""
             try:
-                chat_obj = await context.bot.get_chat(chat_id=chat_id)
+                chat_obj = await get_channel_chat(context.bot)
                 uname = getattr(chat_obj, 'username', None)
                 inv = getattr(chat_obj, 'invite_link', None)
                 if uname:
@@ -603,49 +655,49 @@ def build_application() -> Application:
         await register_new_user(update.effective_user, update, referrer_hint=context.user_data.get('referrer_id'))
         await start_command(update, context)
 
-    application.add_handler(CallbackQueryHandler(check_join_and_start, pattern='^check_join$'), group=3)
+    callback_router.add(check_join_and_start, '^check_join$')
 
     application.add_handler(CallbackQueryHandler(dynamic_button_handler), group=4)
 
     # Global: admin messages menu so it opens from anywhere
-    application.add_handler(CallbackQueryHandler(admin_messages_menu, pattern='^admin_messages_menu$'), group=3)
+    callback_router.add(admin_messages_menu, '^admin_messages_menu$')
 
     # User main menu callbacks (global)
-    application.add_handler(CallbackQueryHandler(wallet_menu, pattern=r'^wallet_menu$'), group=3)
-    application.add_handler(CallbackQueryHandler(support_menu, pattern=r'^support_menu$'), group=3)
-    application.add_handler(CallbackQueryHandler(tutorials_menu, pattern=r'^tutorials_menu$'), group=3)
-    application.add_handler(CallbackQueryHandler(tutorial_show, pattern=r'^tutorial_show_\d+$'), group=3)
-    application.add_handler(CallbackQueryHandler(referral_menu, pattern=r'^referral_menu$'), group=3)
-    application.add_handler(CallbackQueryHandler(reseller_menu, pattern=r'^reseller_menu$'), group=3)
+    callback_router.add(wallet_menu, r'^wallet_menu$')
+    callback_router.add(support_menu, r'^support_menu$')
+    callback_router.add(tutorials_menu, r'^tutorials_menu$')
+    callback_router.add(tutorial_show, r'^tutorial_show_\d+$')
+    callback_router.add(referral_menu, r'^referral_menu$')
+    callback_router.add(reseller_menu, r'^reseller_menu$')
 
     # User wallet flows and support/tutorials (global callbacks)
-    application.add_handler(CallbackQueryHandler(wallet_verify_gateway, pattern=r'^wallet_verify_gateway$'), group=3)
+    callback_router.add(wallet_verify_gateway, r'^wallet_verify_gateway$')
 
     # Unified upload router handles both wallet and reseller (run early to avoid other catch-alls)
     application.add_handler(MessageHandler(filters.PHOTO | filters.VOICE | filters.VIDEO | filters.AUDIO | filters.Document.ALL | filters.TEXT, composite_upload_router), group=0)
 
     # Reseller flows
-    application.add_handler(CallbackQueryHandler(reseller_pay_start, pattern=r'^reseller_pay_start$'), group=3)
-    application.add_handler(CallbackQueryHandler(reseller_pay_card, pattern=r'^reseller_pay_card$'), group=3)
-    application.add_handler(CallbackQueryHandler(reseller_pay_crypto, pattern=r'^reseller_pay_crypto$'), group=3)
-    application.add_handler(CallbackQueryHandler(reseller_pay_gateway, pattern=r'^reseller_pay_gateway$'), group=3)
-    application.add_handler(CallbackQueryHandler(reseller_verify_gateway, pattern=r'^reseller_verify_gateway$'), group=3)
-    application.add_handler(CallbackQueryHandler(reseller_upload_start_card, pattern=r'^reseller_upload_start_card$'), group=3)
-    application.add_handler(CallbackQueryHandler(reseller_upload_start_crypto, pattern=r'^reseller_upload_start_crypto$'), group=3)
+    callback_router.add(reseller_pay_start, r'^reseller_pay_start$')
+    callback_router.add(reseller_pay_card, r'^reseller_pay_card$')
+    callback_router.add(reseller_pay_crypto, r'^reseller_pay_crypto$')
+    callback_router.add(reseller_pay_gateway, r'^reseller_pay_gateway$')
+    callback_router.add(reseller_verify_gateway, r'^reseller_verify_gateway$')
+    callback_router.add(reseller_upload_start_card, r'^reseller_upload_start_card$')
+    callback_router.add(reseller_upload_start_crypto, r'^reseller_upload_start_crypto$')
     # Already covered by composite router
 
     # Admin tickets (global)
-    application.add_handler(CallbackQueryHandler(admin_tickets_menu, pattern=r'^admin_tickets_menu$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_ticket_view, pattern=r'^ticket_view_\d+$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_ticket_delete, pattern=r'^ticket_delete_\d+$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_ticket_reply_start, pattern=r'^ticket_reply_\d+$'), group=3)
+    callback_router.add(admin_tickets_menu, r'^admin_tickets_menu$')
+    callback_router.add(admin_ticket_view, r'^ticket_view_\d+$')
+    callback_router.add(admin_ticket_delete, r'^ticket_delete_\d+$')
+    callback_router.add(admin_ticket_reply_start, r'^ticket_reply_\d+$')
     application.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, admin_ticket_receive_reply), group=-3)
 
     # Admin wallet tx (global)
-    application.add_handler(CallbackQueryHandler(admin_wallet_tx_menu, pattern=r'^admin_wallet_tx_menu$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_wallet_tx_view, pattern=r'^wallet_tx_view_\d+$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_wallet_tx_approve, pattern=r'^wallet_tx_approve_\d+$'), group=3)
-    application.add_handler(CallbackQueryHandler(admin_wallet_tx_reject, pattern=r'^wallet_tx_reject_\d+$'), group=3)
+    callback_router.add(admin_wallet_tx_menu, r'^admin_wallet_tx_menu$')
+    callback_router.add(admin_wallet_tx_view, r'^wallet_tx_view_\d+$')
+    callback_router.add(admin_wallet_tx_approve, r'^wallet_tx_approve_\d+$')
+    callback_router.add(admin_wallet_tx_reject, r'^wallet_tx_reject_\d+$')
     # Place before other generic text handlers to ensure it captures admin adjust flow
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, admin_wallet_adjust_text_router), group=-4)
 
@@ -657,6 +709,8 @@ def build_application() -> Application:
         fallbacks=[CallbackQueryHandler(admin_tickets_menu, pattern='^admin_tickets_menu$')],
         allow_reentry=True,
         per_message=False,
+        name='admin_reply_conv',
+        persistent=True,
     )
     application.add_handler(admin_reply_conv, group=1)
 
@@ -691,6 +745,8 @@ def build_application() -> Application:
         fallbacks=[CallbackQueryHandler(wallet_menu, pattern='^wallet_menu$')],
         allow_reentry=True,
         per_message=False,
+        name='wallet_conv',
+        persistent=True,
     )
     application.add_handler(wallet_conv, group=1)
 
@@ -702,12 +758,14 @@ def build_application() -> Application:
         fallbacks=[],
         allow_reentry=True,
         per_message=False,
+        name='support_conv',
+        persistent=True,
     )
 
     application.add_handler(support_conv, group=1)
 
     # Purchase quick handlers
-    application.add_handler(CallbackQueryHandler(pay_method_wallet, pattern=r'^pay_method_wallet$'), group=3)
+    callback_router.add(pay_method_wallet, r'^pay_method_wallet$')
 
     return application
 
@@ -743,7 +801,7 @@ def run():
                 loop.run_until_complete(app.bot.delete_webhook(drop_pending_updates=True))
         except Exception:
             pass
-        app.run_polling(drop_pending_updates=True)
+        app.run_polling(drop_pending_updates=True, allowed_updates=_ALLOWED_UPDATES)
         return
 
     # Webhook mode (for shared hosting with HTTPS domain + open HTTP port)
@@ -755,7 +813,7 @@ def run():
 
     # If WEBHOOK_URL not set or invalid, fallback to polling to keep bot usable
     if not (base_url.startswith('http://') or base_url.startswith('https://')):
-        app.run_polling(drop_pending_updates=True)
+        app.run_polling(drop_pending_updates=True, allowed_updates=_ALLOWED_UPDATES)
         return
 
     # Drop any pending updates before switching to webhook
@@ -775,4 +833,5 @@ def run():
         url_path=url_path,
         webhook_url=webhook_url,
         secret_token=secret_token,
+        allowed_updates=_ALLOWED_UPDATES,
     )
\ No newline at end of file
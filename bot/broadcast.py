@@ -0,0 +1,365 @@
+import asyncio
+import time
+from datetime import datetime
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden
+
+from .config import logger
+from .db import aexecute_db, aquery_db, arun_transaction, query_db, execute_db
+from .reachability import REACHABLE_CLAUSE
+from .send_scheduler import scheduled_send, PRIORITY_BULK
+
+# Persistent broadcast jobs.
+#
+# A broadcast row holds the message to copy/forward, its audience and a recipient cursor.
+# The worker claims recipients in batches (user_id > cursor, ordered), writing a
+# 'sending' delivery row and advancing the cursor in one transaction, then sends the batch
+# through the shared send scheduler and records the outcome. On restart, running jobs
+# continue from their cursor; deliveries left in 'sending' by a crash are marked failed
+# rather than retried, so nobody receives a broadcast twice.
+
+_BATCH_SIZE = 100
+_PROGRESS_EVERY_SECONDS = 3
+
+# Audience segments. Each `sql` selects recipient ids greater than :cursor (keyset pagination on
+# `col`, so recipients stream into the job batch by batch); `{reach}` is replaced by the
+# reachability filter (see reachability.py), so `col` must carry its table alias. Segments
+# with a `param` take one admin-chosen value, bound as :value and stored in
+# broadcasts.audience_value.
+SEGMENTS = {
+    'all': {
+        'title': "همه کاربران",
+        'col': 'user_id',
+        'reach': 'reachable = 1',
+        'sql': "SELECT user_id FROM users WHERE {reach} AND user_id > :cursor",
+    },
+    'buyers': {
+        'title': "خریداران",
+        'col': 'o.user_id',
+        'sql': "SELECT DISTINCT o.user_id FROM orders o WHERE o.status = 'approved' AND {reach} AND o.user_id > :cursor",
+    },
+    'trial': {
+        'title': "کاربران تست بدون خرید",
+        'col': 'f.user_id',
+        'sql': (
+            "SELECT f.user_id FROM free_trials f WHERE NOT EXISTS ("
+            "SELECT 1 FROM orders o WHERE o.user_id = f.user_id AND o.status = 'approved' AND COALESCE(o.is_trial, 0) = 0"
+            ") AND {reach} AND f.user_id > :cursor"
+        ),
+    },
+    'expiring': {
+        'title': "سرویس رو به اتمام",
+        'col': 'o.user_id',
+        'param': 'days',
+        'prompt': "انقضای سرویس تا چند روز آینده؟ (عدد روز را ارسال کنید)",
+        # expire_at is refreshed from the panels by the daily expiration check (jobs.py)
+        'sql': (
+            "SELECT DISTINCT o.user_id FROM orders o WHERE o.status = 'approved' "
+            "AND o.expire_at BETWEEN CAST(strftime('%s', 'now') AS INTEGER) AND CAST(strftime('%s', 'now') AS INTEGER) + :value * 86400 "
+            "AND {reach} AND o.user_id > :cursor"
+        ),
+    },
+    'wallet': {
+        'title': "موجودی کیف پول بیشتر از",
+        'col': 'w.user_id',
+        'param': 'amount',
+        'prompt': "حداقل موجودی کیف پول (تومان) را ارسال کنید:",
+        'sql': "SELECT w.user_id FROM user_wallets w WHERE w.balance > :value AND {reach} AND w.user_id > :cursor",
+    },
+    'panel': {
+        'title': "کاربران یک پنل",
+        'col': 'o.user_id',
+        'param': 'panel',
+        'sql': (
+            "SELECT DISTINCT o.user_id FROM orders o WHERE o.status = 'approved' AND o.panel_id = :value "
+            "AND {reach} AND o.user_id > :cursor"
+        ),
+    },
+    'referrers': {
+        'title': "معرف‌ها با حداقل زیرمجموعه",
+        'col': 'r.referrer_id',
+        'param': 'count',
+        'prompt': "حداقل تعداد زیرمجموعه را ارسال کنید:",
+        'sql': (
+            "SELECT r.referrer_id AS user_id FROM referrals r WHERE {reach} AND r.referrer_id > :cursor "
+            "GROUP BY r.referrer_id HAVING COUNT(*) >= :value"
+        ),
+    },
+}
+
+# Menu counts: (segment, value) -> reachable recipients, recomputed by refresh_segment_counts
+# for the parameterless segments and every panel, so opening a menu runs no query
+_segment_counts: dict = {}
+
+
+def _segment_sql(segment: str, filtered: bool = True) -> str:
+    seg = SEGMENTS[segment]
+    reach = seg.get('reach') or REACHABLE_CLAUSE.format(col=seg['col'])
+    return seg['sql'].format(reach=reach if filtered else '1')
+
+
+def _recipients_sql(segment: str) -> str:
+    return f"{_segment_sql(segment)} ORDER BY {SEGMENTS[segment]['col']} LIMIT :limit"
+
+_STATUS_LABELS = {
+    'running': "⏳ در حال ارسال",
+    'paused': "⏸ متوقف شده",
+    'cancelled': "❌ لغو شده",
+    'done': "✅ پایان یافته",
+}
+
+_tasks: dict[int, asyncio.Task] = {}
+
+
+async def _acount(segment: str, value=None, filtered: bool = True) -> int:
+    row = await aquery_db(
+        f"SELECT COUNT(*) AS c FROM ({_segment_sql(segment, filtered)})",
+        {'cursor': 0, 'value': value},
+        one=True,
+    ) or {}
+    return int(row.get('c') or 0)
+
+
+async def refresh_segment_counts(context=None) -> None:
+    """Job: recount the audiences shown in the broadcast menus."""
+    global _segment_counts
+    try:
+        counts = {}
+        for key, seg in SEGMENTS.items():
+            if not seg.get('param'):
+                counts[(key, None)] = await _acount(key)
+        rows = await aquery_db(
+            "SELECT panel_id, COUNT(DISTINCT user_id) AS c FROM orders WHERE status = 'approved' AND panel_id IS NOT NULL "
+            f"AND {REACHABLE_CLAUSE.format(col='orders.user_id')} GROUP BY panel_id"
+        ) or []
+        for r in rows:
+            counts[('panel', r['panel_id'])] = int(r['c'] or 0)
+        _segment_counts = counts
+    except Exception as e:
+        logger.error(f"Could not refresh broadcast segment counts: {e}")
+
+
+def cached_segment_count(segment: str, value=None):
+    """Last precomputed size of the audience, or None before the first count."""
+    if segment == 'panel' and _segment_counts:
+        return _segment_counts.get((segment, value), 0)
+    return _segment_counts.get((segment, value))
+
+
+async def segment_count(segment: str, value=None) -> int:
+    """Reachable audience size: the precomputed one, else counted off the event loop."""
+    cached = cached_segment_count(segment, value)
+    return cached if cached is not None else await _acount(segment, value)
+
+
+def panel_segment_counts():
+    """panel_id -> reachable buyers on that panel as last precomputed, or None before the first count."""
+    if not _segment_counts:
+        return None
+    return {value: count for (segment, value), count in _segment_counts.items() if segment == 'panel'}
+
+
+def segment_label(segment: str, value=None) -> str:
+    title = SEGMENTS[segment]['title']
+    if value is None:
+        return title
+    if segment == 'panel':
+        row = query_db("SELECT name FROM panels WHERE id = ?", (value,), one=True)
+        return f"{title}: {row['name'] if row else value}"
+    return f"{title}: {value}"
+
+
+async def create_broadcast(admin_id: int, audience: str, mode: str, from_chat_id: int, message_id: int, audience_value=None) -> int:
+    # Exact counts for the progress report, taken on the DB threads rather than the event loop
+    total = await _acount(audience, audience_value)
+    skipped = max(0, await _acount(audience, audience_value, filtered=False) - total)
+    if skipped:
+        logger.info(f"Broadcast ({audience}): skipping {skipped} unreachable users")
+    return await aexecute_db(
+        "INSERT INTO broadcasts (admin_id, audience, audience_value, mode, from_chat_id, message_id, total, skipped, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (admin_id, audience, audience_value, mode, from_chat_id, message_id, total, skipped, datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+    )
+
+
+def set_progress_message(broadcast_id: int, chat_id: int, message_id: int) -> None:
+    execute_db(
+        "UPDATE broadcasts SET progress_chat_id = ?, progress_message_id = ? WHERE id = ?",
+        (chat_id, message_id, broadcast_id),
+    )
+
+
+def get_broadcast(broadcast_id: int):
+    return query_db("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,), one=True)
+
+
+def progress_text(b: dict) -> str:
+    done = int(b.get('sent') or 0) + int(b.get('failed') or 0)
+    total = max(int(b.get('total') or 0), done)
+    percent = int(done * 100 / total) if total else 100
+    return (
+        f"\U0001F4E3 ارسال همگانی #{b['id']}\n"
+        f"مخاطبان: {segment_label(b['audience'], b.get('audience_value')) if b.get('audience') in SEGMENTS else b.get('audience')}\n\n"
+        f"وضعیت: {_STATUS_LABELS.get(b.get('status'), b.get('status'))}\n"
+        f"پیشرفت: {done}/{total} ({percent}%)\n"
+        f"ارسال موفق: {int(b.get('sent') or 0)}\n"
+        f"ارسال ناموفق: {int(b.get('failed') or 0)}\n"
+        f"رد شده (ربات را مسدود کرده‌اند): {int(b.get('skipped') or 0)}"
+    )
+
+
+def progress_keyboard(b: dict):
+    if b.get('status') == 'running':
+        row = [
+            InlineKeyboardButton("⏸ توقف", callback_data=f"bcast_pause_{b['id']}"),
+            InlineKeyboardButton("❌ لغو", callback_data=f"bcast_cancel_{b['id']}"),
+        ]
+    elif b.get('status') == 'paused':
+        row = [
+            InlineKeyboardButton("▶️ ادامه", callback_data=f"bcast_resume_{b['id']}"),
+            InlineKeyboardButton("❌ لغو", callback_data=f"bcast_cancel_{b['id']}"),
+        ]
+    else:
+        return None
+    return InlineKeyboardMarkup([row])
+
+
+async def _update_progress(bot, broadcast_id: int) -> None:
+    b = await aquery_db("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,), one=True)
+    if not b or not b.get('progress_chat_id'):
+        return
+    try:
+        await bot.edit_message_text(
+            chat_id=b['progress_chat_id'],
+            message_id=b['progress_message_id'],
+            text=progress_text(b),
+            reply_markup=progress_keyboard(b),
+        )
+    except BadRequest as e:
+        if 'not modified' not in str(e).lower():
+            logger.warning(f"Broadcast #{broadcast_id}: progress edit failed: {e}")
+    except Exception as e:
+        logger.warning(f"Broadcast #{broadcast_id}: progress edit failed: {e}")
+
+
+def _claim_batch(conn, broadcast_id: int):
+    """Claim the next recipients; None when the job is not running, [] when it has no more."""
+    row = conn.execute("SELECT status, audience, audience_value, cursor FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+    if not row or row['status'] != 'running':
+        return None
+    if row['audience'] not in SEGMENTS:
+        return []
+    user_ids = [r[0] for r in conn.execute(
+        _recipients_sql(row['audience']),
+        {'cursor': row['cursor'], 'value': row['audience_value'], 'limit': _BATCH_SIZE},
+    )]
+    if not user_ids:
+        conn.execute(
+            "UPDATE broadcasts SET status = 'done', finished_at = ? WHERE id = ?",
+            (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), broadcast_id),
+        )
+        return []
+    conn.executemany(
+        "INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id, status) VALUES (?, ?, 'sending')",
+        [(broadcast_id, uid) for uid in user_ids],
+    )
+    conn.execute("UPDATE broadcasts SET cursor = ? WHERE id = ?", (user_ids[-1], broadcast_id))
+    return user_ids
+
+
+def _record_results(conn, broadcast_id: int, results: list) -> None:
+    conn.executemany(
+        "UPDATE broadcast_deliveries SET status = ?, error = ? WHERE broadcast_id = ? AND user_id = ?",
+        [(status, error, broadcast_id, uid) for uid, status, error in results],
+    )
+    sent = sum(1 for _, status, _ in results if status == 'sent')
+    conn.execute(
+        "UPDATE broadcasts SET sent = sent + ?, failed = failed + ? WHERE id = ?",
+        (sent, len(results) - sent, broadcast_id),
+    )
+
+
+async def _deliver(bot, b: dict, user_id: int):
+    method = bot.forward_message if b['mode'] == 'forward' else bot.copy_message
+    try:
+        await scheduled_send(method, chat_id=user_id, priority=PRIORITY_BULK, from_chat_id=b['from_chat_id'], message_id=b['message_id'])
+        return user_id, 'sent', None
+    except (Forbidden, BadRequest) as e:
+        return user_id, 'failed', str(e)[:200]
+    except Exception as e:
+        return user_id, 'failed', str(e)[:200]
+
+
+async def _run(bot, broadcast_id: int) -> None:
+    b = await aquery_db("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,), one=True)
+    if not b:
+        return
+    logger.info(f"Broadcast #{broadcast_id}: worker started ({b['audience']}, {b['mode']})")
+    last_progress = 0.0
+    try:
+        while True:
+            user_ids = await arun_transaction(_claim_batch, broadcast_id)
+            if not user_ids:
+                break
+            results = await asyncio.gather(*(_deliver(bot, b, uid) for uid in user_ids))
+            await arun_transaction(_record_results, broadcast_id, results)
+            if time.monotonic() - last_progress >= _PROGRESS_EVERY_SECONDS:
+                last_progress = time.monotonic()
+                await _update_progress(bot, broadcast_id)
+    except Exception as e:
+        logger.error(f"Broadcast #{broadcast_id}: worker stopped: {e}")
+    finally:
+        _tasks.pop(broadcast_id, None)
+        await _update_progress(bot, broadcast_id)
+        b = await aquery_db("SELECT status, sent, failed FROM broadcasts WHERE id = ?", (broadcast_id,), one=True) or {}
+        logger.info(f"Broadcast #{broadcast_id}: worker exited, status={b.get('status')} sent={b.get('sent')} failed={b.get('failed')}")
+
+
+def start_broadcast(bot, broadcast_id: int) -> None:
+    task = _tasks.get(broadcast_id)
+    if task is not None and not task.done():
+        return
+    _tasks[broadcast_id] = asyncio.get_running_loop().create_task(_run(bot, broadcast_id))
+
+
+def set_broadcast_status(broadcast_id: int, status: str) -> bool:
+    """Pause, resume or cancel a broadcast; returns False when the transition does not apply."""
+    allowed_from = {
+        'paused': ('running',),
+        'running': ('paused',),
+        'cancelled': ('running', 'paused'),
+    }[status]
+    placeholders = ','.join('?' for _ in allowed_from)
+    execute_db(
+        f"UPDATE broadcasts SET status = ?, finished_at = CASE WHEN ? = 'cancelled' THEN ? ELSE finished_at END "
+        f"WHERE id = ? AND status IN ({placeholders})",
+        (status, status, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), broadcast_id, *allowed_from),
+    )
+    row = query_db("SELECT status FROM broadcasts WHERE id = ?", (broadcast_id,), one=True)
+    return bool(row) and row['status'] == status
+
+
+def _settle_interrupted(conn) -> int:
+    # A 'sending' delivery may or may not have reached the user before the crash; count it
+    # as failed instead of risking a duplicate
+    rows = conn.execute(
+        "SELECT broadcast_id, COUNT(*) FROM broadcast_deliveries WHERE status = 'sending' GROUP BY broadcast_id"
+    ).fetchall()
+    for broadcast_id, count in rows:
+        conn.execute("UPDATE broadcasts SET failed = failed + ? WHERE id = ?", (count, broadcast_id))
+    conn.execute("UPDATE broadcast_deliveries SET status = 'failed', error = 'interrupted' WHERE status = 'sending'")
+    return sum(count for _, count in rows)
+
+
+async def resume_broadcasts(bot) -> None:
+    """Called once at startup: settle interrupted deliveries and restart running jobs."""
+    try:
+        interrupted = await arun_transaction(_settle_interrupted)
+        if interrupted:
+            logger.warning(f"Broadcasts: {interrupted} deliveries interrupted by restart were marked failed")
+        rows = await aquery_db("SELECT id FROM broadcasts WHERE status = 'running'") or []
+        for row in rows:
+            start_broadcast(bot, row['id'])
+    except Exception as e:
+        logger.error(f"Could not resume broadcasts: {e}")
@@ -0,0 +1,104 @@
+import re
+
+from telegram import Update
+from telegram.ext import BaseHandler
+
+# One handler for the global callback-query routes (group 3 in app.py).
+#
+# python-telegram-bot tries the handlers of a group one by one, so every button press used
+# to run up to ~80 regexes. The router indexes each route by the literal text its pattern
+# starts with (`^view_service_\d+$` -> "view_service_"); a callback only runs the patterns
+# whose literal prefix it starts with, and exact patterns (`^my_services$`) are a dict hit.
+# Routes keep their registration order, so the first matching route wins as before.
+
+_META = set('.^$*+?{}[]\\|()')
+
+
+def _literal_prefix(pattern: str):
+    """(prefix, exact) for a `^literal...` pattern; None when no literal prefix can be relied on."""
+    if not pattern.startswith('^'):
+        return None
+    depth = 0
+    for ch in pattern:
+        # A top-level alternative could match without the prefix
+        if ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+        elif ch == '|' and depth == 0:
+            return None
+    body = pattern[1:]
+    end = 0
+    while end < len(body) and body[end] not in _META:
+        end += 1
+    prefix = body[:end]
+    if end == len(body) - 1 and body[end] == '$':
+        return prefix, True
+    if end < len(body) and body[end] in '*?{':
+        # The last literal character is optional
+        prefix = prefix[:-1]
+    return prefix, False
+
+
+class CallbackRouter(BaseHandler):
+    def __init__(self):
+        super().__init__(self._unrouted)
+        self._exact: dict[str, list] = {}
+        self._prefixed: dict[str, list] = {}
+        self._prefix_lengths: list[int] = []
+        self._unindexed: list = []
+        self._order = 0
+
+    @staticmethod
+    async def _unrouted(update, context):
+        return None
+
+    def add(self, callback, pattern: str) -> None:
+        """Route callback queries whose data matches `pattern` (same semantics as CallbackQueryHandler)."""
+        route = (self._order, re.compile(pattern), callback)
+        self._order += 1
+        literal = _literal_prefix(pattern)
+        if literal is None:
+            self._unindexed.append(route)
+            return
+        prefix, exact = literal
+        if exact:
+            self._exact.setdefault(prefix, []).append(route)
+            return
+        self._prefixed.setdefault(prefix, []).append(route)
+        if len(prefix) not in self._prefix_lengths:
+            self._prefix_lengths.append(len(prefix))
+            self._prefix_lengths.sort()
+
+    def resolve(self, data: str):
+        """(callback, match) of the first route matching `data`, or None."""
+        candidates = list(self._exact.get(data, ()))
+        for length in self._prefix_lengths:
+            if length > len(data):
+                break
+            bucket = self._prefixed.get(data[:length])
+            if bucket:
+                candidates.extend(bucket)
+        candidates.extend(self._unindexed)
+        if len(candidates) > 1:
+            candidates.sort(key=lambda route: route[0])
+        for _, regex, callback in candidates:
+            match = regex.match(data)
+            if match:
+                return callback, match
+        return None
+
+    def check_update(self, update):
+        if not isinstance(update, Update) or not update.callback_query:
+            return None
+        data = update.callback_query.data
+        if not isinstance(data, str):
+            return None
+        return self.resolve(data)
+
+    def collect_additional_context(self, context, update, application, check_result):
+        context.matches = [check_result[1]]
+
+    async def handle_update(self, update, application, check_result, context):
+        self.collect_additional_context(context, update, application, check_result)
+        return await check_result[0](update, context)
@@ -63,6 +63,55 @@ def _unify_chat_identifier(raw_id: str, username: str):
 # Prefer CHANNEL_ID if provided, otherwise CHANNEL_USERNAME
 CHANNEL_CHAT = _unify_chat_identifier(RAW_CHANNEL_ID, CHANNEL_USERNAME)
 DB_NAME = os.getenv("DB_NAME", "bot.db")
+# SQLite tuning for the pooled per-thread connections in db.py
+DB_BUSY_TIMEOUT_MS = _safe_int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"), 5000)
+DB_CACHE_SIZE_KB = _safe_int(os.getenv("DB_CACHE_SIZE_KB", "16384"), 16384)
+DB_MMAP_SIZE = _safe_int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)), 64 * 1024 * 1024)
+# Reader threads behind aquery_db (writes always go through a single writer thread)
+DB_READ_WORKERS = max(1, _safe_int(os.getenv("DB_READ_WORKERS", "4"), 4))
+# How often a process re-checks settings_version before trusting its cached settings
+SETTINGS_VERSION_CHECK_SECONDS = max(0, _safe_int(os.getenv("SETTINGS_VERSION_CHECK_SECONDS", "2"), 2))
+# Panel HTTP transport (panel_http.py): worker threads for blocking panel calls and
+# keep-alive pool limits shared by all panel adapters
+PANEL_HTTP_WORKERS = max(1, _safe_int(os.getenv("PANEL_HTTP_WORKERS", "16"), 16))
+PANEL_HTTP_MAX_PER_HOST = max(1, _safe_int(os.getenv("PANEL_HTTP_MAX_PER_HOST", "8"), 8))
+PANEL_HTTP_MAX_HOSTS = max(1, _safe_int(os.getenv("PANEL_HTTP_MAX_HOSTS", "32"), 32))
+# Inbounds fetched at once when enumerating an X-UI panel's clients (kept below MAX_PER_HOST
+# so interactive calls to the same panel still get a connection)
+PANEL_SCAN_CONCURRENCY = max(1, _safe_int(os.getenv("PANEL_SCAN_CONCURRENCY", "6"), 6))
+# Upper bound on how long a panel login (token/cookie) is reused before logging in again
+PANEL_AUTH_TTL_SECONDS = max(0, _safe_int(os.getenv("PANEL_AUTH_TTL_SECONDS", "1800"), 1800))
+# Daily expiration check: panels queried at once, and how long one panel may take
+EXPIRY_PANEL_CONCURRENCY = max(1, _safe_int(os.getenv("EXPIRY_PANEL_CONCURRENCY", "4"), 4))
+EXPIRY_PANEL_TIMEOUT_SECONDS = max(1, _safe_int(os.getenv("EXPIRY_PANEL_TIMEOUT_SECONDS", "120"), 120))
+# Outgoing Telegram messages per second across all chats (send_scheduler.py; Telegram's limit is ~30)
+TG_SEND_RATE = max(1, _safe_int(os.getenv("TG_SEND_RATE", "25"), 25))
+TG_SEND_MAX_RETRIES = max(0, _safe_int(os.getenv("TG_SEND_MAX_RETRIES", "3"), 3))
+# Re-probe users marked unreachable (blocked the bot) after this many days; 0 disables it
+UNREACHABLE_REPROBE_DAYS = max(0, _safe_int(os.getenv("UNREACHABLE_REPROBE_DAYS", "0"), 0))
+# Force-join gate (helpers/membership.py): how long channel membership answers are reused for
+# members and non-members, and how long the channel's own info is kept
+CHANNEL_MEMBER_TTL_SECONDS = max(0, _safe_int(os.getenv("CHANNEL_MEMBER_TTL_SECONDS", "600"), 600))
+CHANNEL_NONMEMBER_TTL_SECONDS = max(0, _safe_int(os.getenv("CHANNEL_NONMEMBER_TTL_SECONDS", "30"), 30))
+CHANNEL_INFO_TTL_SECONDS = max(0, _safe_int(os.getenv("CHANNEL_INFO_TTL_SECONDS", "21600"), 21600))
+# Updates handled at once across users (update_processor.py); each user's updates run in
+# order, one at a time. Admins get extra reserved slots on top.
+UPDATE_CONCURRENCY = max(1, _safe_int(os.getenv("UPDATE_CONCURRENCY", "64"), 64))
+ADMIN_UPDATE_SLOTS = max(0, _safe_int(os.getenv("ADMIN_UPDATE_SLOTS", "4"), 4))
+# How often changed user_data / conversation states are written to the DB (persistence.py)
+PERSISTENCE_UPDATE_SECONDS = max(1, _safe_int(os.getenv("PERSISTENCE_UPDATE_SECONDS", "10"), 10))
+# Background provisioning of approved orders (provisioning.py): jobs run at once overall and
+# per panel, attempts per job, and the first retry delay (doubled on each further attempt)
+PROVISIONING_WORKERS = max(1, _safe_int(os.getenv("PROVISIONING_WORKERS", "8"), 8))
+PROVISIONING_PANEL_CONCURRENCY = max(1, _safe_int(os.getenv("PROVISIONING_PANEL_CONCURRENCY", "2"), 2))
+PROVISIONING_MAX_ATTEMPTS = max(1, _safe_int(os.getenv("PROVISIONING_MAX_ATTEMPTS", "4"), 4))
+PROVISIONING_RETRY_SECONDS = max(1, _safe_int(os.getenv("PROVISIONING_RETRY_SECONDS", "15"), 15))
+# Warm account pools (account_pool.py): how often pools are topped up, and how many clients
+# one top-up may create per inbound
+ACCOUNT_POOL_REFILL_SECONDS = max(10, _safe_int(os.getenv("ACCOUNT_POOL_REFILL_SECONDS", "120"), 120))
+ACCOUNT_POOL_REFILL_BATCH = max(1, _safe_int(os.getenv("ACCOUNT_POOL_REFILL_BATCH", "5"), 5))
+# How often the audience sizes shown in the broadcast menus are recounted (broadcast.py)
+BROADCAST_COUNTS_REFRESH_SECONDS = max(10, _safe_int(os.getenv("BROADCAST_COUNTS_REFRESH_SECONDS", "120"), 120))
 NOBITEX_TOKEN = os.getenv("NOBITEX_TOKEN", "")
 
 # Job schedule hour for daily tasks
@@ -1,36 +1,419 @@
+import asyncio
+import functools
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from .config import DB_NAME, logger
+from .config import DB_NAME, DB_BUSY_TIMEOUT_MS, DB_CACHE_SIZE_KB, DB_MMAP_SIZE, DB_READ_WORKERS, logger
+
+
+# --- Connection pool ---
+# One long-lived connection per thread (the event loop thread plus any executor threads).
+# Opening/closing a connection per call was the main cost of query_db/execute_db and
+# WAL mode lets readers proceed while a writer holds the lock.
+_local = threading.local()
+_all_connections: list[sqlite3.Connection] = []
+_pool_lock = threading.Lock()
+
+
+def _configure_connection(conn: sqlite3.Connection) -> None:
+    conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+    cur.execute(f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT_MS)}")
+    try:
+        cur.execute("PRAGMA journal_mode = WAL")
+    except sqlite3.Error as e:
+        # e.g. network filesystems; fall back to the default rollback journal
+        logger.warning(f"Could not enable WAL journal mode: {e}")
+    cur.execute("PRAGMA synchronous = NORMAL")
+    cur.execute(f"PRAGMA cache_size = {-abs(int(DB_CACHE_SIZE_KB))}")
+    cur.execute(f"PRAGMA mmap_size = {max(0, int(DB_MMAP_SIZE))}")
+    cur.execute("PRAGMA temp_store = MEMORY")
+    cur.close()
+
+
+def get_connection() -> sqlite3.Connection:
+    """Return this thread's pooled connection, opening it on first use."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and getattr(_local, 'db_name', None) == DB_NAME:
+        return conn
+    conn = sqlite3.connect(DB_NAME, timeout=DB_BUSY_TIMEOUT_MS / 1000.0, check_same_thread=False)
+    _configure_connection(conn)
+    _local.conn = conn
+    _local.db_name = DB_NAME
+    with _pool_lock:
+        _all_connections.append(conn)
+    return conn
+
+
+def close_all_connections() -> None:
+    with _pool_lock:
+        conns = list(_all_connections)
+        _all_connections.clear()
+    for conn in conns:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+    _local.__dict__.clear()
+
+
+def checkpoint_wal() -> None:
+    """Fold the WAL back into the main DB file (call before copying the file on disk)."""
+    try:
+        get_connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    except sqlite3.Error as e:
+        logger.error(f"DB checkpoint error: {e}")
+
+
+def _rollback_quietly(conn: sqlite3.Connection) -> None:
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+    except sqlite3.Error:
+        pass
 
 
 def query_db(query: str, args=(), one: bool = False):
+    conn = None
     try:
-        with sqlite3.connect(DB_NAME, check_same_thread=False) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute(query, args)
-            rows = cursor.fetchall()
-            if one:
-                return dict(rows[0]) if rows else None
-            return [dict(row) for row in rows]
+        conn = get_connection()
+        cursor = conn.execute(query, args)
+        rows = cursor.fetchall()
+        # Some call sites issue writes through query_db; keep their old autocommit behaviour
+        if conn.in_transaction:
+            conn.commit()
+        if one:
+            return dict(rows[0]) if rows else None
+        return [dict(row) for row in rows]
     except sqlite3.Error as e:
         logger.error(f"DB query error: {e}")
+        if conn is not None:
+            _rollback_quietly(conn)
         return None if one else []
 
 
 def execute_db(query: str, args=()):
+    conn = None
     try:
-        with sqlite3.connect(DB_NAME, check_same_thread=False) as conn:
-            cursor = conn.cursor()
-            cursor.execute(query, args)
-            conn.commit()
-            return cursor.lastrowid
+        conn = get_connection()
+        cursor = conn.execute(query, args)
+        conn.commit()
+        return cursor.lastrowid
     except sqlite3.Error as e:
         logger.error(f"DB execute error: {e}")
+        if conn is not None:
+            _rollback_quietly(conn)
         return None
 
 
-def initialize_default_content(cursor: sqlite3.Cursor, conn: sqlite3.Connection):
+# --- Async API ---
+# Handlers run on the event loop; these twins push the sqlite call onto DB threads so a
+# slow disk write never stalls other users' updates. All writes share one thread (SQLite
+# allows a single writer anyway), reads fan out over a few threads thanks to WAL.
+_read_executor = ThreadPoolExecutor(max_workers=DB_READ_WORKERS, thread_name_prefix='db-read')
+_write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-write')
+
+_READ_PREFIXES = ('SELECT', 'WITH', 'PRAGMA', 'EXPLAIN')
+
+
+def _is_read_only(query: str) -> bool:
+    return query.lstrip().upper().startswith(_READ_PREFIXES)
+
+
+async def aquery_db(query: str, args=(), one: bool = False):
+    executor = _read_executor if _is_read_only(query) else _write_executor
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(query_db, query, args, one))
+
+
+async def aexecute_db(query: str, args=()):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_write_executor, functools.partial(execute_db, query, args))
+
+
+def run_transaction(fn, *args):
+    """Run `fn(conn, *args)` inside BEGIN IMMEDIATE; commit on success, roll back and re-raise on error."""
+    conn = get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        result = fn(conn, *args)
+        conn.commit()
+        return result
+    except Exception:
+        _rollback_quietly(conn)
+        raise
+
+
+async def arun_transaction(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_write_executor, functools.partial(run_transaction, fn, *args))
+
+
+# --- Schema migrations ---
+# The applied version lives in `schema_version`. Each migration is numbered, idempotent
+# (safe on databases created by the old ad-hoc setup code) and all pending ones run in a
+# single transaction. When the DB is already current, startup does one SELECT and returns.
+
+def _table_columns(cursor: sqlite3.Cursor, table: str) -> set[str]:
+    cursor.execute(f"PRAGMA table_info({table})")
+    return {col[1] for col in cursor.fetchall()}
+
+
+def _ensure_columns(cursor: sqlite3.Cursor, table: str, columns: list[tuple[str, str]]) -> None:
+    existing = _table_columns(cursor, table)
+    for name, decl in columns:
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+
+def _migration_1_base_schema(cursor: sqlite3.Cursor) -> None:
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, first_name TEXT, join_date TEXT, referrer_id INTEGER)"
+    )
+    _ensure_columns(cursor, 'users', [('referrer_id', 'INTEGER')])
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS referrals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            referrer_id INTEGER NOT NULL,
+            referee_id INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            UNIQUE(referrer_id, referee_id)
+        )
+        """
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS messages (message_name TEXT PRIMARY KEY, text TEXT, file_id TEXT, file_type TEXT)"
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS buttons (id INTEGER PRIMARY KEY AUTOINCREMENT, menu_name TEXT, text TEXT, target TEXT, is_url BOOLEAN DEFAULT 0, row INTEGER, col INTEGER)"
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)"
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS plans (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, description TEXT, price INTEGER NOT NULL, duration_days INTEGER NOT NULL, traffic_gb REAL NOT NULL)"
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS cards (id INTEGER PRIMARY KEY AUTOINCREMENT, card_number TEXT NOT NULL, holder_name TEXT NOT NULL)"
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS free_trials (user_id INTEGER PRIMARY KEY, timestamp TEXT)"
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS discount_codes (id INTEGER PRIMARY KEY AUTOINCREMENT, code TEXT UNIQUE NOT NULL, percentage INTEGER NOT NULL, usage_limit INTEGER NOT NULL, times_used INTEGER DEFAULT 0, expiry_date TEXT)"
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS panels (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL, panel_type TEXT NOT NULL DEFAULT 'marzban', url TEXT NOT NULL, username TEXT NOT NULL, password TEXT NOT NULL, sub_base TEXT, token TEXT)"
+    )
+    if 'panel_type' not in _table_columns(cursor, 'panels'):
+        cursor.execute("ALTER TABLE panels ADD COLUMN panel_type TEXT NOT NULL DEFAULT 'marzban'")
+        cursor.execute("UPDATE panels SET panel_type = 'marzban' WHERE panel_type IS NULL")
+    _ensure_columns(cursor, 'panels', [('sub_base', 'TEXT'), ('token', 'TEXT')])
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_services (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            panel_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            panel_username TEXT NOT NULL,
+            panel_password TEXT,
+            connection_info TEXT,
+            traffic_limit INTEGER,
+            created_at TEXT NOT NULL,
+            expire_at TEXT,
+            multi_user INTEGER DEFAULT 1,
+            FOREIGN KEY (panel_id) REFERENCES panels(id)
+        )
+        """
+    )
+    _ensure_columns(cursor, 'user_services', [('connection_info', 'TEXT')])
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS panel_inbounds (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            panel_id INTEGER NOT NULL,
+            protocol TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            inbound_id INTEGER,
+            UNIQUE(panel_id, tag),
+            FOREIGN KEY (panel_id) REFERENCES panels(id) ON DELETE CASCADE
+        )
+        """
+    )
+    _ensure_columns(cursor, 'panel_inbounds', [('inbound_id', 'INTEGER')])
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, plan_id INTEGER NOT NULL,
+            status TEXT DEFAULT 'pending', marzban_username TEXT, screenshot_file_id TEXT, timestamp TEXT,
+            panel_id INTEGER, discount_code TEXT, final_price INTEGER, last_reminder_date TEXT, panel_type TEXT,
+            last_link TEXT, xui_inbound_id INTEGER, xui_client_id TEXT, reseller_applied INTEGER DEFAULT 0,
+            is_trial INTEGER DEFAULT 0
+        )
+        """
+    )
+    _ensure_columns(cursor, 'orders', [
+        ('panel_id', 'INTEGER'),
+        ('discount_code', 'TEXT'),
+        ('final_price', 'INTEGER'),
+        ('last_reminder_date', 'TEXT'),
+        ('panel_type', 'TEXT'),
+        ('last_link', 'TEXT'),
+        ('xui_inbound_id', 'INTEGER'),
+        ('xui_client_id', 'TEXT'),
+        ('reseller_applied', 'INTEGER DEFAULT 0'),
+        ('is_trial', 'INTEGER DEFAULT 0'),
+    ])
+    # Wallets and wallet_transactions
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS wallets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            asset TEXT NOT NULL,
+            chain TEXT NOT NULL,
+            address TEXT NOT NULL,
+            memo TEXT
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_wallets (
+            user_id INTEGER PRIMARY KEY,
+            balance INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS wallet_transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            direction TEXT NOT NULL, -- credit/debit
+            method TEXT NOT NULL,    -- gateway/crypto/card/manual
+            status TEXT NOT NULL DEFAULT 'pending', -- pending/approved/rejected
+            created_at TEXT NOT NULL,
+            screenshot_file_id TEXT,
+            reference TEXT,
+            meta TEXT
+        )
+        """
+    )
+    # Reseller tables
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS resellers (
+            user_id INTEGER PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'active',
+            activated_at TEXT NOT NULL,
+            expires_at TEXT NOT NULL,
+            discount_percent INTEGER NOT NULL,
+            max_purchases INTEGER NOT NULL,
+            used_purchases INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS reseller_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            method TEXT NOT NULL, -- card/crypto/gateway
+            status TEXT NOT NULL DEFAULT 'pending', -- pending/approved/rejected
+            created_at TEXT NOT NULL,
+            screenshot_file_id TEXT,
+            reference TEXT,
+            meta TEXT
+        )
+        """
+    )
+    # Tickets and threaded ticket messages
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tickets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            content_type TEXT,
+            text TEXT,
+            file_id TEXT,
+            created_at TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending'
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ticket_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ticket_id INTEGER NOT NULL,
+            sender TEXT NOT NULL, -- 'user' | 'admin'
+            content_type TEXT,
+            text TEXT,
+            file_id TEXT,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY (ticket_id) REFERENCES tickets(id) ON DELETE CASCADE
+        )
+        """
+    )
+    # Tutorials
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tutorials (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            sort_order INTEGER DEFAULT 0,
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tutorial_media (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tutorial_id INTEGER NOT NULL,
+            content_type TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            caption TEXT,
+            sort_order INTEGER DEFAULT 0,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY (tutorial_id) REFERENCES tutorials(id) ON DELETE CASCADE
+        )
+        """
+    )
+    # Admins table (additional admins besides primary ADMIN_ID)
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id INTEGER PRIMARY KEY
+        )
+        """
+    )
+
+
+def _migration_2_indexes(cursor: sqlite3.Cursor) -> None:
+    # Secondary indexes for the hot lookup paths (handlers, jobs, stats)
+    for ddl in (
+        "CREATE INDEX IF NOT EXISTS idx_orders_user_status ON orders(user_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_marzban_username ON orders(marzban_username)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_status_timestamp ON orders(status, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_wallet_tx_status ON wallet_transactions(status)",
+        "CREATE INDEX IF NOT EXISTS idx_wallet_tx_reference ON wallet_transactions(reference)",
+        "CREATE INDEX IF NOT EXISTS idx_tickets_status ON tickets(status)",
+        "CREATE INDEX IF NOT EXISTS idx_tickets_user ON tickets(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_ticket_messages_ticket ON ticket_messages(ticket_id)",
+        "CREATE INDEX IF NOT EXISTS idx_referrals_referee ON referrals(referee_id)",
+        "CREATE INDEX IF NOT EXISTS idx_buttons_menu ON buttons(menu_name, row, col)",
+        "CREATE INDEX IF NOT EXISTS idx_user_services_panel_username ON user_services(panel_id, panel_username)",
+        "CREATE INDEX IF NOT EXISTS idx_tutorial_media_tutorial ON tutorial_media(tutorial_id, sort_order)",
+    ):
+        cursor.execute(ddl)
+
+
+def initialize_default_content(cursor: sqlite3.Cursor) -> None:
     default_messages = {
         'start_main': ('\U0001F44B سلام! به ربات فروش کانفیگ ما خوش آمدید.\nبرای شروع از دکمه‌های زیر استفاده کنید.', None, None),
         'admin_panel_main': ('\U0001F5A5\uFE0F پنل مدیریت ربات. لطفا یک گزینه را انتخاب کنید.', None, None),
@@ -38,51 +421,47 @@ def initialize_default_content(cursor: sqlite3.Cursor, conn: sqlite3.Connection)
         'payment_info_text': ('\U0001F4B3 **اطلاعات پرداخت** \U0001F4B3\n\nمبلغ پلن انتخابی را به یکی از کارت‌های زیر واریز کرده و سپس اسکرین‌شات رسید را در همین صفحه ارسال نمایید.', None, None),
         'renewal_reminder_text': ('\u26A0\uFE0F **یادآوری تمدید سرویس**\n\nکاربر گرامی، اعتبار سرویس شما با نام کاربری `{marzban_username}` رو به اتمام است.\n\n{details}\n\nبرای جلوگیری از قطع شدن سرویس، لطفاً از طریق دکمه "سرویس من" در منوی اصلی ربات اقدام به تمدید نمایید.', None, None)
     }
+    cursor.executemany(
+        "INSERT OR IGNORE INTO messages (message_name, text, file_id, file_type) VALUES (?, ?, ?, ?)",
+        [(name, text, f_id, f_type) for name, (text, f_id, f_type) in default_messages.items()],
+    )
 
-    for name, (text, f_id, f_type) in default_messages.items():
+    # Move legacy single-panel settings into the panels table
+    cursor.execute("SELECT 1 FROM panels LIMIT 1")
+    if not cursor.fetchone():
+        cursor.execute("SELECT key, value FROM settings WHERE key IN ('panel_url', 'panel_user', 'panel_pass')")
+        legacy = {row[0]: row[1] for row in cursor.fetchall()}
         cursor.execute(
-            "INSERT OR IGNORE INTO messages (message_name, text, file_id, file_type) VALUES (?, ?, ?, ?)",
-            (name, text, f_id, f_type),
-        )
-
-    conn.commit()
-
-    from .db import query_db as _query_db, execute_db as _execute_db
-
-    if not _query_db("SELECT 1 FROM panels", one=True):
-        url_row = _query_db("SELECT value FROM settings WHERE key = 'panel_url'", one=True)
-        user_row = _query_db("SELECT value FROM settings WHERE key = 'panel_user'", one=True)
-        password_row = _query_db("SELECT value FROM settings WHERE key = 'panel_pass'", one=True)
-
-        url = url_row.get('value') if url_row else 'https://your-panel.com'
-        user = user_row.get('value') if user_row else 'admin'
-        password = password_row.get('value') if password_row else 'password'
-
-        _execute_db(
             "INSERT INTO panels (name, panel_type, url, username, password, sub_base) VALUES (?, ?, ?, ?, ?, ?)",
-            ('پنل اصلی (پیش‌فرض)', 'marzban', url, user, password, None),
+            (
+                'پنل اصلی (پیش‌فرض)',
+                'marzban',
+                legacy.get('panel_url') or 'https://your-panel.com',
+                legacy.get('panel_user') or 'admin',
+                legacy.get('panel_pass') or 'password',
+                None,
+            ),
         )
-        _execute_db("DELETE FROM settings WHERE key IN ('panel_url', 'panel_user', 'panel_pass')")
-
-    default_settings = {'free_trial_days': '1', 'free_trial_gb': '0.2', 'free_trial_status': '1'}
-    for key, value in default_settings.items():
-        _execute_db("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", (key, value))
+        cursor.execute("DELETE FROM settings WHERE key IN ('panel_url', 'panel_user', 'panel_pass')")
 
     # Insert default cards
-    if not _query_db("SELECT 1 FROM cards", one=True):
-        _execute_db(
+    cursor.execute("SELECT 1 FROM cards LIMIT 1")
+    if not cursor.fetchone():
+        cursor.execute(
             "INSERT INTO cards (card_number, holder_name) VALUES (?, ?)",
             ("6037-0000-0000-0000", "نام دارنده کارت"),
         )
 
-    # Ensure USD rate related settings exist
-    _execute_db("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ('usd_irt_manual', ''))
-    _execute_db("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ('usd_irt_cached', ''))
-    _execute_db("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ('usd_irt_cached_ts', ''))
-    _execute_db("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ('usd_irt_mode', 'manual'))
-
-    # Payment method toggles and gateway config
     defaults = [
+        ('free_trial_days', '1'),
+        ('free_trial_gb', '0.2'),
+        ('free_trial_status', '1'),
+        # USD rate related settings
+        ('usd_irt_manual', ''),
+        ('usd_irt_cached', ''),
+        ('usd_irt_cached_ts', ''),
+        ('usd_irt_mode', 'manual'),
+        # Payment method toggles and gateway config
         ('pay_card_enabled', '1'),
         ('pay_crypto_enabled', '1'),
         ('pay_gateway_enabled', '0'),
@@ -107,317 +486,211 @@ def initialize_default_content(cursor: sqlite3.Cursor, conn: sqlite3.Connection)
         ('reseller_duration_days', '30'),
         ('reseller_max_purchases', '10'),
     ]
-    for k, v in defaults:
-        _execute_db("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", (k, v))
+    cursor.executemany("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", defaults)
 
 
-def db_setup():
-    with sqlite3.connect(DB_NAME, check_same_thread=False) as conn:
-        cursor = conn.cursor()
-        # --- Create Tables ---
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, first_name TEXT, join_date TEXT)"
-        )
-        # Referrals
-        cursor.execute("PRAGMA table_info(users)")
-        ucols = [col[1] for col in cursor.fetchall()]
-        if 'referrer_id' not in ucols:
-            try:
-                cursor.execute("ALTER TABLE users ADD COLUMN referrer_id INTEGER")
-            except sqlite3.Error:
-                pass
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS referrals (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                referrer_id INTEGER NOT NULL,
-                referee_id INTEGER NOT NULL,
-                created_at TEXT NOT NULL,
-                UNIQUE(referrer_id, referee_id)
-            )
-            """
-        )
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS messages (message_name TEXT PRIMARY KEY, text TEXT, file_id TEXT, file_type TEXT)"
-        )
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS buttons (id INTEGER PRIMARY KEY AUTOINCREMENT, menu_name TEXT, text TEXT, target TEXT, is_url BOOLEAN DEFAULT 0, row INTEGER, col INTEGER)"
-        )
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)"
-        )
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS plans (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, description TEXT, price INTEGER NOT NULL, duration_days INTEGER NOT NULL, traffic_gb REAL NOT NULL)"
-        )
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS cards (id INTEGER PRIMARY KEY AUTOINCREMENT, card_number TEXT NOT NULL, holder_name TEXT NOT NULL)"
-        )
+def _migration_4_settings_version(cursor: sqlite3.Cursor) -> None:
+    # Monotonic counter bumped by any write to `settings`; lets every process's
+    # settings cache (settings.py) notice changes made elsewhere.
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS settings_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)"
+    )
+    cursor.execute("INSERT OR IGNORE INTO settings_version (id, version) VALUES (1, 0)")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
         cursor.execute(
-            "CREATE TABLE IF NOT EXISTS free_trials (user_id INTEGER PRIMARY KEY, timestamp TEXT)"
-        )
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS discount_codes (id INTEGER PRIMARY KEY AUTOINCREMENT, code TEXT UNIQUE NOT NULL, percentage INTEGER NOT NULL, usage_limit INTEGER NOT NULL, times_used INTEGER DEFAULT 0, expiry_date TEXT)"
-        )
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS panels (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL, panel_type TEXT NOT NULL DEFAULT 'marzban', url TEXT NOT NULL, username TEXT NOT NULL, password TEXT NOT NULL, sub_base TEXT, token TEXT)"
-        )
-        # Migrations for existing tables
-        cursor.execute("PRAGMA table_info(panels)")
-        columns = [col[1] for col in cursor.fetchall()]
-        if 'panel_type' not in columns:
-            try:
-                cursor.execute("ALTER TABLE panels ADD COLUMN panel_type TEXT NOT NULL DEFAULT 'marzban'")
-                cursor.execute("UPDATE panels SET panel_type = 'marzban' WHERE panel_type IS NULL")
-            except sqlite3.Error as e:
-                logger.error(f"Error adding panel_type to panels: {e}")
-        cursor.execute("PRAGMA table_info(panels)")
-        columns = [col[1] for col in cursor.fetchall()]
-        if 'sub_base' not in columns:
-            try:
-                cursor.execute("ALTER TABLE panels ADD COLUMN sub_base TEXT")
-            except sqlite3.Error as e:
-                logger.error(f"Error adding sub_base to panels: {e}")
-        cursor.execute("PRAGMA table_info(panels)")
-        columns = [col[1] for col in cursor.fetchall()]
-        if 'token' not in columns:
-            try:
-                cursor.execute("ALTER TABLE panels ADD COLUMN token TEXT")
-            except sqlite3.Error as e:
-                logger.error(f"Error adding token to panels: {e}")
-        # Migrations for panel_inbounds
-        cursor.execute("PRAGMA table_info(panel_inbounds)")
-        columns = [col[1] for col in cursor.fetchall()]
-        if 'inbound_id' not in columns:
-            try:
-                cursor.execute("ALTER TABLE panel_inbounds ADD COLUMN inbound_id INTEGER")
-            except sqlite3.Error as e:
-                logger.error(f"Error adding inbound_id to panel_inbounds: {e}")
-
-        # --- NEW: Table for manually setting inbounds for each panel ---
-        # --- NEW: Table for user services to track service information ---
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS user_services (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                panel_id INTEGER NOT NULL,
-                user_id INTEGER NOT NULL,
-                panel_username TEXT NOT NULL,
-                panel_password TEXT,
-                connection_info TEXT,
-                traffic_limit INTEGER,
-                created_at TEXT NOT NULL,
-                expire_at TEXT,
-                multi_user INTEGER DEFAULT 1,
-                FOREIGN KEY (panel_id) REFERENCES panels(id)
-            )
-            """
-        )
-        
-        # Check if connection_info column exists in user_services table
-        cursor.execute("PRAGMA table_info(user_services)")
-        columns = [col[1] for col in cursor.fetchall()]
-        if 'connection_info' not in columns:
-            try:
-                cursor.execute("ALTER TABLE user_services ADD COLUMN connection_info TEXT")
-                logger.info("Added connection_info column to user_services table")
-            except sqlite3.Error as e:
-                logger.error(f"Error adding connection_info column: {e}")
-        
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS panel_inbounds (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                panel_id INTEGER NOT NULL,
-                protocol TEXT NOT NULL,
-                tag TEXT NOT NULL,
-                inbound_id INTEGER,
-                UNIQUE(panel_id, tag),
-                FOREIGN KEY (panel_id) REFERENCES panels(id) ON DELETE CASCADE
-            )
-            """
+            f"CREATE TRIGGER IF NOT EXISTS trg_settings_version_{event.lower()} AFTER {event} ON settings "
+            f"BEGIN UPDATE settings_version SET version = version + 1 WHERE id = 1; END"
         )
 
-        # Orders table with conditional add columns
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='orders'")
-        if cursor.fetchone():
-            cursor.execute("PRAGMA table_info(orders)")
-            columns = [col[1] for col in cursor.fetchall()]
-            if 'panel_id' not in columns:
-                cursor.execute("ALTER TABLE orders ADD COLUMN panel_id INTEGER")
-            if 'discount_code' not in columns:
-                cursor.execute("ALTER TABLE orders ADD COLUMN discount_code TEXT")
-            if 'final_price' not in columns:
-                cursor.execute("ALTER TABLE orders ADD COLUMN final_price INTEGER")
-            if 'last_reminder_date' not in columns:
-                cursor.execute("ALTER TABLE orders ADD COLUMN last_reminder_date TEXT")
-            if 'panel_type' not in columns:
-                cursor.execute("ALTER TABLE orders ADD COLUMN panel_type TEXT")
-            if 'last_link' not in columns:
-                try:
-                    cursor.execute("ALTER TABLE orders ADD COLUMN last_link TEXT")
-                except sqlite3.Error:
-                    pass
-            if 'xui_inbound_id' not in columns:
-                try:
-                    cursor.execute("ALTER TABLE orders ADD COLUMN xui_inbound_id INTEGER")
-                except sqlite3.Error:
-                    pass
-            if 'xui_client_id' not in columns:
-                try:
-                    cursor.execute("ALTER TABLE orders ADD COLUMN xui_client_id TEXT")
-                except sqlite3.Error:
-                    pass
-            if 'is_trial' not in columns:
-                try:
-                    cursor.execute("ALTER TABLE orders ADD COLUMN is_trial INTEGER DEFAULT 0")
-                except sqlite3.Error:
-                    pass
-        else:
-            cursor.execute(
-                """
-                CREATE TABLE orders (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, plan_id INTEGER NOT NULL,
-                    status TEXT DEFAULT 'pending', marzban_username TEXT, screenshot_file_id TEXT, timestamp TEXT,
-                    panel_id INTEGER, discount_code TEXT, final_price INTEGER, last_reminder_date TEXT, panel_type TEXT,
-                    last_link TEXT, xui_inbound_id INTEGER, xui_client_id TEXT, reseller_applied INTEGER DEFAULT 0,
-                    is_trial INTEGER DEFAULT 0
-                )
-                """
-            )
-        # NEW: wallets and wallet_transactions
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS wallets (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                asset TEXT NOT NULL,
-                chain TEXT NOT NULL,
-                address TEXT NOT NULL,
-                memo TEXT
-            )
-            """
-        )
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS user_wallets (
-                user_id INTEGER PRIMARY KEY,
-                balance INTEGER NOT NULL DEFAULT 0
-            )
-            """
-        )
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS wallet_transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                amount INTEGER NOT NULL,
-                direction TEXT NOT NULL, -- credit/debit
-                method TEXT NOT NULL,    -- gateway/crypto/card/manual
-                status TEXT NOT NULL DEFAULT 'pending', -- pending/approved/rejected
-                created_at TEXT NOT NULL,
-                screenshot_file_id TEXT,
-                reference TEXT,
-                meta TEXT
-            )
-            """
-        )
-        # Reseller tables
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS resellers (
-                user_id INTEGER PRIMARY KEY,
-                status TEXT NOT NULL DEFAULT 'active',
-                activated_at TEXT NOT NULL,
-                expires_at TEXT NOT NULL,
-                discount_percent INTEGER NOT NULL,
-                max_purchases INTEGER NOT NULL,
-                used_purchases INTEGER NOT NULL DEFAULT 0
-            )
-            """
-        )
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS reseller_requests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                amount INTEGER NOT NULL,
-                method TEXT NOT NULL, -- card/crypto/gateway
-                status TEXT NOT NULL DEFAULT 'pending', -- pending/approved/rejected
-                created_at TEXT NOT NULL,
-                screenshot_file_id TEXT,
-                reference TEXT,
-                meta TEXT
-            )
-            """
-        )
-        # Migration: add reseller_applied if missing
-        cursor.execute("PRAGMA table_info(orders)")
-        ocols = [col[1] for col in cursor.fetchall()]
-        if 'reseller_applied' not in ocols:
-            try:
-                cursor.execute("ALTER TABLE orders ADD COLUMN reseller_applied INTEGER DEFAULT 0")
-            except sqlite3.Error:
-                pass
-        # Tickets table
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS tickets (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                content_type TEXT,
-                text TEXT,
-                file_id TEXT,
-                created_at TEXT NOT NULL,
-                status TEXT NOT NULL DEFAULT 'pending'
-            )
-            """
-        )
-        # Threaded ticket messages (new)
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS ticket_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                ticket_id INTEGER NOT NULL,
-                sender TEXT NOT NULL, -- 'user' | 'admin'
-                content_type TEXT,
-                text TEXT,
-                file_id TEXT,
-                created_at TEXT NOT NULL,
-                FOREIGN KEY (ticket_id) REFERENCES tickets(id) ON DELETE CASCADE
-            )
-            """
-        )
-        # Tutorials
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS tutorials (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT NOT NULL,
-                sort_order INTEGER DEFAULT 0,
-                created_at TEXT NOT NULL
-            )
-            """
+
+def _migration_5_panel_api_prefix(cursor: sqlite3.Cursor) -> None:
+    # X-UI family: the API path prefix a panel answered on last (see panel.py _remember_endpoint)
+    _ensure_columns(cursor, 'panels', [('api_prefix', 'TEXT')])
+
+
+def _migration_6_broadcasts(cursor: sqlite3.Cursor) -> None:
+    # Broadcast jobs (broadcast.py). `cursor` is the last recipient user_id claimed; a
+    # delivery row is written before each send so a restart never messages anyone twice.
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            audience TEXT NOT NULL,
+            mode TEXT NOT NULL DEFAULT 'copy',
+            from_chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            cursor INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            progress_chat_id INTEGER,
+            progress_message_id INTEGER,
+            created_at TEXT,
+            finished_at TEXT
         )
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS tutorial_media (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                tutorial_id INTEGER NOT NULL,
-                content_type TEXT NOT NULL,
-                file_id TEXT NOT NULL,
-                caption TEXT,
-                sort_order INTEGER DEFAULT 0,
-                created_at TEXT NOT NULL,
-                FOREIGN KEY (tutorial_id) REFERENCES tutorials(id) ON DELETE CASCADE
-            )
-            """
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            error TEXT,
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+        """
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status)")
+
+
+def _migration_7_user_reachability(cursor: sqlite3.Cursor) -> None:
+    # reachable = 0 once Telegram says the user blocked the bot / the chat is gone (reachability.py)
+    _ensure_columns(cursor, 'users', [('reachable', 'INTEGER NOT NULL DEFAULT 1'), ('unreachable_at', 'TEXT')])
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_unreachable ON users(user_id) WHERE reachable = 0")
+    _ensure_columns(cursor, 'broadcasts', [('skipped', 'INTEGER NOT NULL DEFAULT 0')])
+
+
+def _migration_8_broadcast_segments(cursor: sqlite3.Cursor) -> None:
+    # Broadcast segments (broadcast.py SEGMENTS): the segment's parameter, the panel-reported
+    # expiry of each service (refreshed by the daily expiration check) and indexes that keep
+    # segment counts and recipient scans off full-table paths
+    _ensure_columns(cursor, 'broadcasts', [('audience_value', 'INTEGER')])
+    _ensure_columns(cursor, 'orders', [('expire_at', 'INTEGER')])
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_expire ON orders(status, expire_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_panel_status_user ON orders(panel_id, status, user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_wallets_balance ON user_wallets(balance)")
+
+
+def _migration_9_persistence(cursor: sqlite3.Cursor) -> None:
+    # user_data and conversation states kept across restarts (persistence.py)
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS persisted_user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL)"
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS persisted_conversations (
+            name TEXT NOT NULL,
+            conv_key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            PRIMARY KEY (name, conv_key)
+        ) WITHOUT ROWID
+        """
+    )
+
+
+def _migration_10_provisioning_jobs(cursor: sqlite3.Cursor) -> None:
+    # Queued panel-user creation for approved orders (provisioning.py); next_attempt_at is epoch seconds
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS provisioning_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            panel_id INTEGER,
+            inbound_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            notice_chat_id INTEGER,
+            notice_message_id INTEGER,
+            notice_is_media INTEGER NOT NULL DEFAULT 0,
+            notice_text TEXT,
+            created_at TEXT,
+            finished_at TEXT
         )
-        # Admins table (additional admins besides primary ADMIN_ID)
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS admins (
-                user_id INTEGER PRIMARY KEY
-            )
-            """
+        """
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_provisioning_jobs_due ON provisioning_jobs(status, next_attempt_at)")
+    # At most one active job per order, so a double-tapped approval can't create two users
+    cursor.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_provisioning_jobs_active_order ON provisioning_jobs(order_id) "
+        "WHERE status IN ('queued', 'running')"
+    )
+
+def _migration_11_account_pool(cursor: sqlite3.Cursor) -> None:
+    # Pre-created X-UI clients per (panel, inbound) and the depth admins want kept (account_pool.py)
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS account_pool_targets (
+            panel_id INTEGER NOT NULL,
+            inbound_id INTEGER NOT NULL,
+            depth INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (panel_id, inbound_id)
+        ) WITHOUT ROWID
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS account_pool (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            panel_id INTEGER NOT NULL,
+            inbound_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            sub_link TEXT,
+            configs TEXT,
+            status TEXT NOT NULL DEFAULT 'ready',
+            created_at TEXT,
+            claimed_at TEXT
         )
+        """
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_account_pool_target ON account_pool(panel_id, inbound_id, status)")
+
+
+def _migration_12_provisioning_job_username(cursor: sqlite3.Cursor) -> None:
+    # Panel username a provisioning job creates, fixed before its first create request
+    _ensure_columns(cursor, 'provisioning_jobs', [('username', 'TEXT')])
+
+
+def _migration_13_order_connection_info(cursor: sqlite3.Cursor) -> None:
+    # Netico approvals store the connection string on the order; the column was never created
+    _ensure_columns(cursor, 'orders', [('connection_info', 'TEXT')])
+
+# (version, migration) pairs; append new ones, never renumber or edit applied ones
+MIGRATIONS = [
+    (1, _migration_1_base_schema),
+    (2, _migration_2_indexes),
+    (3, initialize_default_content),
+    (4, _migration_4_settings_version),
+    (5, _migration_5_panel_api_prefix),
+    (6, _migration_6_broadcasts),
+    (7, _migration_7_user_reachability),
+    (8, _migration_8_broadcast_segments),
+    (9, _migration_9_persistence),
+    (10, _migration_10_provisioning_jobs),
+    (11, _migration_11_account_pool),
+    (12, _migration_12_provisioning_job_username),
+    (13, _migration_13_order_connection_info),
+]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return int(row[0] or 0) if row else 0
+
+
+def db_setup():
+    conn = get_connection()
+    current = get_schema_version(conn)
+    pending = [(v, fn) for v, fn in MIGRATIONS if v > current]
+    if not pending:
+        logger.debug(f"DB schema is current (version {current})")
+        return
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        for version, migration in pending:
+            migration(cursor)
+            cursor.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
+            logger.info(f"Applied DB migration {version} ({migration.__name__})")
         conn.commit()
-        initialize_default_content(cursor, conn)
\ No newline at end of file
+    except Exception:
+        _rollback_quietly(conn)
+        raise
+    # Refresh planner statistics so new indexes are actually chosen
+    conn.execute("PRAGMA optimize")
@@ -7,11 +7,12 @@ import base64
 import requests
 import json as _json
 from urllib.parse import urlsplit, quote as _urlquote
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile, User
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
 from telegram.constants import ParseMode, ChatAction
 from telegram.error import TelegramError, Forbidden, BadRequest
 from telegram.ext import ContextTypes, ConversationHandler, ApplicationHandlerStop, MessageHandler
 from telegram.ext import filters
+from telegram.helpers import mention_html
 from html import escape as html_escape
 import re
 import time
@@ -19,11 +20,17 @@ from uuid import uuid4
 import random
 from ..config import ADMIN_ID, logger
 from ..db import query_db, execute_db
-from ..panel import VpnPanelAPI
+from ..admins import add_admin, extra_admin_ids, is_admin, remove_admin
+from ..settings import get_setting, get_settings, set_setting, set_settings
+from ..panel import VpnPanelAPI, drop_panel_client
+from ..panel_http import run_blocking
+from ..provisioning import cancel_provisioning, enqueue_provisioning, job_username, set_job_username
+from ..account_pool import claim_pool_account
 from ..utils import register_new_user
 from ..states import *
 from .renewal import process_renewal_for_order
-from ..helpers.tg import safe_edit_text as _safe_edit_text, safe_edit_caption as _safe_edit_caption
+from ..helpers.tg import safe_edit_text as _safe_edit_text, safe_edit_caption as _safe_edit_caption, notify_admins
+from ..helpers.keyboards import invalidate_menu_cache
 
 # Normalize Persian/Arabic digits to ASCII
 _DIGIT_MAP = str.maketrans({
@@ -50,10 +57,7 @@ def _md_escape(text: str) -> str:
     )
 
 def _is_admin(user_id: int) -> bool:
-    if int(user_id) == int(ADMIN_ID):
-        return True
-    row = query_db("SELECT 1 FROM admins WHERE user_id = ?", (user_id,), one=True)
-    return bool(row)
+    return is_admin(user_id)
 
 
 async def admin_set_trial_inbound_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -66,8 +70,8 @@ async def admin_set_trial_inbound_start(update: Update, context: ContextTypes.DE
         "اینباندی را انتخاب کنید تا کانفیگ‌های تست روی همان اینباند ساخته شوند."
     )
     # Choose panel first: use selected free_trial_panel_id or ask user to pick if not set
-    sel = query_db("SELECT value FROM settings WHERE key='free_trial_panel_id'", one=True)
-    panel_id = int((sel.get('value') or 0)) if sel and str(sel.get('value') or '').isdigit() else None
+    sel = str(get_setting('free_trial_panel_id') or '')
+    panel_id = int(sel) if sel.isdigit() else None
     if not panel_id:
         await _safe_edit_text(query.message, "ابتدا از گزینه 'انتخاب پنل ساخت تست' یک پنل انتخاب کنید.")
         return SETTINGS_MENU
@@ -80,7 +84,7 @@ async def admin_set_trial_inbound_start(update: Update, context: ContextTypes.DE
         await _safe_edit_text(query.message, "این تنظیم فقط برای پنل‌های XUI/3xUI/Alireza/TX-UI است.")
         return SETTINGS_MENU
     api = VpnPanelAPI(panel_id=panel_id)
-    inbounds, msg_err = getattr(api, 'list_inbounds', lambda: (None,'NA'))()
+    inbounds, msg_err = await run_blocking(getattr(api, 'list_inbounds', lambda: (None,'NA')))
     if not inbounds:
         await _safe_edit_text(query.message, f"لیست اینباندها دریافت نشد: {msg_err}")
         return SETTINGS_MENU
@@ -101,7 +105,7 @@ async def admin_set_trial_inbound_choose(update: Update, context: ContextTypes.D
         await query.answer("شناسه نامعتبر", show_alert=True)
         return SETTINGS_MENU
     # Persist setting
-    execute_db("INSERT OR REPLACE INTO settings (key, value) VALUES ('free_trial_inbound_id', ?)", (inbound_id,))
+    set_setting('free_trial_inbound_id', inbound_id)
     await query.answer("اینباند تست ذخیره شد", show_alert=True)
     return await admin_settings_manage(update, context)
 
@@ -376,89 +380,47 @@ async def admin_ask_panel_for_approval(update: Update, context: ContextTypes.DEF
     await query.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
 
 
-async def admin_approve_on_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer("در حال ساخت کانفیگ...")
-    *_, order_id, panel_id = query.data.split('_')
-    order_id, panel_id = int(order_id), int(panel_id)
+def _order_notice(message):
+    """(chat_id, message_id, is_media, html_text) of an order message, for enqueue_provisioning."""
+    is_media = bool(message.photo or message.video or message.document)
+    base_text = message.caption_html if is_media else (message.text_html or message.text or '')
+    return message.chat_id, message.message_id, is_media, base_text
 
-    order = query_db("SELECT * FROM orders WHERE id = ?", (order_id,), one=True)
-    plan = query_db("SELECT * FROM plans WHERE id = ?", (order['plan_id'],), one=True)
-    panel_row = query_db("SELECT * FROM panels WHERE id = ?", (panel_id,), one=True)
 
-    is_media = bool(query.message.photo or query.message.video or query.message.document)
-    base_text = query.message.caption_html if is_media else (query.message.text_html or query.message.text or '')
-    progress_text = base_text + "\n\n\u23F3 در حال ساخت کانفیگ..."
+async def _show_provisioning_queued(message, notice, job_id) -> None:
+    _, _, is_media, base_text = notice
+    if job_id:
+        new_text = base_text + "\n\n\u23F3 در صف ساخت کانفیگ؛ نتیجه همین‌جا اعلام می‌شود."
+    else:
+        new_text = base_text + "\n\n\u26A0\uFE0F این سفارش قبلاً تایید شده یا در حال ساخت است."
     if is_media:
-        await _safe_edit_caption(query.message, progress_text, parse_mode=ParseMode.HTML, reply_markup=None)
+        await _safe_edit_caption(message, new_text, parse_mode=ParseMode.HTML, reply_markup=None)
     else:
-        await _safe_edit_text(query.message, progress_text, parse_mode=ParseMode.HTML, reply_markup=None)
+        await _safe_edit_text(message, new_text, parse_mode=ParseMode.HTML, reply_markup=None)
 
-    # Branch based on panel type
-    ptype = (panel_row.get('panel_type') or 'marzban').lower()
-    api = VpnPanelAPI(panel_id=panel_id)
 
-    # اضافه کردن پشتیبانی از پنل Netico
-    if ptype == 'netico':
-        # استفاده از NeticoAPI برای ساخت کاربر
-        from ..panel import NeticoAPI
-        netico_api = NeticoAPI(panel_row)
-        
-        # ساخت کاربر در پنل Netico
-        username, password, connection_info = netico_api.create_user(
-            traffic_limit=plan.get('traffic_gb', 0),
-            days=plan.get('duration_days', 30),
-            user_id=order['user_id']
-        )
-        
-        if username and password and connection_info:
-            # به‌روزرسانی وضعیت سفارش در دیتابیس
-            execute_db(
-                "UPDATE orders SET status = 'approved', marzban_username = ?, panel_id = ?, panel_type = ?, connection_info = ? WHERE id = ?", 
-                (username, panel_id, 'netico', connection_info, order_id)
-            )
-            
-            if order.get('discount_code'):
-                execute_db("UPDATE discount_codes SET times_used = times_used + 1 WHERE code = ?", (order['discount_code'],))
-            
-            # اعمال پاداش معرف
-            await _apply_referral_bonus(order_id, context)
-            
-            # دریافت متن پاورقی کانفیگ
-            cfg = query_db("SELECT value FROM settings WHERE key = 'config_footer_text'", one=True)
-            footer = (cfg.get('value') if cfg else '') or ''
-            
-            # ساخت پیام نهایی برای کاربر
-            final_message = (
-                f"✅ سفارش شما تایید شد!\n\n"
-                f"<b>پلن:</b> {plan['name']}\n"
-                f"<b>اطلاعات اتصال:</b>\n<code>{connection_info}</code>\n\n" + footer
-            )
-            
-            try:
-                await context.bot.send_message(order['user_id'], final_message, parse_mode=ParseMode.HTML)
-                done_text = base_text + f"\n\n\u2705 **ارسال خودکار موفق بود.**"
-                if is_media:
-                    await _safe_edit_caption(query.message, done_text, parse_mode=ParseMode.HTML, reply_markup=None)
-                else:
-                    await _safe_edit_text(query.message, done_text, parse_mode=ParseMode.HTML, reply_markup=None)
-            except TelegramError as e:
-                err_text = base_text + f"\n\n\u26A0\uFE0F **خطا:** ارسال به کاربر ناموفق بود. {e}\nاطلاعات اتصال: <code>{connection_info}</code>"
-                if is_media:
-                    await _safe_edit_caption(query.message, err_text, parse_mode=ParseMode.HTML, reply_markup=None)
-                else:
-                    await _safe_edit_text(query.message, err_text, parse_mode=ParseMode.HTML, reply_markup=None)
+async def admin_approve_on_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    *_, order_id, panel_id = query.data.split('_')
+    order_id, panel_id = int(order_id), int(panel_id)
+
+    panel_row = query_db("SELECT * FROM panels WHERE id = ?", (panel_id,), one=True)
+    notice = _order_notice(query.message)
+    _, _, is_media, base_text = notice
+    if not panel_row:
+        err_text = base_text + "\n\n\u274C **خطا:** پنل یافت نشد."
+        if is_media:
+            await _safe_edit_caption(query.message, err_text, parse_mode=ParseMode.HTML, reply_markup=None)
         else:
-            fail_text = base_text + f"\n\n\u274C **خطای پنل Netico:** ساخت کاربر ناموفق بود."
-            if is_media:
-                await _safe_edit_caption(query.message, fail_text, parse_mode=ParseMode.HTML, reply_markup=None)
-            else:
-                await _safe_edit_text(query.message, fail_text, parse_mode=ParseMode.HTML, reply_markup=None)
+            await _safe_edit_text(query.message, err_text, parse_mode=ParseMode.HTML, reply_markup=None)
         return
-    
-    elif ptype in ('xui', 'x-ui', 'sanaei', 'alireza', '3xui', '3x-ui', 'txui', 'tx-ui', 'sui', 's-ui'):
-        # Step 1: show inbound list to admin
-        inbounds, msg = api.list_inbounds() if hasattr(api, 'list_inbounds') else (None, 'Not supported')
+
+    ptype = (panel_row.get('panel_type') or 'marzban').lower()
+    if ptype in ('xui', 'x-ui', 'sanaei', 'alireza', '3xui', '3x-ui', 'txui', 'tx-ui', 'sui', 's-ui'):
+        # Step 1: show inbound list to admin; the client is created once one is chosen
+        api = VpnPanelAPI(panel_id=panel_id)
+        inbounds, msg = await run_blocking(api.list_inbounds) if hasattr(api, 'list_inbounds') else (None, 'Not supported')
         if not inbounds:
             safe = html_escape(str(msg))
             err_text = base_text + f"\n\n<b>خطای پنل:</b>\n<code>{safe}</code>"
@@ -476,119 +438,189 @@ async def admin_approve_on_panel(update: Update, context: ContextTypes.DEFAULT_T
         await query.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(kb))
         return
 
-    # Default Marzban/Marzneshin flow: only send subscription link
-    marzban_username, config_link, message = await api.create_user(order['user_id'], plan)
-    if config_link and marzban_username:
-        execute_db("UPDATE orders SET status = 'approved', marzban_username = ?, panel_id = ?, panel_type = ? WHERE id = ?", (marzban_username, panel_id, (panel_row.get('panel_type') or 'marzban').lower(), order_id))
-        if order.get('discount_code'):
-            execute_db("UPDATE discount_codes SET times_used = times_used + 1 WHERE code = ?", (order['discount_code'],))
-        # Apply referral bonus
-        await _apply_referral_bonus(order_id, context)
-        cfg = query_db("SELECT value FROM settings WHERE key = 'config_footer_text'", one=True)
-        footer = (cfg.get('value') if cfg else '') or ''
-        # Always send ONLY subscription link for Marzban/Marzneshin
-        final_message = (
-            f"✅ سفارش شما تایید شد!\n\n"
-            f"<b>پلن:</b> {plan['name']}\n"
-            f"<b>لینک اشتراک شما:</b>\n<code>{config_link}</code>\n\n" + footer
+    job_id = await enqueue_provisioning(order_id, 'panel', panel_id=panel_id, notice=notice)
+    await _show_provisioning_queued(query.message, notice, job_id)
+
+
+async def provision_on_panel(context: ContextTypes.DEFAULT_TYPE, job: dict):
+    """Provisioning job (provisioning.py): create the order's user on a Marzban-style or Netico panel and send it."""
+    order_id, panel_id = job['order_id'], job['panel_id']
+    order = query_db("SELECT * FROM orders WHERE id = ?", (order_id,), one=True)
+    plan = query_db("SELECT * FROM plans WHERE id = ?", (order['plan_id'],), one=True) if order else None
+    panel_row = query_db("SELECT * FROM panels WHERE id = ?", (panel_id,), one=True)
+    if not order or not plan or not panel_row:
+        return 'failed', "\n\n\u274C **خطا:** سفارش، پلن یا پنل یافت نشد."
+    if order['status'] == 'approved':
+        return 'done', "\n\n\u26A0\uFE0F این سفارش قبلاً تایید شده است."
+    if order['status'] != 'pending':
+        return 'failed', "\n\n\u26A0\uFE0F این سفارش رد شده است."
+
+    ptype = (panel_row.get('panel_type') or 'marzban').lower()
+    if ptype == 'netico':
+        username, connection_info, message, retryable = await _create_netico_user(VpnPanelAPI(panel_id=panel_id), order['user_id'], plan, job)
+        if not (username and connection_info):
+            return ('retry' if retryable else 'failed'), f"\n\n\u274C **خطای پنل Netico:** `{message}`"
+        execute_db(
+            "UPDATE orders SET status = 'approved', marzban_username = ?, panel_id = ?, panel_type = ?, connection_info = ? WHERE id = ?",
+            (username, panel_id, 'netico', connection_info, order_id)
         )
-        try:
-            await context.bot.send_message(order['user_id'], final_message, parse_mode=ParseMode.HTML)
-            done_text = base_text + f"\n\n\u2705 **ارسال خودکار موفق بود.**"
-            if is_media:
-                await _safe_edit_caption(query.message, done_text, parse_mode=ParseMode.HTML, reply_markup=None)
-            else:
-                await _safe_edit_text(query.message, done_text, parse_mode=ParseMode.HTML, reply_markup=None)
-        except TelegramError as e:
-            err_text = base_text + f"\n\n\u26A0\uFE0F **خطا:** ارسال به کاربر ناموفق بود. {e}\nکانفیگ: <code>{config_link}</code>"
-            if is_media:
-                await _safe_edit_caption(query.message, err_text, parse_mode=ParseMode.HTML, reply_markup=None)
-            else:
-                await _safe_edit_text(query.message, err_text, parse_mode=ParseMode.HTML, reply_markup=None)
+        link_label, admin_label, link = "اطلاعات اتصال", "اطلاعات اتصال", connection_info
     else:
-        fail_text = base_text + f"\n\n\u274C **خطای پنل:** `{message}`"
-        if is_media:
-            await _safe_edit_caption(query.message, fail_text, parse_mode=ParseMode.HTML, reply_markup=None)
-        else:
-            await _safe_edit_text(query.message, fail_text, parse_mode=ParseMode.HTML, reply_markup=None)
+        # Marzban/Marzneshin: only the subscription link is sent
+        api = VpnPanelAPI(panel_id=panel_id)
+        username, config_link, message = await _create_panel_user(api, order['user_id'], plan, job)
+        if not (config_link and username):
+            return 'retry', f"\n\n\u274C **خطای پنل:** `{message}`"
+        execute_db("UPDATE orders SET status = 'approved', marzban_username = ?, panel_id = ?, panel_type = ? WHERE id = ?", (username, panel_id, ptype, order_id))
+        link_label, admin_label, link = "لینک اشتراک شما", "کانفیگ", config_link
+
+    if order.get('discount_code'):
+        execute_db("UPDATE discount_codes SET times_used = times_used + 1 WHERE code = ?", (order['discount_code'],))
+    await _apply_referral_bonus(order_id, context)
+    footer = get_setting('config_footer_text') or ''
+    final_message = (
+        f"✅ سفارش شما تایید شد!\n\n"
+        f"<b>پلن:</b> {plan['name']}\n"
+        f"<b>{link_label}:</b>\n<code>{link}</code>\n\n" + footer
+    )
+    try:
+        await context.bot.send_message(order['user_id'], final_message, parse_mode=ParseMode.HTML)
+    except TelegramError as e:
+        return 'done', f"\n\n\u26A0\uFE0F **خطا:** ارسال به کاربر ناموفق بود. {e}\n{admin_label}: <code>{link}</code>"
+    return 'done', "\n\n\u2705 **ارسال خودکار موفق بود.**"
 
 
 async def admin_xui_choose_inbound(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer("در حال ساخت کلاینت روی اینباند انتخابی...")
+    await query.answer()
     _, _, order_id, panel_id, inbound_id = query.data.split('_', 4)
-    order_id, panel_id = int(order_id), int(panel_id)
-    # Capture current message meta for later edits
-    is_media = bool(query.message.photo or query.message.video or query.message.document)
-    base_text = query.message.caption_html if is_media else (query.message.text_html or query.message.text or '')
-
-    order = query_db("SELECT * FROM orders WHERE id = ?", (order_id,), one=True)
-    if not order:
-        err_text = base_text + "\n\n\u274C سفارش یافت نشد."
-        if is_media:
-            await _safe_edit_caption(query.message, err_text, parse_mode=ParseMode.HTML, reply_markup=None)
-        else:
-            await _safe_edit_text(query.message, err_text, parse_mode=ParseMode.HTML, reply_markup=None)
+    # Exit selection mode; the inbound keyboard is replaced by the queued note
+    context.user_data.pop('pending_xui', None)
+    notice = _order_notice(query.message)
+    job_id = await enqueue_provisioning(int(order_id), 'inbound', panel_id=int(panel_id), inbound_id=int(inbound_id), notice=notice)
+    await _show_provisioning_queued(query.message, notice, job_id)
+
+
+async def _inbound_configs(api, inbound_id: int, username: str, sub_link: str, panel_row: dict) -> list[str]:
+    # Build direct configs from the inbound where possible; fall back to the subscription
+    # content, then to the panel's own helper
+    inbound_detail = None
+    if hasattr(api, '_fetch_inbound_detail'):
+        inbound_detail = await run_blocking(api._fetch_inbound_detail, inbound_id)
+    built_confs = []
+    if inbound_detail:
         try:
-            await query.message.edit_reply_markup(reply_markup=None)
+            built_confs = _build_configs_from_inbound(inbound_detail, username, panel_row) or []
         except Exception:
-            pass
-        return
+            built_confs = []
+    if not built_confs:
+        built_confs = await run_blocking(_fetch_subscription_configs, sub_link)
+    if not built_confs and hasattr(api, 'get_configs_for_user_on_inbound'):
+        try:
+            built_confs = await run_blocking(api.get_configs_for_user_on_inbound, inbound_id, username) or []
+        except Exception:
+            built_confs = []
+    return built_confs
+
+
+async def _job_user_on_panel(api, job: dict):
+    """(info, reachable) of the user an earlier attempt of the job may have created on the panel;
+    info is None when it is not there."""
+    found, _msg = await api.get_users_bulk([job['username']])
+    if found is None:
+        return None, False
+    return found.get(job['username']), True
+
+
+async def _create_on_inbound(api, panel_id: int, inbound_id: int, user_id: int, plan, job: dict | None = None):
+    """(username, sub_link, msg, configs) of a new client on the inbound, taken from its warm
+    pool (account_pool.py) when one is ready; configs is empty when they still have to be built.
+
+    With a provisioning job, the client gets the job's fixed username and a retry first looks
+    it up, so a lost addClient response never leaves a second client behind."""
+    if job and job.get('username'):
+        existing, reachable = await _job_user_on_panel(api, job)
+        if not reachable:
+            return None, None, "پنل برای بررسی تلاش قبلی در دسترس نبود.", []
+        if existing:
+            logger.info(f"Provisioning job #{job['id']}: {job['username']} already exists on the panel, delivering it")
+            return job['username'], existing.get('subscription_url') or '', "Success", []
+        username = job['username']
+    else:
+        pooled = await claim_pool_account(panel_id, inbound_id, plan)
+        if pooled:
+            if job:
+                await set_job_username(job, pooled['username'])
+            return pooled['username'], pooled['sub_link'], "Success", pooled['configs']
+        username = await job_username(job, user_id) if job else None
+    username, sub_link, msg = await run_blocking(api.create_user_on_inbound, inbound_id, user_id, plan, username=username)
+    return username, sub_link, msg, []
+
+
+async def _create_panel_user(api, user_id: int, plan, job: dict):
+    """(username, link, msg) of the job's user on a Marzban-style panel, looked up first on a retry."""
+    if job.get('username'):
+        existing, reachable = await _job_user_on_panel(api, job)
+        if not reachable:
+            return None, None, "پنل برای بررسی تلاش قبلی در دسترس نبود."
+        if existing:
+            logger.info(f"Provisioning job #{job['id']}: {job['username']} already exists on the panel, delivering it")
+            link = existing.get('subscription_url') or ''
+            if link and not link.startswith('http'):
+                link = f"{api.base_url}{link}"
+            return job['username'], link, "Success"
+    return await api.create_user(user_id, plan, username=await job_username(job, user_id))
+
+
+async def _create_netico_user(api, user_id: int, plan, job: dict | None = None):
+    """(username, connection_info, msg, retryable) of a new Netico user.
+
+    Netico has no API to look users up, so a create request whose answer was lost is never
+    sent again: only a failed login is retryable, and a later attempt of the job delivers its
+    user only if this bot recorded it as created."""
+    if job and job.get('username'):
+        row = query_db(
+            "SELECT connection_info FROM user_services WHERE panel_id = ? AND panel_username = ?",
+            (api.panel_id, job['username']), one=True,
+        )
+        if row:
+            return job['username'], row.get('connection_info'), "Success", False
+        return None, None, "پاسخ پنل به تلاش قبلی نرسید؛ ممکن است کاربر ساخته شده باشد، پنل را بررسی کنید.", False
+    if not await run_blocking(api.get_token):
+        return None, None, "خطا در ورود به پنل Netico", True
+    username = await job_username(job, user_id) if job else None
+    username, connection_info, msg = await api.create_user(user_id, plan, username=username)
+    return username, connection_info, msg, False
+
+
+async def provision_on_inbound(context: ContextTypes.DEFAULT_TYPE, job: dict):
+    """Provisioning job (provisioning.py): create the order's client on the chosen X-UI inbound and send it."""
+    order_id, panel_id, inbound_id = job['order_id'], job['panel_id'], int(job['inbound_id'])
+    order = query_db("SELECT * FROM orders WHERE id = ?", (order_id,), one=True)
+    if not order:
+        return 'failed', "\n\n\u274C سفارش یافت نشد."
+    if order['status'] == 'approved':
+        return 'done', "\n\n\u26A0\uFE0F این سفارش قبلاً تایید شده است."
+    if order['status'] != 'pending':
+        return 'failed', "\n\n\u26A0\uFE0F این سفارش رد شده است."
     plan = query_db("SELECT * FROM plans WHERE id = ?", (order['plan_id'],), one=True)
 
     api = VpnPanelAPI(panel_id=panel_id)
     if not hasattr(api, 'create_user_on_inbound'):
-        err_text = base_text + "\n\n\u274C این نوع پنل از ساخت بر اساس اینباند پشتیبانی نمی‌کند."
-        if is_media:
-            await _safe_edit_caption(query.message, err_text, parse_mode=ParseMode.HTML, reply_markup=None)
-        else:
-            await _safe_edit_text(query.message, err_text, parse_mode=ParseMode.HTML, reply_markup=None)
-        try:
-            await query.message.edit_reply_markup(reply_markup=None)
-        except Exception:
-            pass
-        return
+        return 'failed', "\n\n\u274C این نوع پنل از ساخت بر اساس اینباند پشتیبانی نمی‌کند."
 
-    username, sub_link, msg = api.create_user_on_inbound(inbound_id, order['user_id'], plan)
+    username, sub_link, msg, display_confs = await _create_on_inbound(api, panel_id, inbound_id, order['user_id'], plan, job)
     if not sub_link or not username:
-        safe = html_escape(str(msg))
-        err_text = base_text + f"\n\n<b>خطای پنل:</b>\n<code>{safe}</code>"
-        if is_media:
-            await _safe_edit_caption(query.message, err_text, parse_mode=ParseMode.HTML, reply_markup=None)
-        else:
-            await _safe_edit_text(query.message, err_text, parse_mode=ParseMode.HTML, reply_markup=None)
-        try:
-            await query.message.edit_reply_markup(reply_markup=None)
-        except Exception:
-            pass
-        return
+        return 'retry', f"\n\n<b>خطای پنل:</b>\n<code>{html_escape(str(msg))}</code>"
 
-    # Build direct configs from inbound where possible; fallback to fetching sub content
     panel_row = query_db("SELECT * FROM panels WHERE id = ?", (panel_id,), one=True)
-    execute_db("UPDATE orders SET status = 'approved', marzban_username = ?, panel_id = ?, panel_type = ?, xui_inbound_id = ? WHERE id = ?", (username, panel_id, (panel_row.get('panel_type') or 'marzban').lower(), int(inbound_id), order_id))
+    execute_db("UPDATE orders SET status = 'approved', marzban_username = ?, panel_id = ?, panel_type = ?, xui_inbound_id = ? WHERE id = ?", (username, panel_id, (panel_row.get('panel_type') or 'marzban').lower(), inbound_id, order_id))
     if order.get('discount_code'):
         execute_db("UPDATE discount_codes SET times_used = times_used + 1 WHERE code = ?", (order['discount_code'],))
 
-    inbound_detail = getattr(api, '_fetch_inbound_detail', lambda _id: None)(int(inbound_id))
-    built_confs = []
-    if inbound_detail:
-        try:
-            built_confs = _build_configs_from_inbound(inbound_detail, username, panel_row) or []
-        except Exception:
-            built_confs = []
-    # If none, try decoding subscription
-    if not built_confs:
-        built_confs = _fetch_subscription_configs(sub_link)
-    # As an extra attempt (but still ensure single output), try API helper only if still empty
-    api_confs = []
-    if not built_confs and hasattr(api, 'get_configs_for_user_on_inbound'):
-        try:
-            api_confs = api.get_configs_for_user_on_inbound(int(inbound_id), username) or []
-        except Exception:
-            api_confs = []
-    display_confs = built_confs or api_confs
-
-    footer = ((query_db("SELECT value FROM settings WHERE key = 'config_footer_text'", one=True) or {}).get('value') or '')
+    if not display_confs:
+        display_confs = await _inbound_configs(api, inbound_id, username, sub_link, panel_row)
+    footer = (get_setting('config_footer_text') or '')
     ptype_lower = (panel_row.get('panel_type') or '').lower()
     if display_confs:
         preview = display_confs[:1]  # send only the first config
@@ -624,28 +656,9 @@ async def admin_xui_choose_inbound(update: Update, context: ContextTypes.DEFAULT
             )
     try:
         await context.bot.send_message(order['user_id'], user_message, parse_mode=ParseMode.HTML)
-        # Exit selection mode: clear pending and collapse keyboard
-        context.user_data.pop('pending_xui', None)
-        ok_text = base_text + f"\n\n\u2705 **ارسال با موفقیت انجام شد.**"
-        if is_media:
-            await _safe_edit_caption(query.message, ok_text, parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("\U0001F519 بازگشت", callback_data='admin_main')]]))
-        else:
-            await _safe_edit_text(query.message, ok_text, parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("\U0001F519 بازگشت", callback_data='admin_main')]]))
-        # Ensure keyboard is cleared from selection state
-        try:
-            await query.message.edit_reply_markup(reply_markup=None)
-        except Exception:
-            pass
     except TelegramError as e:
-        err_text = base_text + f"\n\n\u26A0\uFE0F **خطا در ارسال به کاربر:** {e}"
-        if is_media:
-            await _safe_edit_caption(query.message, err_text, parse_mode=ParseMode.HTML, reply_markup=None)
-        else:
-            await _safe_edit_text(query.message, err_text, parse_mode=ParseMode.HTML, reply_markup=None)
-        try:
-            await query.message.edit_reply_markup(reply_markup=None)
-        except Exception:
-            pass
+        return 'done', f"\n\n\u26A0\uFE0F **خطا در ارسال به کاربر:** {e}"
+    return 'done', "\n\n\u2705 **ارسال با موفقیت انجام شد.**"
 
 
 async def admin_review_order_reject(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -653,9 +666,9 @@ async def admin_review_order_reject(update: Update, context: ContextTypes.DEFAUL
     await query.answer()
     order_id = int(query.data.split('_')[-1])
     order = query_db("SELECT * FROM orders WHERE id = ?", (order_id,), one=True)
+    is_media = bool(query.message.photo or query.message.video or query.message.document)
+    base_text = query.message.caption_html if is_media else (query.message.text_html or query.message.text or '')
     if not order or order['status'] != 'pending':
-        is_media = bool(query.message.photo or query.message.video or query.message.document)
-        base_text = query.message.caption_html if is_media else (query.message.text_html or query.message.text or '')
         new_text = base_text + "\n\n\u26A0\uFE0F این سفارش قبلاً بررسی شده است."
         if is_media:
             await _safe_edit_caption(query.message, new_text, parse_mode=ParseMode.HTML, reply_markup=None)
@@ -663,6 +676,8 @@ async def admin_review_order_reject(update: Update, context: ContextTypes.DEFAUL
             await _safe_edit_text(query.message, new_text, parse_mode=ParseMode.HTML, reply_markup=None)
         return
     execute_db("UPDATE orders SET status = 'rejected' WHERE id = ?", (order_id,))
+    # A delivery queued for this order (e.g. a wallet auto-approval retrying) must not run now
+    await cancel_provisioning(order_id, 'order rejected')
     try:
         await context.bot.send_message(order['user_id'], "\u274C متاسفانه پرداخت شما تایید نشد. لطفا با پشتیبانی در تماس باشید.")
     except TelegramError:
@@ -1194,7 +1209,7 @@ async def admin_plan_edit_save(update: Update, context: ContextTypes.DEFAULT_TYP
 async def admin_settings_manage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+    settings = get_settings()
     trial_status = settings.get('free_trial_status', '0')
     trial_button_text = "\u274C غیرفعال کردن تست" if trial_status == '1' else "\u2705 فعال کردن تست"
     trial_button_callback = "set_trial_status_0" if trial_status == '1' else "set_trial_status_1"
@@ -1258,7 +1273,7 @@ async def admin_settings_manage(update: Update, context: ContextTypes.DEFAULT_TY
 async def admin_toggle_trial_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     new_status = query.data.split('_')[-1]
-    execute_db("UPDATE settings SET value = ? WHERE key = 'free_trial_status'", (new_status,))
+    set_setting('free_trial_status', new_status)
     await query.answer(f"وضعیت تست رایگان {'فعال' if new_status == '1' else 'غیرفعال'} شد.", show_alert=True)
     return await admin_settings_manage(update, context)
 
@@ -1267,7 +1282,7 @@ async def admin_toggle_trial_status(update: Update, context: ContextTypes.DEFAUL
 async def admin_reseller_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")} or {}
+    settings = get_settings()
     enabled = settings.get('reseller_enabled', '1') == '1'
     fee = int((settings.get('reseller_fee_toman') or '200000') or 200000)
     percent = int((settings.get('reseller_discount_percent') or '50') or 50)
@@ -1296,7 +1311,7 @@ async def admin_toggle_reseller(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
     val = query.data.split('_')[-1]
-    execute_db("INSERT OR REPLACE INTO settings (key, value) VALUES ('reseller_enabled', ?)", (val,))
+    set_setting('reseller_enabled', val)
     return await admin_reseller_menu(update, context)
 
 
@@ -1339,7 +1354,7 @@ async def admin_reseller_set_value_save(update: Update, context: ContextTypes.DE
         await update.message.reply_text("جلسه منقضی شده است.")
         return await admin_reseller_menu(update, context)
     val = _normalize_digits(update.message.text.strip())
-    execute_db("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, val))
+    set_setting(key, val)
     context.user_data.pop('reseller_edit_key', None)
     await update.message.reply_text("ذخیره شد.")
     # Return to reseller menu
@@ -1406,7 +1421,7 @@ async def admin_reseller_approve(update: Update, context: ContextTypes.DEFAULT_T
         await query.answer("این درخواست قبلا بررسی شده است.", show_alert=True)
         return SETTINGS_MENU
     # Activate reseller for user
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")} or {}
+    settings = get_settings()
     percent = int((settings.get('reseller_discount_percent') or '50') or 50)
     days = int((settings.get('reseller_duration_days') or '30') or 30)
     cap = int((settings.get('reseller_max_purchases') or '10') or 10)
@@ -1445,7 +1460,7 @@ async def admin_toggle_usd_mode(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
     target = query.data.split('_')[-1]
-    execute_db("UPDATE settings SET value = ? WHERE key = 'usd_irt_mode'", (target,))
+    set_setting('usd_irt_mode', target)
     return await admin_settings_manage(update, context)
 
 
@@ -1595,8 +1610,8 @@ async def admin_settings_ask(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def admin_settings_save_trial(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         days, gb = update.message.text.split('-')
-        execute_db("UPDATE settings SET value = ? WHERE key = 'free_trial_days'", (days.strip(),))
-        execute_db("UPDATE settings SET value = ? WHERE key = 'free_trial_gb'", (gb.strip(),))
+        set_setting('free_trial_days', days.strip())
+        set_setting('free_trial_gb', gb.strip())
         await update.message.reply_text("\u2705 تنظیمات تست رایگان با موفقیت ذخیره شد.")
     except Exception:
         await update.message.reply_text("فرمت نامعتبر است. لطفا با فرمت `روز-حجم` وارد کنید.")
@@ -1614,6 +1629,7 @@ async def admin_settings_save_payment_text(update: Update, context: ContextTypes
         await update.message.reply_text("ورودی نامعتبر است. متن خالی ارسال نکنید.")
         return ConversationHandler.END
     execute_db("UPDATE messages SET text = ? WHERE message_name = ?", (new_text, 'payment_info_text'))
+    invalidate_menu_cache()
     context.user_data.pop('awaiting_admin', None)
     await update.message.reply_text("\u2705 متن پرداخت با موفقیت ذخیره شد.")
     # If invoked globally, refresh settings view
@@ -1850,6 +1866,7 @@ async def admin_panel_delete(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     panel_id = int(query.data.split('_')[-1])
     execute_db("DELETE FROM panels WHERE id=?", (panel_id,))
+    drop_panel_client(panel_id)
     await query.answer("پنل و اینباندهای مرتبط با آن حذف شدند.", show_alert=True)
     return await admin_panels_menu(update, context)
 
@@ -1978,13 +1995,13 @@ async def admin_panel_inbounds_menu(update: Update, context: ContextTypes.DEFAUL
             prow = query_db("SELECT * FROM panels WHERE id = ?", (panel_id,), one=True)
             if prow and (prow.get('panel_type') or 'marzban').lower() in ('marzban', 'marzneshin'):
                 api = VpnPanelAPI(panel_id=panel_id)
-                found, msg = getattr(api, 'list_inbounds', lambda: (None, 'NA'))()
+                found, msg = await run_blocking(getattr(api, 'list_inbounds', lambda: (None, 'NA')))
                 # Fallback: try Marzneshin API style if Marzban paths returned 404/empty
                 if not found:
                     try:
                         from ..panel import MarzneshinAPI as _MZ
                         alt = _MZ(prow)
-                        found, msg = alt.list_inbounds()
+                        found, msg = await run_blocking(alt.list_inbounds)
                         logger.info(f"Auto-discover fallback (apiv2) used for panel {panel_id}: {bool(found)}")
                     except Exception as _e:
                         logger.error(f"Auto-discover apiv2 fallback failed: {_e}")
@@ -2052,7 +2069,7 @@ async def admin_panel_inbounds_refresh(update: Update, context: ContextTypes.DEF
     # Try to fetch inbounds
     try:
         api = VpnPanelAPI(panel_id=panel_id)
-        found, msg = getattr(api, 'list_inbounds', lambda: (None, 'NA'))()
+        found, msg = await run_blocking(getattr(api, 'list_inbounds', lambda: (None, 'NA')))
         if not found:
             try:
                 await query.answer(f"ناموفق: {msg}", show_alert=True)
@@ -2179,6 +2196,7 @@ async def msg_add_receive_content(update: Update, context: ContextTypes.DEFAULT_
         "INSERT INTO messages (message_name, text, file_id, file_type) VALUES (?, ?, ?, ?)",
         (message_name, text, file_id, file_type),
     )
+    invalidate_menu_cache()
     await update.message.reply_text(f"\u2705 پیام جدید با نام `{message_name}` ساخته شد.")
     context.user_data.clear()
     return await send_admin_panel(update, context)
@@ -2219,6 +2237,7 @@ async def admin_messages_edit_text_save(update: Update, context: ContextTypes.DE
     message_name = context.user_data['editing_message_name']
     new_text = update.message.text
     execute_db("UPDATE messages SET text = ? WHERE message_name = ?", (new_text, message_name))
+    invalidate_menu_cache()
     await update.message.reply_text("\u2705 متن با موفقیت بروزرسانی شد.")
     context.user_data.clear()
     return await send_admin_panel(update, context)
@@ -2248,6 +2267,7 @@ async def admin_button_delete(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     button_id = int(query.data.replace("btn_delete_", ""))
     execute_db("DELETE FROM buttons WHERE id = ?", (button_id,))
+    invalidate_menu_cache()
     await query.answer("دکمه حذف شد.", show_alert=True)
     return await admin_buttons_menu(update, context)
 
@@ -2305,6 +2325,7 @@ async def admin_button_add_save(update: Update, context: ContextTypes.DEFAULT_TY
         "INSERT INTO buttons (menu_name, text, target, is_url, row, col) VALUES (?, ?, ?, ?, ?, ?)",
         (b['menu_name'], b['text'], b['target'], b['is_url'], b['row'], b['col']),
     )
+    invalidate_menu_cache()
     await update.message.reply_text("\u2705 دکمه با موفقیت اضافه شد.")
     return await admin_buttons_menu(update, context)
 
@@ -2469,12 +2490,14 @@ async def admin_generate_backup(update: Update, context: ContextTypes.DEFAULT_TY
     import json as _json
     import zipfile as _zipfile
     from ..config import DB_NAME
+    from ..db import checkpoint_wal
 
     zip_buffer = _io.BytesIO()
     total_users_count = 0
     with _zipfile.ZipFile(zip_buffer, mode='w', compression=_zipfile.ZIP_DEFLATED) as zf:
         # Include bot database
         try:
+            checkpoint_wal()
             with open(DB_NAME, 'rb') as fdb:
                 zf.writestr('bot_db.sqlite', fdb.read())
         except Exception as e:
@@ -2494,53 +2517,17 @@ async def admin_generate_backup(update: Update, context: ContextTypes.DEFAULT_TY
                 inbounds = query_db("SELECT id, protocol, tag FROM panel_inbounds WHERE panel_id = ? ORDER BY id", (panel_id,)) or []
                 zf.writestr(f"{base_dir}/panel_inbounds.json", _json.dumps(inbounds, ensure_ascii=False, indent=2))
 
-                # Clients/users snapshot via panel API when possible
+                # Clients/users snapshot via panel API when possible; X-UI-like panels enumerate
+                # their inbounds concurrently (BasePanelAPI._iter_xui_users)
                 api = VpnPanelAPI(panel_id=panel_id)
-                users_payload = []
-                # Marzban supports get_all_users
                 try:
                     users, msg = await api.get_all_users()
                 except Exception as e:
                     users, msg = None, str(e)
-                if users:
-                    users_payload = users
-                    total_users_count += len(users)
-                else:
-                    # Try to enumerate clients from inbounds for X-UI-like panels
-                    list_inb = None
-                    try:
-                        list_inb, _ = api.list_inbounds()
-                    except Exception:
-                        list_inb = None
-                    if list_inb:
-                        for ib in list_inb:
-                            inbound_id = ib.get('id')
-                            fetch = getattr(api, '_fetch_inbound_detail', None)
-                            detail = None
-                            if callable(fetch):
-                                try:
-                                    detail = fetch(inbound_id)
-                                except Exception:
-                                    detail = None
-                            if not detail:
-                                continue
-                            settings_str = detail.get('settings')
-                            try:
-                                settings_obj = _json.loads(settings_str) if isinstance(settings_str, str) else {}
-                            except Exception:
-                                settings_obj = {}
-                            clients = settings_obj.get('clients') or []
-                            if isinstance(clients, list):
-                                for c in clients:
-                                    users_payload.append({
-                                        'email': c.get('email'),
-                                        'totalGB': c.get('totalGB'),
-                                        'expiryTime': c.get('expiryTime'),
-                                        'enable': c.get('enable'),
-                                        'subId': c.get('subId'),
-                                        'inbound_id': inbound_id,
-                                    })
-                        total_users_count += len(users_payload)
+                if users is None:
+                    logger.warning(f"Backup: could not list users of panel {panel_id}: {msg}")
+                users_payload = users or []
+                total_users_count += len(users_payload)
                 zf.writestr(f"{base_dir}/clients_or_users.json", _json.dumps(users_payload, ensure_ascii=False, indent=2))
             except Exception as e:
                 logger.error(f"Error adding panel {panel_id} to backup ZIP: {e}")
@@ -2614,7 +2601,7 @@ async def admin_generate_backup(update: Update, context: ContextTypes.DEFAULT_TY
             logger.error(f"Could not add stats.json: {e}")
 
         try:
-            add_admins = [row['user_id'] for row in (query_db("SELECT user_id FROM admins ORDER BY user_id") or [])]
+            add_admins = extra_admin_ids()
             admins_obj = {
                 'primary_admin_id': ADMIN_ID,
                 'additional_admin_ids': add_admins,
@@ -2666,13 +2653,13 @@ async def admin_set_usd_rate_save(update: Update, context: ContextTypes.DEFAULT_
         else:
             val = update.message.text.strip()
         if val == '-' or val == '' or val.lower() == 'clear':
-            execute_db("UPDATE settings SET value = NULL WHERE key = 'usd_irt_manual'", ())
+            set_setting('usd_irt_manual', None)
             await update.message.reply_text("نرخ دلار پاک شد؛ از نرخ API استفاده خواهد شد.")
         else:
             rate = int(float(val))
             if rate <= 0:
                 raise ValueError()
-            execute_db("UPDATE settings SET value = ? WHERE key = 'usd_irt_manual'", (str(rate),))
+            set_setting('usd_irt_manual', str(rate))
             await update.message.reply_text("نرخ دلار ذخیره شد.")
     except Exception:
         await update.message.reply_text("ورودی نامعتبر است. یک عدد صحیح تومان وارد کنید یا '-' برای پاک کردن.")
@@ -2696,7 +2683,7 @@ async def admin_set_usd_rate_save(update: Update, context: ContextTypes.DEFAULT_
 
 async def admin_clear_usd_cache(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    execute_db("UPDATE settings SET value = '' WHERE key IN ('usd_irt_cached','usd_irt_cached_ts')")
+    set_settings({'usd_irt_cached': '', 'usd_irt_cached_ts': ''})
     await query.answer("کش دلار پاک شد.", show_alert=True)
     return await admin_settings_manage(update, context)
 
@@ -2704,35 +2691,35 @@ async def admin_clear_usd_cache(update: Update, context: ContextTypes.DEFAULT_TY
 async def admin_toggle_pay_card(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     val = query.data.split('_')[-1]
-    execute_db("UPDATE settings SET value = ? WHERE key = 'pay_card_enabled'", (val,))
+    set_setting('pay_card_enabled', val)
     return await admin_settings_manage(update, context)
 
 
 async def admin_toggle_pay_crypto(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     val = query.data.split('_')[-1]
-    execute_db("UPDATE settings SET value = ? WHERE key = 'pay_crypto_enabled'", (val,))
+    set_setting('pay_crypto_enabled', val)
     return await admin_settings_manage(update, context)
 
 
 async def admin_toggle_pay_gateway(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     val = query.data.split('_')[-1]
-    execute_db("UPDATE settings SET value = ? WHERE key = 'pay_gateway_enabled'", (val,))
+    set_setting('pay_gateway_enabled', val)
     return await admin_settings_manage(update, context)
 
 
 async def admin_toggle_gateway_type(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     t = query.data.split('_')[-1]
-    execute_db("UPDATE settings SET value = ? WHERE key = 'gateway_type'", (t,))
+    set_setting('gateway_type', t)
     return await admin_settings_manage(update, context)
 
 
 async def admin_set_gateway_api_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+    settings = get_settings()
     gateway_type = (settings.get('gateway_type') or 'zarinpal').lower()
     context.user_data['gateway_setup'] = {'step': 1, 'type': gateway_type}
     if gateway_type == 'zarinpal':
@@ -2753,7 +2740,7 @@ async def admin_set_gateway_api_save(update: Update, context: ContextTypes.DEFAU
             if len(txt) < 5:
                 await update.message.reply_text("MerchantID نامعتبر است. دوباره وارد کنید:")
                 return SETTINGS_AWAIT_GATEWAY_API
-            execute_db("UPDATE settings SET value = ? WHERE key = 'zarinpal_merchant_id'", (txt,))
+            set_setting('zarinpal_merchant_id', txt)
             context.user_data['gateway_setup']['step'] = 2
             await update.message.reply_text("مرحله 2/2: Callback URL را وارد کنید (مثال: https://site.com/pay/callback):")
             return SETTINGS_AWAIT_GATEWAY_API
@@ -2761,7 +2748,7 @@ async def admin_set_gateway_api_save(update: Update, context: ContextTypes.DEFAU
             if not (txt.startswith('http://') or txt.startswith('https://')):
                 await update.message.reply_text("Callback URL نامعتبر است. با http(s) شروع شود:")
                 return SETTINGS_AWAIT_GATEWAY_API
-            execute_db("UPDATE settings SET value = ? WHERE key = 'gateway_callback_url'", (txt,))
+            set_setting('gateway_callback_url', txt)
             await update.message.reply_text("اطلاعات زرین‌پال ذخیره شد.")
             context.user_data.pop('gateway_setup', None)
             return await admin_settings_manage(update, context)
@@ -2770,7 +2757,7 @@ async def admin_set_gateway_api_save(update: Update, context: ContextTypes.DEFAU
             if len(txt) < 4:
                 await update.message.reply_text("PIN نامعتبر است. دوباره وارد کنید:")
                 return SETTINGS_AWAIT_GATEWAY_API
-            execute_db("UPDATE settings SET value = ? WHERE key = 'aghapay_pin'", (txt,))
+            set_setting('aghapay_pin', txt)
             context.user_data['gateway_setup']['step'] = 2
             await update.message.reply_text("مرحله 2/2: Callback URL را وارد کنید (اختیاری، برای رد این مرحله '-' بزنید):")
             return SETTINGS_AWAIT_GATEWAY_API
@@ -2779,7 +2766,7 @@ async def admin_set_gateway_api_save(update: Update, context: ContextTypes.DEFAU
                 if not (txt.startswith('http://') or txt.startswith('https://')):
                     await update.message.reply_text("Callback URL نامعتبر است. با http(s) شروع شود یا '-' برای رد:")
                     return SETTINGS_AWAIT_GATEWAY_API
-                execute_db("UPDATE settings SET value = ? WHERE key = 'gateway_callback_url'", (txt,))
+                set_setting('gateway_callback_url', txt)
             await update.message.reply_text("اطلاعات آقای پرداخت ذخیره شد.")
             context.user_data.pop('gateway_setup', None)
             return await admin_settings_manage(update, context)
@@ -3328,7 +3315,7 @@ async def admin_tutorial_view(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def admin_toggle_signup_bonus(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     val = query.data.split('_')[-1]
-    execute_db("UPDATE settings SET value = ? WHERE key = 'signup_bonus_enabled'", (val,))
+    set_setting('signup_bonus_enabled', val)
     await query.answer("ذخیره شد.", show_alert=False)
     return await admin_settings_manage(update, context)
 
@@ -3349,7 +3336,7 @@ async def admin_set_signup_bonus_amount_save(update: Update, context: ContextTyp
     except Exception:
         await update.message.reply_text("مبلغ نامعتبر است. یک عدد صحیح وارد کنید:")
         return SETTINGS_AWAIT_SIGNUP_BONUS
-    execute_db("UPDATE settings SET value = ? WHERE key = 'signup_bonus_amount'", (str(amount),))
+    set_setting('signup_bonus_amount', str(amount))
     await update.message.reply_text("ذخیره شد.")
     fake_query = type('obj', (object,), {
         'data': 'admin_settings_manage',
@@ -3382,7 +3369,7 @@ async def _apply_referral_bonus(order_id: int, context: ContextTypes.DEFAULT_TYP
             base_price = 0
         if base_price <= 0:
             return
-        settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+        settings = get_settings()
         pct = 10
         try:
             pct = int((settings.get('referral_commission_percent') or '10').strip())
@@ -3436,8 +3423,8 @@ async def admin_admins_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     if query:
         await query.answer()
-    admins = query_db("SELECT user_id FROM admins ORDER BY user_id") or []
-    text = "👑 مدیریت ادمین‌ها\n\n" + ("لیست ادمین‌ها:\n" + "\n".join(f"- `{row['user_id']}`" for row in admins) if admins else "ادمین دیگری ثبت نشده است.")
+    admins = extra_admin_ids()
+    text = "👑 مدیریت ادمین‌ها\n\n" + ("لیست ادمین‌ها:\n" + "\n".join(f"- `{uid}`" for uid in admins) if admins else "ادمین دیگری ثبت نشده است.")
     text += "\n\nافزودن: `/addadmin USER_ID`\nحذف: `/deladmin USER_ID`\n"
     kb = [[InlineKeyboardButton("\U0001F519 بازگشت", callback_data="admin_main")]]
     sender = query.message.edit_text if query else update.message.reply_text
@@ -3455,7 +3442,7 @@ async def admin_add_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if len(parts) == 2:
         try:
             uid = int(parts[1])
-            execute_db("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (uid,))
+            add_admin(uid)
             await update.message.reply_text(f"✅ کاربر `{uid}` به عنوان ادمین اضافه شد.", parse_mode=ParseMode.MARKDOWN)
             return
         except Exception as e:
@@ -3472,7 +3459,7 @@ async def admin_del_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if len(parts) == 2:
         try:
             uid = int(parts[1])
-            execute_db("DELETE FROM admins WHERE user_id = ?", (uid,))
+            remove_admin(uid)
             await update.message.reply_text(f"✅ کاربر `{uid}` از لیست ادمین‌ها حذف شد.", parse_mode=ParseMode.MARKDOWN)
             return
         except Exception as e:
@@ -3487,7 +3474,7 @@ async def admin_setms_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     txt = (update.message.text or '').strip()
     arg = txt[len('/setms'):].strip() if txt.startswith('/setms') else ''
     if arg:
-        execute_db("UPDATE settings SET value = ? WHERE key = 'config_footer_text'", (arg,))
+        set_setting('config_footer_text', arg)
         await update.message.reply_text("✅ متن زیر کانفیگ بروزرسانی شد.")
         return
     context.user_data['awaiting_admin'] = 'set_config_footer'
@@ -3530,7 +3517,7 @@ async def admin_set_config_footer_save(update: Update, context: ContextTypes.DEF
     if context.user_data.get('awaiting_admin') != 'set_config_footer':
         return ConversationHandler.END
     new_text = (update.message.text or '').strip()
-    execute_db("UPDATE settings SET value = ? WHERE key = 'config_footer_text'", (new_text,))
+    set_setting('config_footer_text', new_text)
     context.user_data.pop('awaiting_admin', None)
     await update.message.reply_text("✅ متن زیر کانفیگ ذخیره شد.")
     # Refresh settings view
@@ -3564,7 +3551,7 @@ async def admin_set_ref_percent_save(update: Update, context: ContextTypes.DEFAU
         percent = int(float(txt))
         if percent < 0 or percent > 100:
             raise ValueError()
-        execute_db("UPDATE settings SET value = ? WHERE key = 'referral_commission_percent'", (str(percent),))
+        set_setting('referral_commission_percent', str(percent))
         await update.message.reply_text("✅ درصد کمیسیون ذخیره شد.")
         context.user_data.pop('awaiting_admin', None)
     except Exception:
@@ -3599,21 +3586,37 @@ async def admin_set_trial_panel_choose(update: Update, context: ContextTypes.DEF
     await query.answer()
     panel_id = query.data.split('_')[-1]
     value = '' if panel_id == '0' else panel_id
-    execute_db("UPDATE settings SET value = ? WHERE key = 'free_trial_panel_id'", (value,))
+    set_setting('free_trial_panel_id', value)
     await query.answer("ذخیره شد", show_alert=True)
     return await admin_settings_manage(update, context)
 
 
-async def auto_approve_wallet_order(order_id: int, context: ContextTypes.DEFAULT_TYPE, user: User) -> bool:
+def auto_approve_panel_id():
+    """Id of the panel auto_approve_wallet_order would use, or None when no panel can auto-approve."""
+    netico_panel = query_db("SELECT id FROM panels WHERE panel_type = 'netico' LIMIT 1", one=True)
+    if netico_panel:
+        return netico_panel['id']
+    row = query_db(
+        "SELECT p.id FROM panels p JOIN panel_inbounds pi ON pi.panel_id = p.id "
+        "WHERE p.panel_type IN ('xui', 'x-ui', 'sanaei', 'alireza', '3xui', '3x-ui', 'txui', 'tx-ui') "
+        "ORDER BY pi.inbound_id IS NULL, pi.id",
+        one=True,
+    )
+    return row['id'] if row else None
+
+
+async def auto_approve_wallet_order(order_id: int, context: ContextTypes.DEFAULT_TYPE, job: dict | None = None) -> bool:
     """
     Attempts to automatically approve an order paid by wallet.
     Finds a suitable panel (Netico or x-ui/3x-ui), creates the user,
-    and sends the connection info to the user.
+    and sends the connection info to the order's user.
     Returns True on success, False on failure.
+    Run from a provisioning job, the user is created under the job's fixed username and a
+    failure that must not be retried sets job['final'].
     """
     # try:
     order = query_db("SELECT * FROM orders WHERE id = ?", (order_id,), one=True)
-    if not order:
+    if not order or order['status'] != 'pending':
         return False
 
     plan = query_db("SELECT * FROM plans WHERE id = ?", (order['plan_id'],), one=True)
@@ -3628,17 +3631,15 @@ async def auto_approve_wallet_order(order_id: int, context: ContextTypes.DEFAULT
     
     if netico_panel:
         # Use Netico panel
-        from ..panel import NeticoAPI
-        api = NeticoAPI(netico_panel)
+        api = VpnPanelAPI(panel_id=netico_panel['id'])
         
         # Create user on Netico panel
-        username, password, connection_info = await api.create_user(
-            user_id=order['user_id'],
-            plan=plan
-        )
+        username, connection_info, message, retryable = await _create_netico_user(api, order['user_id'], plan, job)
         
-        if not (username and password):
-            logger.error(f"Auto-approve failed for Netico order {order_id}: Failed to create user")
+        if not (username and connection_info):
+            logger.error(f"Auto-approve failed for Netico order {order_id}: {message}")
+            if job and not retryable:
+                job['final'] = True
             return False
         
         # Update order in DB
@@ -3655,18 +3656,15 @@ async def auto_approve_wallet_order(order_id: int, context: ContextTypes.DEFAULT
         )
         
         # Footer and message composition
-        footer_row = query_db("SELECT value FROM settings WHERE key = 'config_footer_text'", one=True)
-        footer_text = (footer_row.get('value') if footer_row else '') or ''
+        footer_text = get_setting('config_footer_text') or ''
         
         message_text = (
             f"✅ سرویس شما با موفقیت ساخته شد!\n\n"
             f"<b>اطلاعات اتصال:</b>\n"
-            f"<b>نام کاربری:</b> <code>{username}</code>\n"
-            f"<b>رمز عبور:</b> <code>{password}</code>\n\n"
             f"{connection_info}\n\n" + footer_text
         )
         
-        await context.bot.send_message(user.id, message_text, parse_mode=ParseMode.HTML)
+        await context.bot.send_message(order['user_id'], message_text, parse_mode=ParseMode.HTML)
         return True
         
     # If no Netico panel, try XUI panels
@@ -3710,7 +3708,7 @@ async def auto_approve_wallet_order(order_id: int, context: ContextTypes.DEFAULT
     inbound_id = default_inbound_id
     if not inbound_id:
         try:
-            inbounds, _ = api.list_inbounds()
+            inbounds, _ = await run_blocking(api.list_inbounds)
         except Exception:
             inbounds = []
         if inbounds:
@@ -3731,7 +3729,7 @@ async def auto_approve_wallet_order(order_id: int, context: ContextTypes.DEFAULT
         return False
 
     # Create user on inbound using panel helper
-    username_created, sub_link, message = api.create_user_on_inbound(int(inbound_id), order['user_id'], plan)
+    username_created, sub_link, message, display_confs = await _create_on_inbound(api, panel_row['id'], int(inbound_id), order['user_id'], plan, job)
     if not (username_created and sub_link):
         logger.error(f"Auto-approve failed for order {order_id}: {message}")
         return False
@@ -3753,28 +3751,11 @@ async def auto_approve_wallet_order(order_id: int, context: ContextTypes.DEFAULT
 
     # Build config(s) similar to admin approval flow
     panel_full = query_db("SELECT * FROM panels WHERE id = ?", (panel_row['id'],), one=True) or panel_row
-    inbound_detail = getattr(api, '_fetch_inbound_detail', lambda _id: None)(int(inbound_id))
-    built_confs = []
-    if inbound_detail:
-        try:
-            built_confs = _build_configs_from_inbound(inbound_detail, username_created, panel_full) or []
-        except Exception:
-            built_confs = []
-    # If none, try decoding subscription content
-    if not built_confs:
-        built_confs = _fetch_subscription_configs(sub_link)
-    # As extra attempt: use API helper if available
-    api_confs = []
-    if not built_confs and hasattr(api, 'get_configs_for_user_on_inbound'):
-        try:
-            api_confs = api.get_configs_for_user_on_inbound(int(inbound_id), username_created) or []
-        except Exception:
-            api_confs = []
-    display_confs = built_confs or api_confs
+    if not display_confs:
+        display_confs = await _inbound_configs(api, int(inbound_id), username_created, sub_link, panel_full)
 
     # Footer and message composition
-    footer_row = query_db("SELECT value FROM settings WHERE key = 'config_footer_text'", one=True)
-    footer_text = (footer_row.get('value') if footer_row else '') or ''
+    footer_text = get_setting('config_footer_text') or ''
     sub_abs = sub_link
     try:
         if sub_abs and not sub_abs.startswith('http'):
@@ -3794,7 +3775,7 @@ async def auto_approve_wallet_order(order_id: int, context: ContextTypes.DEFAULT
             f"✅ سرویس شما با موفقیت ساخته شد!\n\n"
             f"<b>لینک اشتراک شما:</b>\n<code>{sub_abs}</code>\n\n" + footer_text
         )
-    await context.bot.send_message(user.id, message_text, parse_mode=ParseMode.HTML)
+    await context.bot.send_message(order['user_id'], message_text, parse_mode=ParseMode.HTML)
     
     return True
 
@@ -3803,10 +3784,80 @@ async def auto_approve_wallet_order(order_id: int, context: ContextTypes.DEFAULT
     #     return False
 
 
+async def _apply_wallet_order_extras(order_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Reseller usage and referral bonus of an auto-delivered order; both are applied only once
+    try:
+        order = query_db("SELECT user_id, reseller_applied FROM orders WHERE id = ?", (order_id,), one=True)
+        if order and not order.get('reseller_applied'):
+            r = query_db("SELECT max_purchases, used_purchases FROM resellers WHERE user_id = ?", (order['user_id'],), one=True)
+            if r and int(r.get('used_purchases') or 0) < int(r.get('max_purchases') or 0):
+                execute_db("UPDATE resellers SET used_purchases = used_purchases + 1 WHERE user_id = ?", (order['user_id'],))
+                execute_db("UPDATE orders SET reseller_applied = 1 WHERE id = ?", (order_id,))
+    except Exception:
+        pass
+    await _apply_referral_bonus(order_id, context)
+
+
+async def provision_wallet_order(context: ContextTypes.DEFAULT_TYPE, job: dict):
+    """Provisioning job (provisioning.py): auto-deliver an order paid from the wallet."""
+    order_id = job['order_id']
+    order = query_db("SELECT status FROM orders WHERE id = ?", (order_id,), one=True)
+    if not order or order['status'] not in ('pending', 'approved'):
+        return 'failed', ''
+    error = ''
+    if order['status'] != 'approved':
+        try:
+            await auto_approve_wallet_order(order_id, context, job)
+        except Exception as e:
+            error = str(e)
+            logger.error(f"Auto-approve of wallet order {order_id} raised: {e}")
+        order = query_db("SELECT status FROM orders WHERE id = ?", (order_id,), one=True) or {}
+    if order.get('status') != 'approved':
+        return ('failed' if job.get('final') else 'retry'), error
+    await _apply_wallet_order_extras(order_id, context)
+    return 'done', ''
+
+
+async def send_wallet_order_to_admins(bot, order_id: int) -> None:
+    """Ask the admins to approve a wallet-paid order by hand."""
+    order = query_db("SELECT * FROM orders WHERE id = ?", (order_id,), one=True)
+    if not order:
+        return
+    plan = query_db("SELECT name FROM plans WHERE id = ?", (order['plan_id'],), one=True) or {}
+    user_row = query_db("SELECT first_name FROM users WHERE user_id = ?", (order['user_id'],), one=True) or {}
+    user_info = f"\U0001F464 **کاربر:** {mention_html(order['user_id'], user_row.get('first_name') or str(order['user_id']))}\n\U0001F194 **آیدی:** `{order['user_id']}`"
+    plan_info = f"\U0001F4CB **پلن:** {plan.get('name', '-')}"
+    price_info = f"\U0001F4B0 **مبلغ پرداختی:** {int(order.get('final_price') or 0):,} تومان\n\U0001F4B3 **روش:** کیف پول"
+    await notify_admins(bot,
+        text=(f"\U0001F514 **درخواست خرید جدید** (سفارش #{order_id})\n\n{user_info}\n\n{plan_info}\n{price_info}\n\nلطفا نتیجه را اعلام کنید:"),
+        parse_mode=ParseMode.HTML,
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("\u2705 تأیید و ارسال خودکار", callback_data=f"approve_auto_{order_id}")],
+            [InlineKeyboardButton("\U0001F4DD تأیید و ارسال دستی", callback_data=f"approve_manual_{order_id}")],
+            [InlineKeyboardButton("\u274C رد درخواست", callback_data=f"reject_order_{order_id}")],
+        ]),
+    )
+
+
+async def wallet_order_to_admins(context: ContextTypes.DEFAULT_TYPE, job: dict) -> None:
+    """Failure hook of wallet provisioning jobs: fall back to manual approval and tell the user."""
+    order = query_db("SELECT user_id, status FROM orders WHERE id = ?", (job['order_id'],), one=True)
+    if not order or order['status'] != 'pending':
+        return
+    await send_wallet_order_to_admins(context.bot, job['order_id'])
+    try:
+        await context.bot.send_message(
+            order['user_id'],
+            "\u26A0\uFE0F ساخت خودکار سرویس انجام نشد؛ سفارش شما برای تایید به ادمین ارسال شد و پس از تایید برایتان ارسال می‌شود.",
+        )
+    except TelegramError:
+        pass
+
+
 async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+    settings = get_settings()
     trial_status = settings.get('free_trial_status', '0')
     trial_button_text = "\u274C غیرفعال کردن تست" if trial_status == '1' else "\u2705 فعال کردن تست"
     trial_button_callback = "set_trial_status_0" if trial_status == '1' else "set_trial_status_1"
@@ -19,7 +19,10 @@ from ..states import (
     ADMIN_PANEL_INBOUNDS_AWAIT_TAG,
 )
 from ..helpers.tg import safe_edit_text as _safe_edit_text
-from ..panel import VpnPanelAPI as PanelAPI
+from ..panel import VpnPanelAPI as PanelAPI, drop_panel_client
+from ..panel_http import run_blocking
+from ..account_pool import XUI_POOL_TYPES, pool_overview, set_pool_depth
+from .admin import _md_escape
 
 
 async def admin_panels_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -41,10 +44,13 @@ async def admin_panels_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
             if (ptype or '').lower() in ('xui', 'x-ui', 'sanaei'):
                 extra = f"\n   \u27A4 sub base: {p.get('sub_base') or '-'}"
             text += f"- {p['name']} ({ptype})\n   URL: {p['url']}{extra}\n"
-            keyboard.append([
+            row = [
                 InlineKeyboardButton("مدیریت اینباندها", callback_data=f"panel_inbounds_{p['id']}"),
                 InlineKeyboardButton("\u274C حذف", callback_data=f"panel_delete_{p['id']}")
-            ])
+            ]
+            if (ptype or '').lower() in XUI_POOL_TYPES:
+                row.insert(1, InlineKeyboardButton("\U0001F9CA استخر اکانت", callback_data=f"panel_pool_{p['id']}"))
+            keyboard.append(row)
 
     keyboard.insert(0, [InlineKeyboardButton("\u2795 افزودن پنل جدید", callback_data="panel_add_start")])
     keyboard.append([InlineKeyboardButton("\U0001F519 بازگشت", callback_data="admin_main")])
@@ -61,10 +67,66 @@ async def admin_panel_delete(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     panel_id = int(query.data.split('_')[-1])
     execute_db("DELETE FROM panels WHERE id=?", (panel_id,))
+    drop_panel_client(panel_id)
     await query.answer("پنل و اینباندهای مرتبط با آن حذف شدند.", show_alert=True)
     return await admin_panels_menu(update, context)
 
 
+# Warm account pool depth changes by this much per button press
+_POOL_DEPTH_STEP = 5
+
+
+async def _show_panel_pool(query, panel_id: int) -> int:
+    panel = query_db("SELECT id, name FROM panels WHERE id = ?", (panel_id,), one=True)
+    if not panel:
+        await _safe_edit_text(query.message, "پنل یافت نشد.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("\U0001F519 بازگشت به لیست پنل‌ها", callback_data="admin_panels_menu")]]))
+        return ADMIN_PANELS_MENU
+    api = PanelAPI(panel_id=panel_id)
+    inbounds, msg = await run_blocking(api.list_inbounds) if hasattr(api, 'list_inbounds') else (None, 'Not supported')
+    overview = pool_overview(panel_id)
+    text = (
+        f"\U0001F9CA **استخر اکانت آماده: {_md_escape(panel['name'])}**\n\n"
+        "برای هر اینباند تعدادی کلاینت غیرفعال از قبل ساخته می‌شود؛ خرید و تست روی آن اینباند یکی را فوراً فعال می‌کند "
+        "و استخر در پس‌زمینه دوباره پر می‌شود.\n\n"
+    )
+    keyboard = []
+    if not inbounds:
+        text += f"خطا در دریافت اینباندها: {_md_escape(str(msg))}"
+    else:
+        text += "آماده / هدف:\n"
+        for ib in inbounds[:30]:
+            ib_id = int(ib['id'])
+            stats = overview.get(ib_id, {'depth': 0, 'ready': 0})
+            title = f"{ib.get('remark','') or ib.get('protocol','inbound')}:{ib.get('port', '')}"
+            text += f"- {_md_escape(title)}: {stats['ready']} / {stats['depth']}\n"
+            keyboard.append([
+                InlineKeyboardButton("\u2796", callback_data=f"pool_depth_{panel_id}_{ib_id}_dec"),
+                InlineKeyboardButton(f"{title} ({stats['ready']}/{stats['depth']})", callback_data=f"panel_pool_{panel_id}"),
+                InlineKeyboardButton("\u2795", callback_data=f"pool_depth_{panel_id}_{ib_id}_inc"),
+            ])
+    keyboard.append([InlineKeyboardButton("\U0001F504 بروزرسانی", callback_data=f"panel_pool_{panel_id}")])
+    keyboard.append([InlineKeyboardButton("\U0001F519 بازگشت به لیست پنل‌ها", callback_data="admin_panels_menu")])
+    await _safe_edit_text(query.message, text, parse_mode=ParseMode.MARKDOWN, reply_markup=InlineKeyboardMarkup(keyboard))
+    return ADMIN_PANELS_MENU
+
+
+async def admin_panel_pool_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    return await _show_panel_pool(query, int(query.data.split('_')[-1]))
+
+
+async def admin_panel_pool_set(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    _, _, panel_id, inbound_id, action = query.data.split('_')
+    panel_id, inbound_id = int(panel_id), int(inbound_id)
+    depth = pool_overview(panel_id).get(inbound_id, {}).get('depth', 0)
+    depth = depth + _POOL_DEPTH_STEP if action == 'inc' else max(0, depth - _POOL_DEPTH_STEP)
+    set_pool_depth(panel_id, inbound_id, depth)
+    await query.answer(f"هدف استخر: {depth}")
+    return await _show_panel_pool(query, panel_id)
+
+
 async def admin_panel_add_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # Clear any conflicting flags from other flows to avoid misrouting inputs
     for key in [
@@ -176,7 +238,7 @@ async def admin_panel_receive_pass(update: Update, context: ContextTypes.DEFAULT
     connecting_message = await update.message.reply_text("در حال اتصال به پنل و دریافت لیست اینباندها...")
 
     # The list_inbounds() method in the panel API returns a tuple: (inbounds_list, message)
-    inbounds, msg = api.list_inbounds()
+    inbounds, msg = await run_blocking(api.list_inbounds)
 
     if not inbounds:
         error_message = msg or "لیست اینباندها خالی است یا خطایی رخ داده است."
@@ -249,6 +311,7 @@ async def admin_panel_receive_default_inbound(update: Update, context: ContextTy
         else:
             # If inbound fails to save, delete the panel to avoid orphaned data
             execute_db("DELETE FROM panels WHERE id = ?", (panel_id,))
+            drop_panel_client(panel_id)
             await query.edit_message_text("خطا در ذخیره اینباند پیش‌فرض در دیتابیس. پنل حذف شد.")
     else:
         await query.edit_message_text("خطا در ذخیره پنل در دیتابیس.")
@@ -2,32 +2,110 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 
-from ..db import query_db, execute_db
-from ..helpers.tg import safe_edit_text as _safe_edit_text
+from ..db import query_db, aquery_db, execute_db
+from ..broadcast import (
+    SEGMENTS,
+    cached_segment_count,
+    create_broadcast,
+    get_broadcast,
+    panel_segment_counts,
+    progress_keyboard,
+    progress_text,
+    segment_count,
+    segment_label,
+    set_broadcast_status,
+    set_progress_message,
+    start_broadcast,
+)
+from ..helpers.tg import safe_edit_text as _safe_edit_text, get_all_admin_ids
 from ..states import BROADCAST_SELECT_AUDIENCE, BROADCAST_SELECT_MODE, BROADCAST_AWAIT_MESSAGE, ADMIN_MAIN_MENU
+from ..states import BROADCAST_AWAIT_SEGMENT_VALUE
+from .admin import _normalize_digits
 from ..states import ADMIN_STATS_MENU
 
 
 async def admin_broadcast_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    keyboard = [
-        [InlineKeyboardButton("ارسال به همه", callback_data="broadcast_all")],
-        [InlineKeyboardButton("ارسال به خریداران", callback_data="broadcast_buyers")],
-        [InlineKeyboardButton("\U0001F519 بازگشت", callback_data="admin_main")],
-    ]
-    await _safe_edit_text(query.message, "📣 ارسال همگانی:", reply_markup=InlineKeyboardMarkup(keyboard))
+    keyboard = []
+    for key, seg in SEGMENTS.items():
+        # Sizes are precomputed by a background job (broadcast.refresh_segment_counts)
+        count = None if seg.get('param') else cached_segment_count(key)
+        label = seg['title'] if count is None else f"{seg['title']} ({count})"
+        keyboard.append([InlineKeyboardButton(label, callback_data=f"broadcast_seg_{key}")])
+    keyboard.append([InlineKeyboardButton("\U0001F519 بازگشت", callback_data="admin_main")])
+    await _safe_edit_text(query.message, "📣 ارسال همگانی:\nمخاطبان را انتخاب کنید.", reply_markup=InlineKeyboardMarkup(keyboard))
     return BROADCAST_SELECT_AUDIENCE
 
 
-async def admin_broadcast_ask_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    context.user_data['broadcast_audience'] = query.data.split('_')[-1]
+async def _mode_prompt(audience: str, value=None):
+    text = (
+        f"مخاطبان: {segment_label(audience, value)}\n"
+        f"تعداد: {await segment_count(audience, value)} نفر\n\n"
+        "لطفا نوع ارسال را انتخاب کنید:"
+    )
     keyboard = [
         [InlineKeyboardButton("ارسال به صورت کپی", callback_data="broadcast_mode_copy")],
         [InlineKeyboardButton("ارسال به صورت فوروارد", callback_data="broadcast_mode_forward")],
-        [InlineKeyboardButton("\U0001F519 بازگشت", callback_data="admin_main")],
+        [InlineKeyboardButton("\U0001F519 بازگشت", callback_data="admin_broadcast_menu")],
     ]
-    await _safe_edit_text(query.message, "لطفا نوع ارسال را انتخاب کنید:", reply_markup=InlineKeyboardMarkup(keyboard))
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+async def admin_broadcast_ask_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    audience = query.data.replace('broadcast_seg_', '')
+    if audience not in SEGMENTS:
+        await query.answer("بخش نامعتبر است.", show_alert=True)
+        return BROADCAST_SELECT_AUDIENCE
+    context.user_data['broadcast_audience'] = audience
+    context.user_data.pop('broadcast_audience_value', None)
+    param = SEGMENTS[audience].get('param')
+    if param == 'panel':
+        counts = panel_segment_counts()
+        panels = await aquery_db("SELECT id, name FROM panels ORDER BY id") or []
+        keyboard = [
+            [InlineKeyboardButton(
+                f"{p['name']} ({counts.get(p['id'], 0)})" if counts is not None else p['name'],
+                callback_data=f"broadcast_panel_{p['id']}",
+            )]
+            for p in panels
+        ]
+        keyboard.append([InlineKeyboardButton("\U0001F519 بازگشت", callback_data="admin_broadcast_menu")])
+        await _safe_edit_text(query.message, "پنل مورد نظر را انتخاب کنید:", reply_markup=InlineKeyboardMarkup(keyboard))
+        return BROADCAST_SELECT_AUDIENCE
+    if param:
+        await _safe_edit_text(query.message, SEGMENTS[audience]['prompt'] + " (برای لغو /cancel را بفرستید)")
+        return BROADCAST_AWAIT_SEGMENT_VALUE
+    text, markup = await _mode_prompt(audience)
+    await _safe_edit_text(query.message, text, reply_markup=markup)
+    return BROADCAST_SELECT_MODE
+
+
+async def admin_broadcast_select_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    panel_id = int(query.data.replace('broadcast_panel_', ''))
+    context.user_data['broadcast_audience'] = 'panel'
+    context.user_data['broadcast_audience_value'] = panel_id
+    text, markup = await _mode_prompt('panel', panel_id)
+    await _safe_edit_text(query.message, text, reply_markup=markup)
+    return BROADCAST_SELECT_MODE
+
+
+async def admin_broadcast_receive_segment_value(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    audience = context.user_data.get('broadcast_audience')
+    if audience not in SEGMENTS:
+        await update.message.reply_text("ابتدا مخاطب ارسال را انتخاب کنید.")
+        return ADMIN_MAIN_MENU
+    try:
+        value = int(_normalize_digits(update.message.text or '').strip().replace(',', ''))
+        if value < 0:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("لطفا یک عدد صحیح معتبر ارسال کنید.")
+        return BROADCAST_AWAIT_SEGMENT_VALUE
+    context.user_data['broadcast_audience_value'] = value
+    text, markup = await _mode_prompt(audience, value)
+    await update.message.reply_text(text, reply_markup=markup)
     return BROADCAST_SELECT_MODE
 
 
@@ -44,27 +122,41 @@ async def admin_broadcast_execute(update: Update, context: ContextTypes.DEFAULT_
     if not audience:
         await update.message.reply_text("ابتدا مخاطب ارسال را انتخاب کنید.")
         return ADMIN_MAIN_MENU
-    users = []
-    if audience == 'buyers':
-        users = query_db("SELECT DISTINCT user_id FROM orders WHERE status='approved'")
-    else:
-        users = query_db("SELECT user_id FROM users")
-    sent = 0
-    for u in users or []:
-        uid = u['user_id']
-        try:
-            if mode == 'forward':
-                await context.bot.forward_message(chat_id=uid, from_chat_id=update.message.chat_id, message_id=update.message.message_id)
-            else:
-                await context.bot.copy_message(chat_id=uid, from_chat_id=update.message.chat_id, message_id=update.message.message_id)
-            sent += 1
-        except Exception:
-            pass
-    await update.message.reply_text(f"✅ ارسال انجام شد. ({sent} نفر)")
+    # Sending happens in a background job (see broadcast.py); this handler returns at once
+    broadcast_id = await create_broadcast(
+        update.effective_user.id, audience, mode, update.message.chat_id, update.message.message_id,
+        context.user_data.get('broadcast_audience_value'),
+    )
+    if not broadcast_id:
+        await update.message.reply_text("\u274C خطا در ثبت ارسال همگانی.")
+        return ADMIN_MAIN_MENU
+    b = get_broadcast(broadcast_id)
+    progress = await update.message.reply_text(progress_text(b), reply_markup=progress_keyboard(b))
+    set_progress_message(broadcast_id, progress.chat_id, progress.message_id)
+    start_broadcast(context.bot, broadcast_id)
     context.user_data.pop('broadcast_audience', None)
+    context.user_data.pop('broadcast_audience_value', None)
     return ADMIN_MAIN_MENU
 
 
+async def admin_broadcast_control(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    if query.from_user.id not in get_all_admin_ids():
+        await query.answer()
+        return
+    _, action, broadcast_id = query.data.split('_')
+    broadcast_id = int(broadcast_id)
+    target = {'pause': 'paused', 'resume': 'running', 'cancel': 'cancelled'}[action]
+    if not set_broadcast_status(broadcast_id, target):
+        await query.answer("این عملیات برای وضعیت فعلی ممکن نیست.", show_alert=True)
+        return
+    await query.answer()
+    if target == 'running':
+        start_broadcast(context.bot, broadcast_id)
+    b = get_broadcast(broadcast_id)
+    await _safe_edit_text(query.message, progress_text(b), reply_markup=progress_keyboard(b))
+
+
 async def admin_stats_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
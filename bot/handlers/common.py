@@ -3,11 +3,12 @@ from telegram.constants import ParseMode
 from telegram.error import TelegramError
 from telegram.ext import ContextTypes, ApplicationHandlerStop
 
-from ..config import ADMIN_ID, CHANNEL_ID, CHANNEL_USERNAME, logger
-from ..db import query_db
+from ..config import CHANNEL_ID, CHANNEL_USERNAME, logger
 from ..utils import register_new_user
+from ..admins import is_admin
 from ..helpers.flow import get_flow
-from ..helpers.keyboards import build_start_menu_keyboard
+from ..helpers.membership import get_channel_chat, is_channel_member
+from ..helpers.keyboards import build_start_menu_keyboard, get_rendered_message, is_dynamic_message
 
 
 async def force_join_checker(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -15,16 +16,9 @@ async def force_join_checker(update: Update, context: ContextTypes.DEFAULT_TYPE)
 	if not user:
 		return
 	# Bypass channel join for any admin (primary or additional)
-	if user.id == ADMIN_ID:
+	if is_admin(user.id):
 		logger.debug(f"force_join_checker: admin {user.id} bypassed")
 		return
-	try:
-		extra_admin = query_db("SELECT 1 FROM admins WHERE user_id = ?", (user.id,), one=True)
-		if extra_admin:
-			logger.debug(f"force_join_checker: extra admin {user.id} bypassed")
-			return
-	except Exception:
-		pass
 	# Capture referral payload from /start before blocking join
 	try:
 		if update.message and update.message.text:
@@ -40,11 +34,10 @@ async def force_join_checker(update: Update, context: ContextTypes.DEFAULT_TYPE)
 	if ud.get('awaiting') or ud.get('awaiting_admin') or ud.get('awaiting_ticket') or get_flow(context):
 		logger.debug(f"force_join_checker: skip join check for user {user.id} due to active flow flags: {list(k for k,v in ud.items() if v)}")
 		return
-	from ..config import CHANNEL_CHAT as _CHAT
-	chat_id = _CHAT if _CHAT is not None else (CHANNEL_ID or CHANNEL_USERNAME)
+	# "عضو شدم" must see a fresh answer; everything else may use the cached one
+	fresh = bool(update.callback_query and update.callback_query.data == 'check_join')
 	try:
-		member = await context.bot.get_chat_member(chat_id=chat_id, user_id=user.id)
-		if member.status in ['member', 'administrator', 'creator']:
+		if await is_channel_member(context.bot, user.id, fresh=fresh):
 			return
 	except TelegramError as e:
 		# If we cannot verify, keep user blocked and show join info instead of allowing silently
@@ -54,7 +47,7 @@ async def force_join_checker(update: Update, context: ContextTypes.DEFAULT_TYPE)
 	join_url = None
 	channel_hint = ""
 	try:
-		chat_obj = await context.bot.get_chat(chat_id=chat_id)
+		chat_obj = await get_channel_chat(context.bot)
 		uname = getattr(chat_obj, 'username', None)
 		inv = getattr(chat_obj, 'invite_link', None)
 		if uname:
@@ -95,46 +88,15 @@ async def force_join_checker(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def send_dynamic_message(update: Update, context: ContextTypes.DEFAULT_TYPE, message_name: str, back_to: str = 'start_main'):
 	query = update.callback_query
 
-	message_data = query_db("SELECT text, file_id, file_type FROM messages WHERE message_name = ?", (message_name,), one=True)
-	if not message_data:
+	rendered = get_rendered_message(message_name, back_to=back_to)
+	if not rendered:
 		await query.answer(f"محتوای '{message_name}' یافت نشد!", show_alert=True)
 		return
 
-	text = message_data.get('text')
-	file_id = message_data.get('file_id')
-	file_type = message_data.get('file_type')
-
-	buttons_data = query_db(
-		"SELECT text, target, is_url, row, col FROM buttons WHERE menu_name = ? ORDER BY row, col",
-		(message_name,),
-	)
-
-	if message_name == 'start_main':
-		trial_status = query_db("SELECT value FROM settings WHERE key = 'free_trial_status'", one=True)
-		if not trial_status or trial_status.get('value') != '1':
-			buttons_data = [b for b in buttons_data if b.get('target') != 'get_free_config']
-
-	keyboard = []
-	if buttons_data:
-		max_row = max((b['row'] for b in buttons_data), default=0) if buttons_data else 0
-		keyboard_rows = [[] for _ in range(max_row + 1)]
-		for b in buttons_data:
-			btn = (
-				InlineKeyboardButton(b['text'], url=b['target'])
-				if b['is_url']
-				else InlineKeyboardButton(b['text'], callback_data=b['target'])
-			)
-			if 0 < b['row'] <= len(keyboard_rows):
-				keyboard_rows[b['row'] - 1].append(btn)
-		keyboard = [row for row in keyboard_rows if row]
-
-	if message_name == 'start_main':
-		# For start_main, the dynamic keyboard builder handles everything
-		reply_markup = build_start_menu_keyboard()
-	else:
-		keyboard.append([InlineKeyboardButton("\U0001F519 بازگشت", callback_data=back_to)])
-		reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
-
+	text = rendered['text']
+	file_id = rendered['file_id']
+	file_type = rendered['file_type']
+	reply_markup = rendered['reply_markup']
 
 	try:
 		if file_id or (query.message and (query.message.photo or query.message.video or query.message.document)):
@@ -185,8 +147,8 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	if not sender:
 		pass
 
-	message_data = query_db("SELECT text FROM messages WHERE message_name = 'start_main'", one=True)
-	text = message_data.get('text') if message_data else "خوش آمدید!"
+	rendered = get_rendered_message('start_main')
+	text = rendered['text'] if rendered else "خوش آمدید!"
 
 	reply_markup = build_start_menu_keyboard()
 
@@ -211,7 +173,7 @@ async def dynamic_button_handler(update: Update, context: ContextTypes.DEFAULT_T
 
 	# First, check if the callback data corresponds to a dynamic message.
 	# This is safer than a blacklist of prefixes.
-	if query_db("SELECT 1 FROM messages WHERE message_name = ?", (message_name,), one=True):
+	if is_dynamic_message(message_name):
 		await query.answer()
 		await send_dynamic_message(update, context, message_name=message_name, back_to='start_main')
 		# Stop further handlers from processing this update
@@ -4,13 +4,15 @@ from telegram.constants import ParseMode
 from telegram.ext import ContextTypes, ConversationHandler
 from telegram.error import BadRequest
 
-from ..db import query_db, execute_db
+from ..db import query_db, execute_db, aquery_db, aexecute_db, arun_transaction
+from ..settings import get_setting, get_settings, set_settings
 from ..handlers.common import start_command
 from ..states import SELECT_PLAN, AWAIT_DISCOUNT_CODE, AWAIT_PAYMENT_SCREENSHOT, RENEW_AWAIT_PAYMENT, SELECT_PAYMENT_METHOD
 from ..config import NOBITEX_TOKEN, logger, ADMIN_ID
 from ..helpers.tg import safe_edit_text as _safe_edit, ltr_code, notify_admins
 from ..helpers.flow import set_flow, clear_flow
-from .admin import auto_approve_wallet_order
+from .admin import auto_approve_panel_id, send_wallet_order_to_admins
+from ..provisioning import enqueue_provisioning
 
 
 def _strike_text(text: str) -> str:
@@ -296,10 +298,9 @@ def _fetch_nobitex_usd_irt() -> float:
 
 def _fetch_usdt_irt_price() -> float:
     # Priority based on mode: manual or api; then cached
-    from ..db import query_db as _q, execute_db as _x
-    mode = ((_q("SELECT value FROM settings WHERE key = 'usd_irt_mode'", one=True) or {}).get('value') or 'manual').lower()
+    mode = (get_setting('usd_irt_mode') or 'manual').lower()
     if mode == 'manual':
-        manual = (_q("SELECT value FROM settings WHERE key = 'usd_irt_manual'", one=True) or {}).get('value') or ''
+        manual = get_setting('usd_irt_manual') or ''
         try:
             rate = float(manual.strip()) if manual.strip() else 0.0
             if rate > 0:
@@ -309,14 +310,13 @@ def _fetch_usdt_irt_price() -> float:
     else:
         price = _fetch_nobitex_usd_irt()
         if price > 0:
-            try:
-                _x("UPDATE settings SET value = ? WHERE key = 'usd_irt_cached'", (str(int(price)),))
-                _x("UPDATE settings SET value = ? WHERE key = 'usd_irt_cached_ts'", (datetime.now().isoformat(timespec='seconds'),))
-            except Exception:
-                pass
+            set_settings({
+                'usd_irt_cached': str(int(price)),
+                'usd_irt_cached_ts': datetime.now().isoformat(timespec='seconds'),
+            })
             return price
     # Cached fallback
-    cached = (_q("SELECT value FROM settings WHERE key = 'usd_irt_cached'", one=True) or {}).get('value') or ''
+    cached = get_setting('usd_irt_cached') or ''
     try:
         c = float(cached.strip()) if cached.strip() else 0.0
         if c > 0:
@@ -335,7 +335,7 @@ async def show_payment_method_selection(update: Update, context: ContextTypes.DE
         await update.effective_message.reply_text("خطا! قیمت نهایی مشخص نیست. لطفا از ابتدا شروع کنید.")
         return await cancel_flow(update, context)
 
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+    settings = get_settings()
     pay_card = settings.get('pay_card_enabled', '1') == '1'
     pay_crypto = settings.get('pay_crypto_enabled', '1') == '1'
     pay_gateway = settings.get('pay_gateway_enabled', '0') == '1'
@@ -364,6 +364,26 @@ async def show_payment_method_selection(update: Update, context: ContextTypes.DE
     return SELECT_PAYMENT_METHOD
 
 
+def _debit_wallet(conn, user_id: int, amount: int):
+    """Take `amount` from the wallet and log it, in one transaction. Returns the new balance,
+    or None when the balance is short (nothing is written then)."""
+    # Users who never topped up have no wallet row; a free order must still go through
+    conn.execute("INSERT OR IGNORE INTO user_wallets (user_id, balance) VALUES (?, 0)", (user_id,))
+    # The balance check lives in the UPDATE itself, so two concurrent payments can't both pass it
+    cur = conn.execute(
+        "UPDATE user_wallets SET balance = balance - ? WHERE user_id = ? AND balance >= ?",
+        (amount, user_id, amount),
+    )
+    if cur.rowcount != 1:
+        return None
+    conn.execute(
+        "INSERT INTO wallet_transactions (user_id, amount, direction, method, status, created_at) VALUES (?, ?, 'debit', 'wallet', 'approved', ?)",
+        (user_id, amount, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+    )
+    row = conn.execute("SELECT balance FROM user_wallets WHERE user_id = ?", (user_id,)).fetchone()
+    return row['balance']
+
+
 async def pay_method_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
@@ -372,9 +392,15 @@ async def pay_method_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if final_price is None:
         await query.message.edit_text("خطا: قیمت نهایی یافت نشد. از ابتدا شروع کنید.")
         return ConversationHandler.END
-    bal_row = query_db("SELECT balance FROM user_wallets WHERE user_id = ?", (user.id,), one=True)
-    balance = bal_row.get('balance') if bal_row else 0
-    if balance < int(final_price):
+    try:
+        new_bal = await arun_transaction(_debit_wallet, user.id, int(final_price))
+    except Exception as e:
+        logger.error(f"Wallet debit for user {user.id} failed: {e}")
+        await query.message.edit_text("خطا در پرداخت از کیف پول. لطفا دوباره تلاش کنید.")
+        return SELECT_PAYMENT_METHOD
+    if new_bal is None:
+        bal_row = await aquery_db("SELECT balance FROM user_wallets WHERE user_id = ?", (user.id,), one=True)
+        balance = bal_row.get('balance') if bal_row else 0
         kb = [
             [InlineKeyboardButton("\U0001F4B3 شارژ کیف پول", callback_data='wallet_menu')],
             [InlineKeyboardButton("\U0001F519 بازگشت", callback_data='buy_config_main')],
@@ -382,11 +408,6 @@ async def pay_method_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.message.edit_text(f"\u26A0\uFE0F موجودی کیف پول کافی نیست.\nموجودی: {balance:,} تومان\nمبلغ موردنیاز: {int(final_price):,} تومان", reply_markup=InlineKeyboardMarkup(kb))
         return SELECT_PAYMENT_METHOD
 
-    # Deduct and log transaction
-    execute_db("INSERT OR IGNORE INTO user_wallets (user_id, balance) VALUES (?, 0)", (user.id,))
-    execute_db("UPDATE user_wallets SET balance = balance - ? WHERE user_id = ?", (int(final_price), user.id))
-    execute_db("INSERT INTO wallet_transactions (user_id, amount, direction, method, status, created_at) VALUES (?, ?, 'debit', 'wallet', 'approved', ?)", (user.id, int(final_price), datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-
     is_renewal = context.user_data.get('renewing_order_id')
     if is_renewal:
         order_id = context.user_data.get('renewing_order_id')
@@ -394,14 +415,13 @@ async def pay_method_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE)
         if not order_id or not plan_id:
             await query.message.edit_text("خطا در فرآیند تمدید. دوباره تلاش کنید.")
             return ConversationHandler.END
-        plan = query_db("SELECT * FROM plans WHERE id = ?", (plan_id,), one=True)
+        plan = await aquery_db("SELECT * FROM plans WHERE id = ?", (plan_id,), one=True)
         await notify_admins(context.bot,
             text=(f"\u2757 **درخواست تمدید** (برای سفارش #{order_id})\n\n**پلن تمدید:** {plan['name']}\n\U0001F4B0 **مبلغ:** {int(final_price):,} تومان\n\U0001F4B3 **روش:** کیف پول\n\nلطفا پس از بررسی، تمدید را تایید کنید:"),
             parse_mode=ParseMode.MARKDOWN,
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("\u2705 تایید و تمدید سرویس", callback_data=f"approve_renewal_{order_id}_{plan_id}")]]),
         )
         # Show remaining balance
-        new_bal = (balance - int(final_price))
         await query.message.edit_text(f"\u2705 پرداخت از کیف پول ثبت شد و برای تایید به ادمین ارسال شد.\nموجودی فعلی: {new_bal:,} تومان")
         context.user_data.clear()
         await start_command(update, context)
@@ -413,110 +433,23 @@ async def pay_method_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not plan_id:
         await query.message.edit_text("خطا: پلن انتخابی یافت نشد.")
         return ConversationHandler.END
-    # Create order first so we can attempt auto-approval on Sanaei/X-UI panels
-    order_id = execute_db(
+    # Create order first so it can be auto-delivered on Netico/X-UI panels
+    order_id = await aexecute_db(
         "INSERT INTO orders (user_id, plan_id, timestamp, final_price, discount_code) VALUES (?, ?, ?, ?, ?)",
         (user.id, plan_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), int(final_price), discount_code),
     )
 
-    # Check if there's a Netico panel first
-    netico_panel = query_db(
-        "SELECT * FROM panels WHERE panel_type = 'netico' LIMIT 1",
-        one=True
-    )
-    
-    if netico_panel:
-        # For Netico panels, always try to create service directly
-        # try:
-        auto_approved = await auto_approve_wallet_order(order_id, context, user)
-        if auto_approved:
-            # On success: mark reseller usage and apply referral bonus
-            try:
-                r = query_db("SELECT max_purchases, used_purchases FROM resellers WHERE user_id = ?", (user.id,), one=True)
-                if r and int(r.get('used_purchases') or 0) < int(r.get('max_purchases') or 0):
-                    execute_db("UPDATE resellers SET used_purchases = used_purchases + 1 WHERE user_id = ?", (user.id,))
-                    execute_db("UPDATE orders SET reseller_applied = 1 WHERE id = ?", (order_id,))
-            except Exception:
-                pass
-            try:
-                from .admin import _apply_referral_bonus
-                await _apply_referral_bonus(order_id, context)
-            except Exception:
-                pass
-            # Inform user balance
-            new_bal = (balance - int(final_price))
-            await query.message.edit_text(
-                f"\u2705 پرداخت با کیف پول انجام شد و سرویس به صورت خودکار ساخته و ارسال شد.\nموجودی فعلی: {new_bal:,} تومان"
-            )
-            context.user_data.clear()
-            await start_command(update, context)
-            return ConversationHandler.END
-        else:
-            # If Netico service creation failed, inform the user
-            execute_db("DELETE FROM orders WHERE id = ?", (order_id,))
-            await query.message.edit_text(
-                f"\u26A0\uFE0F خطا در ایجاد سرویس. لطفاً دوباره تلاش کنید یا با پشتیبانی تماس بگیرید."
-            )
-            context.user_data.clear()
-            await start_command(update, context)
-            return ConversationHandler.END
-        # except Exception as e:
-        #     logger.error(f"Error creating Netico service: {str(e)}")
-        #     execute_db("DELETE FROM orders WHERE id = ?", (order_id,))
-        #     await query.message.edit_text(
-        #         f"\u26A0\uFE0F خطا در ایجاد سرویس. لطفاً دوباره تلاش کنید یا با پشتیبانی تماس بگیرید."
-        #     )
-        #     context.user_data.clear()
-        #     await start_command(update, context)
-        #     return ConversationHandler.END
+    # Deliver in the background when a panel can take the order automatically (provisioning.py)
+    panel_id = auto_approve_panel_id()
+    job_id = await enqueue_provisioning(order_id, 'wallet', panel_id=panel_id) if panel_id else None
+    if job_id:
+        await query.message.edit_text(
+            f"\u2705 پرداخت با کیف پول انجام شد.\n\u23F3 سرویس شما در حال ساخت است و به محض آماده شدن برایتان ارسال می‌شود.\nموجودی فعلی: {new_bal:,} تومان"
+        )
     else:
-        # For other panel types, try auto-approval
-        auto_approved = False
-        try:
-            auto_approved = await auto_approve_wallet_order(order_id, context, user)
-        except Exception:
-            auto_approved = False
-
-        if auto_approved:
-            # On success: mark reseller usage and apply referral bonus
-            try:
-                r = query_db("SELECT max_purchases, used_purchases FROM resellers WHERE user_id = ?", (user.id,), one=True)
-                if r and int(r.get('used_purchases') or 0) < int(r.get('max_purchases') or 0):
-                    execute_db("UPDATE resellers SET used_purchases = used_purchases + 1 WHERE user_id = ?", (user.id,))
-                    execute_db("UPDATE orders SET reseller_applied = 1 WHERE id = ?", (order_id,))
-            except Exception:
-                pass
-            try:
-                from .admin import _apply_referral_bonus
-                await _apply_referral_bonus(order_id, context)
-            except Exception:
-                pass
-            # Inform user balance
-            new_bal = (balance - int(final_price))
-            await query.message.edit_text(
-                f"\u2705 پرداخت با کیف پول انجام شد و سرویس به صورت خودکار ساخته و ارسال شد.\nموجودی فعلی: {new_bal:,} تومان"
-            )
-            context.user_data.clear()
-            await start_command(update, context)
-            return ConversationHandler.END
-
         # Fallback: auto-approval not possible -> proceed with manual admin approval
-        plan = query_db("SELECT * FROM plans WHERE id = ?", (plan_id,), one=True)
-        user_info = f"\U0001F464 **کاربر:** {user.mention_html()}\n\U0001F194 **آیدی:** `{user.id}`"
-        plan_info = f"\U0001F4CB **پلن:** {plan['name']}"
-        price_info = f"\U0001F4B0 **مبلغ پرداختی:** {int(final_price):,} تومان\n\U0001F4B3 **روش:** کیف پول"
-        await notify_admins(context.bot,
-            text=(f"\U0001F514 **درخواست خرید جدید** (سفارش #{order_id})\n\n{user_info}\n\n{plan_info}\n{price_info}\n\nلطفا نتیجه را اعلام کنید:"),
-            parse_mode=ParseMode.HTML,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("\u2705 تأیید و ارسال خودکار", callback_data=f"approve_auto_{order_id}")],
-                [InlineKeyboardButton("\U0001F4DD تأیید و ارسال دستی", callback_data=f"approve_manual_{order_id}")],
-                [InlineKeyboardButton("\u274C رد درخواست", callback_data=f"reject_order_{order_id}")],
-            ]),
-        )
-    # Deduct balance and log transaction already happened at the beginning of the function
-    new_bal = (balance - int(final_price))
-    await query.message.edit_text(f"\u2705 پرداخت از کیف پول ثبت شد و برای تایید به ادمین ارسال شد.\nموجودی فعلی: {new_bal:,} تومان")
+        await send_wallet_order_to_admins(context.bot, order_id)
+        await query.message.edit_text(f"\u2705 پرداخت از کیف پول ثبت شد و برای تایید به ادمین ارسال شد.\nموجودی فعلی: {new_bal:,} تومان")
     context.user_data.clear()
     await start_command(update, context)
     return ConversationHandler.END
@@ -645,7 +578,7 @@ async def show_payment_info_gateway(update: Update, context: ContextTypes.DEFAUL
         await update.effective_message.reply_text("خطا! قیمت نهایی مشخص نیست. لطفا از ابتدا شروع کنید.")
         return await cancel_flow(update, context)
 
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+    settings = get_settings()
     gateway_type = (settings.get('gateway_type') or 'zarinpal').lower()
     callback_url = (settings.get('gateway_callback_url') or '').strip()
 
@@ -896,14 +829,14 @@ async def gateway_verify_purchase(update: Update, context: ContextTypes.DEFAULT_
         await query.message.edit_text("خطا: اطلاعات پرداخت یافت نشد.")
         return SELECT_PAYMENT_METHOD
     if gw.get('type') == 'zarinpal':
-        settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+        settings = get_settings()
         merchant_id = settings.get('zarinpal_merchant_id') or ''
         ok, ref_id = _zarinpal_verify(merchant_id, gw.get('amount_rial', 0), gw.get('authority', ''))
         if not ok:
             await query.message.edit_text("پرداخت تایید نشد. اگر پرداخت کرده‌اید چند لحظه دیگر دوباره بررسی کنید یا از روش‌های دیگر استفاده کنید.")
             return SELECT_PAYMENT_METHOD
     elif gw.get('type') == 'aghapay':
-        settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+        settings = get_settings()
         pin = settings.get('aghapay_pin') or ''
         ok = _aghapay_verify(pin, int(context.user_data.get('final_price', 0)), gw.get('transid', ''))
         if not ok:
@@ -963,14 +896,14 @@ async def gateway_verify_renewal(update: Update, context: ContextTypes.DEFAULT_T
         await query.message.edit_text("خطا: اطلاعات پرداخت یافت نشد.")
         return RENEW_AWAIT_PAYMENT
     if gw.get('type') == 'zarinpal':
-        settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+        settings = get_settings()
         merchant_id = settings.get('zarinpal_merchant_id') or ''
         ok, ref_id = _zarinpal_verify(merchant_id, gw.get('amount_rial', 0), gw.get('authority', ''))
         if not ok:
             await query.message.edit_text("پرداخت تایید نشد. اگر پرداخت کرده‌اید کمی بعد دوباره بررسی کنید.")
             return RENEW_AWAIT_PAYMENT
     elif gw.get('type') == 'aghapay':
-        settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+        settings = get_settings()
         pin = settings.get('aghapay_pin') or ''
         ok = _aghapay_verify(pin, int(context.user_data.get('final_price', 0)), gw.get('transid', ''))
         if not ok:
@@ -10,6 +10,7 @@ from ..states import (
     RENEW_AWAIT_PAYMENT,
 )
 from ..panel import VpnPanelAPI
+from ..panel_http import run_blocking
 from ..helpers.flow import set_flow, clear_flow
 from ..helpers.tg import notify_admins
 
@@ -166,11 +167,11 @@ async def process_renewal_for_order(order_id: int, plan_id: int, context: Contex
                     add_days = 0
                 # Prefer recreate strategy first for 3x-UI for maximum compatibility
                 if hasattr(api, 'renew_by_recreate_on_inbound'):
-                    renewed_user, message = api.renew_by_recreate_on_inbound(inbound_id, marz_username, add_gb, add_days)
+                    renewed_user, message = await run_blocking(api.renew_by_recreate_on_inbound, inbound_id, marz_username, add_gb, add_days)
                     if not renewed_user and hasattr(api, 'renew_user_on_inbound'):
-                        renewed_user, message = api.renew_user_on_inbound(inbound_id, marz_username, add_gb, add_days)
+                        renewed_user, message = await run_blocking(api.renew_user_on_inbound, inbound_id, marz_username, add_gb, add_days)
                 elif hasattr(api, 'renew_user_on_inbound'):
-                    renewed_user, message = api.renew_user_on_inbound(inbound_id, marz_username, add_gb, add_days)
+                    renewed_user, message = await run_blocking(api.renew_user_on_inbound, inbound_id, marz_username, add_gb, add_days)
                 else:
                     renewed_user, message = await api.renew_user_in_panel(marz_username, plan)
             else:
@@ -190,10 +191,10 @@ async def process_renewal_for_order(order_id: int, plan_id: int, context: Contex
                 add_days = 0
             # Try updateClient/{uuid} first
             if hasattr(api, 'renew_user_on_inbound'):
-                renewed_user, message = api.renew_user_on_inbound(inbound_id, marz_username, add_gb, add_days)
+                renewed_user, message = await run_blocking(api.renew_user_on_inbound, inbound_id, marz_username, add_gb, add_days)
             # Fallback to recreate strategy
             if not renewed_user and hasattr(api, 'renew_by_recreate_on_inbound'):
-                renewed_user, message = api.renew_by_recreate_on_inbound(inbound_id, marz_username, add_gb, add_days)
+                renewed_user, message = await run_blocking(api.renew_by_recreate_on_inbound, inbound_id, marz_username, add_gb, add_days)
         else:
             renewed_user, message = await api.renew_user_in_panel(marz_username, plan)
     else:
@@ -5,11 +5,15 @@ from telegram.constants import ParseMode
 from telegram.error import TelegramError
 from telegram.ext import ContextTypes, ConversationHandler, CallbackQueryHandler, MessageHandler, filters
 
-from ..db import query_db, execute_db
+from ..db import query_db, execute_db, aquery_db
+from ..settings import get_setting, get_settings
 from ..utils import register_new_user
 from ..helpers.flow import set_flow, clear_flow
 from ..helpers.keyboards import build_start_menu_keyboard
 from ..panel import VpnPanelAPI
+from ..panel_http import run_blocking
+from ..account_pool import XUI_POOL_TYPES, claim_pool_account
+from ..retry import poll
 from ..utils import bytes_to_gb
 from ..states import (
     WALLET_AWAIT_AMOUNT_CARD,
@@ -30,7 +34,6 @@ try:
     import qrcode
 except Exception:
     qrcode = None
-import time
 
 # Normalize Persian/Arabic digits to ASCII
 _DIGIT_MAP = str.maketrans({
@@ -97,8 +100,7 @@ async def get_free_config_handler(update: Update, context: ContextTypes.DEFAULT_
         return
 
     # Use admin-selected panel for free trials if set; fallback to first
-    cfg = query_db("SELECT value FROM settings WHERE key = 'free_trial_panel_id'", one=True)
-    sel_id = (cfg.get('value') if cfg else '') or ''
+    sel_id = get_setting('free_trial_panel_id') or ''
     first_panel = None
     if sel_id.isdigit():
         first_panel = query_db("SELECT id FROM panels WHERE id = ?", (int(sel_id),), one=True)
@@ -116,41 +118,38 @@ async def get_free_config_handler(update: Update, context: ContextTypes.DEFAULT_
     except Exception:
         pass
 
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings WHERE key LIKE 'free_trial_%'")}
+    settings = get_settings('free_trial_')
     trial_plan = {'traffic_gb': settings.get('free_trial_gb', '0.2'), 'duration_days': settings.get('free_trial_days', '1')}
 
     panel_api = VpnPanelAPI(panel_id=first_panel['id'])
 
-    # Quick precheck: ensure at least one inbound is visible to API (best-effort)
-    try:
-        pre_inb = getattr(panel_api, 'list_inbounds', lambda: (None, 'NA'))()
-        if isinstance(pre_inb, tuple):
-            pre_list, _ = pre_inb
-        else:
-            pre_list = pre_inb
-        if pre_list is None:
-            # continue; maybe API requires create to login first
-            pass
-    except Exception:
-        pass
+    # A ready client from the trial inbound's warm pool skips creating one (account_pool.py)
+    pooled = None
+    prow = query_db("SELECT panel_type FROM panels WHERE id = ?", (first_panel['id'],), one=True) or {}
+    trial_inb_val = str(get_setting('free_trial_inbound_id') or '')
+    if (prow.get('panel_type') or '').lower() in XUI_POOL_TYPES and trial_inb_val.isdigit():
+        pooled = await claim_pool_account(first_panel['id'], int(trial_inb_val), trial_plan)
 
-    try:
-        # For XUI-like panels, if a trial inbound is set, create on that inbound directly
-        prow = query_db("SELECT panel_type FROM panels WHERE id = ?", (first_panel['id'],), one=True) or {}
-        ptype = (prow.get('panel_type') or '').lower()
-        trial_inb_row = query_db("SELECT value FROM settings WHERE key='free_trial_inbound_id'", one=True)
-        trial_inb = int(trial_inb_row.get('value')) if (trial_inb_row and str(trial_inb_row.get('value') or '').isdigit()) else None
-        if ptype in ('xui','x-ui','3xui','3x-ui','alireza','txui','tx-ui','tx ui') and trial_inb is not None and hasattr(panel_api, 'create_user_on_inbound'):
-            username_created, sub_link, _msg = panel_api.create_user_on_inbound(trial_inb, user_id, trial_plan)
-            marzban_username, config_link, message = username_created, sub_link, _msg
-        else:
-            marzban_username, config_link, message = await panel_api.create_user(user_id, trial_plan)
-    except Exception as e:
-        await query.message.edit_text(
-            f"❌ ایجاد کاربر تست ناموفق بود.\nجزئیات: {e}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("\U0001F519 بازگشت به منو", callback_data='start_main')]]),
-        )
-        return
+    if pooled:
+        marzban_username, config_link, message = pooled['username'], pooled['sub_link'], "Success"
+    else:
+        try:
+            # For XUI-like panels, if a trial inbound is set, create on that inbound directly
+            prow = query_db("SELECT panel_type FROM panels WHERE id = ?", (first_panel['id'],), one=True) or {}
+            ptype = (prow.get('panel_type') or '').lower()
+            trial_inb_val = str(get_setting('free_trial_inbound_id') or '')
+            trial_inb = int(trial_inb_val) if trial_inb_val.isdigit() else None
+            if ptype in ('xui','x-ui','3xui','3x-ui','alireza','txui','tx-ui','tx ui') and trial_inb is not None and hasattr(panel_api, 'create_user_on_inbound'):
+                username_created, sub_link, _msg = await run_blocking(panel_api.create_user_on_inbound, trial_inb, user_id, trial_plan)
+                marzban_username, config_link, message = username_created, sub_link, _msg
+            else:
+                marzban_username, config_link, message = await panel_api.create_user(user_id, trial_plan)
+        except Exception as e:
+            await query.message.edit_text(
+                f"❌ ایجاد کاربر تست ناموفق بود.\nجزئیات: {e}",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("\U0001F519 بازگشت به منو", callback_data='start_main')]]),
+            )
+            return
 
     if config_link:
         plan_id_row = query_db("SELECT id FROM plans LIMIT 1", one=True)
@@ -162,9 +161,9 @@ async def get_free_config_handler(update: Update, context: ContextTypes.DEFAULT_
             prow = query_db("SELECT panel_type FROM panels WHERE id = ?", (first_panel['id'],), one=True) or {}
             ptype = (prow.get('panel_type') or '').lower()
             if ptype in ('xui','x-ui','3xui','3x-ui','alireza','txui','tx-ui','tx ui'):
-                trial_inb_row = query_db("SELECT value FROM settings WHERE key='free_trial_inbound_id'", one=True)
-                if trial_inb_row and str(trial_inb_row.get('value') or '').isdigit():
-                    xui_inb = int(trial_inb_row.get('value'))
+                trial_inb_val = str(get_setting('free_trial_inbound_id') or '')
+                if trial_inb_val.isdigit():
+                    xui_inb = int(trial_inb_val)
         except Exception:
             xui_inb = None
         if xui_inb is not None:
@@ -186,7 +185,7 @@ async def get_free_config_handler(update: Update, context: ContextTypes.DEFAULT_
         except Exception:
             ptype = ''
         if ptype in ('xui','x-ui','3xui','3x-ui','alireza','txui','tx-ui','tx ui'):
-            confs = []
+            confs = list(pooled['configs']) if pooled else []
             ib_id = None
             # Prefer selected trial inbound
             if xui_inb is not None:
@@ -194,25 +193,25 @@ async def get_free_config_handler(update: Update, context: ContextTypes.DEFAULT_
             else:
                 # Fallback: first inbound
                 try:
-                    inbs, _m = getattr(panel_api, 'list_inbounds', lambda: (None,'NA'))()
+                    inbs, _m = await run_blocking(getattr(panel_api, 'list_inbounds', lambda: (None,'NA')))
                     if inbs:
                         ib_id = inbs[0].get('id')
                 except Exception:
                     ib_id = None
-            if ib_id is not None and hasattr(panel_api, 'get_configs_for_user_on_inbound'):
+            if not confs and ib_id is not None and hasattr(panel_api, 'get_configs_for_user_on_inbound'):
                 try:
-                    confs = panel_api.get_configs_for_user_on_inbound(int(ib_id), marzban_username) or []
+                    confs = await run_blocking(panel_api.get_configs_for_user_on_inbound, int(ib_id), marzban_username) or []
                 except Exception:
                     confs = []
             if not confs and isinstance(config_link, str) and config_link.startswith('http'):
                 # Decode subscription content as a fallback
                 try:
-                    confs = _fetch_subscription_configs(config_link)
+                    confs = await run_blocking(_fetch_subscription_configs, config_link)
                 except Exception:
                     confs = []
             if confs:
                 cfg_text = "\n".join(f"<code>{c}</code>" for c in confs)
-                footer = ((query_db("SELECT value FROM settings WHERE key = 'config_footer_text'", one=True) or {}).get('value') or '')
+                footer = (get_setting('config_footer_text') or '')
                 text = (
                     f"✅ کانفیگ تست رایگان شما با موفقیت ساخته شد!\n\n"
                     f"<b>حجم:</b> {trial_plan['traffic_gb']} گیگابایت\n"
@@ -267,8 +266,10 @@ async def my_services_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
     user_id = query.from_user.id
 
-    orders = query_db(
-        "SELECT id, marzban_username, plan_id, COALESCE(is_trial, 0) AS is_trial FROM orders WHERE user_id = ? AND status = 'approved' AND marzban_username IS NOT NULL ORDER BY id DESC",
+    orders = await aquery_db(
+        "SELECT o.id, o.marzban_username, o.plan_id, COALESCE(o.is_trial, 0) AS is_trial, p.name AS plan_name "
+        "FROM orders o LEFT JOIN plans p ON p.id = o.plan_id "
+        "WHERE o.user_id = ? AND o.status = 'approved' AND o.marzban_username IS NOT NULL ORDER BY o.id DESC",
         (user_id,),
     )
 
@@ -285,11 +286,10 @@ async def my_services_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         text = "سرویس فعال شما:"
 
     for order in orders:
-        plan = query_db("SELECT name FROM plans WHERE id = ?", (order['plan_id'],), one=True)
         if int(order.get('is_trial') or 0) == 1:
             plan_name = "سرویس تست"
         else:
-            plan_name = plan['name'] if plan else "سرویس ویژه"
+            plan_name = order.get('plan_name') or "سرویس ویژه"
         button_text = f"{plan_name} ({order['marzban_username']})"
         keyboard.append([InlineKeyboardButton(button_text, callback_data=f"view_service_{order['id']}")])
 
@@ -384,13 +384,13 @@ async def show_specific_service_details(update: Update, context: ContextTypes.DE
                 if order.get('xui_inbound_id'):
                     ib_id = int(order['xui_inbound_id'])
                 else:
-                    inbounds, _m = panel_api.list_inbounds()
+                    inbounds, _m = await run_blocking(panel_api.list_inbounds)
                     if inbounds:
                         ib_id = inbounds[0].get('id')
                 if ib_id is not None:
-                    confs = panel_api.get_configs_for_user_on_inbound(ib_id, marzban_username) or []
+                    confs = await run_blocking(panel_api.get_configs_for_user_on_inbound, ib_id, marzban_username) or []
             if not confs and sub_link and isinstance(sub_link, str) and sub_link.startswith('http'):
-                confs = _fetch_subscription_configs(sub_link)
+                confs = await run_blocking(_fetch_subscription_configs, sub_link)
             if confs:
                 cfgs = "\n".join(f"<code>{c}</code>" for c in confs[:1])
                 # Try to also show subscription link under configs
@@ -453,7 +453,7 @@ async def refresh_service_link(update: Update, context: ContextTypes.DEFAULT_TYP
             # ensure login for 3x-UI
             if hasattr(panel_api, 'get_token'):
                 try:
-                    panel_api.get_token()
+                    await run_blocking(panel_api.get_token)
                 except Exception:
                     pass
             ib_id = None
@@ -461,7 +461,7 @@ async def refresh_service_link(update: Update, context: ContextTypes.DEFAULT_TYP
                 ib_id = int(order['xui_inbound_id'])
             else:
                 if hasattr(panel_api, 'list_inbounds'):
-                    inbounds, _m = panel_api.list_inbounds()
+                    inbounds, _m = await run_blocking(panel_api.list_inbounds)
                     if inbounds:
                         ib_id = inbounds[0].get('id')
             if ib_id is None:
@@ -473,12 +473,11 @@ async def refresh_service_link(update: Update, context: ContextTypes.DEFAULT_TYP
             # try multiple times to account for propagation
             confs = []
             if hasattr(panel_api, 'get_configs_for_user_on_inbound'):
-                for _ in range(4):
-                    pref_id = (order.get('xui_client_id') or None)
-                    confs = panel_api.get_configs_for_user_on_inbound(ib_id, order['marzban_username'], preferred_id=pref_id) or []
-                    if confs:
-                        break
-                    time.sleep(1.0)
+                pref_id = (order.get('xui_client_id') or None)
+                confs = await poll(
+                    lambda: run_blocking(panel_api.get_configs_for_user_on_inbound, ib_id, order['marzban_username'], preferred_id=pref_id),
+                    attempts=4, delay=1.0, timeout=10,
+                ) or []
             if not confs:
                 # decode subscription as fallback for display
                 user_info, message = await panel_api.get_user(order['marzban_username'])
@@ -487,7 +486,7 @@ async def refresh_service_link(update: Update, context: ContextTypes.DEFAULT_TYP
                         f"{panel_api.base_url}{user_info['subscription_url']}" if user_info.get('subscription_url') and not user_info['subscription_url'].startswith('http') else user_info.get('subscription_url', '')
                     )
                     if sub:
-                        confs = _fetch_subscription_configs(sub)
+                        confs = await run_blocking(_fetch_subscription_configs, sub)
             if not confs:
                 try:
                     await context.bot.send_message(chat_id=query.message.chat_id, text="ساخت کانفیگ ناموفق بود - کمی بعد دوباره تلاش کنید.")
@@ -552,7 +551,7 @@ async def revoke_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         # Try to ensure token if available
         if hasattr(panel_api, '_ensure_token'):
             try:
-                panel_api._ensure_token()
+                await run_blocking(panel_api._ensure_token)
             except Exception:
                 pass
         ok = False
@@ -570,24 +569,24 @@ async def revoke_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         if not ok and (order.get('xui_inbound_id') and hasattr(panel_api, 'rotate_user_key_on_inbound')):
             if hasattr(panel_api, 'get_token'):
                 try:
-                    panel_api.get_token()
+                    await run_blocking(panel_api.get_token)
                 except Exception:
                     pass
             try:
-                updated = panel_api.rotate_user_key_on_inbound(int(order['xui_inbound_id']), order['marzban_username'])
+                updated = await run_blocking(panel_api.rotate_user_key_on_inbound, int(order['xui_inbound_id']), order['marzban_username'])
                 ok = bool(updated)
             except Exception:
                 ok = False
         # 3x-UI rotate across inbounds as fallback
         if not ok and hasattr(panel_api, 'rotate_user_key'):
             try:
-                ok = bool(panel_api.rotate_user_key(order['marzban_username']))
+                ok = bool(await run_blocking(panel_api.rotate_user_key, order['marzban_username']))
             except Exception:
                 ok = False
         # Marzban fallback
         if not ok and hasattr(panel_api, 'revoke_subscription'):
             try:
-                ok, _msg = panel_api.revoke_subscription(order['marzban_username'])
+                ok, _msg = await run_blocking(panel_api.revoke_subscription, order['marzban_username'])
             except Exception:
                 ok = False
         if not ok:
@@ -612,7 +611,7 @@ async def revoke_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
                 ib_id = int(order['xui_inbound_id'])
             else:
                 try:
-                    inbounds, _m = panel_api.list_inbounds()
+                    inbounds, _m = await run_blocking(panel_api.list_inbounds)
                     if inbounds:
                         ib_id = inbounds[0].get('id')
                 except Exception:
@@ -620,7 +619,7 @@ async def revoke_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             if ib_id is None:
                 await query.answer("اینباندی یافت نشد", show_alert=True)
                 return ConversationHandler.END
-            new_client = panel_api.recreate_user_key_on_inbound(ib_id, order['marzban_username'])
+            new_client = await run_blocking(panel_api.recreate_user_key_on_inbound, ib_id, order['marzban_username'])
             if not new_client:
                 await query.answer("خطا در تغییر کلید", show_alert=True)
                 return ConversationHandler.END
@@ -634,7 +633,7 @@ async def revoke_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             try:
                 # Try to reuse X-UI/3x-UI config builder with preferred new id
                 if hasattr(panel_api, 'get_configs_for_user_on_inbound'):
-                    confs = panel_api.get_configs_for_user_on_inbound(ib_id, order['marzban_username'], preferred_id=(new_client.get('id') or new_client.get('uuid'))) or []
+                    confs = await run_blocking(panel_api.get_configs_for_user_on_inbound, ib_id, order['marzban_username'], preferred_id=(new_client.get('id') or new_client.get('uuid'))) or []
                 if confs:
                     cfg_text = "\n".join(f"<code>{c}</code>" for c in confs)
                     if qrcode:
@@ -750,7 +749,7 @@ async def _wallet_show_gateway_message(update: Update, context: ContextTypes.DEF
     if not amount:
         await update.message.reply_text("خطا: مبلغ یافت نشد.")
         return ConversationHandler.END
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+    settings = get_settings()
     gateway_type = (settings.get('gateway_type') or 'zarinpal').lower()
     callback_url = (settings.get('gateway_callback_url') or '').strip()
     amount_rial = int(amount) * 10
@@ -808,7 +807,7 @@ async def wallet_verify_gateway(update: Update, context: ContextTypes.DEFAULT_TY
         await query.message.edit_text("اطلاعات پرداخت یافت نشد.")
         return ConversationHandler.END
     ok = False
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+    settings = get_settings()
     if gw.get('type') == 'zarinpal':
         from .purchase import _zarinpal_verify
         ok, _ = _zarinpal_verify(settings.get('zarinpal_merchant_id') or '', gw.get('amount_rial', 0), gw.get('authority',''))
@@ -1073,8 +1072,7 @@ async def referral_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     link = f"https://t.me/{(await context.bot.get_me()).username}?start={uid}"
     total = query_db("SELECT COUNT(*) AS c FROM referrals WHERE referrer_id = ?", (uid,), one=True) or {'c': 0}
     buyers = query_db("SELECT COUNT(DISTINCT o.user_id) AS c FROM orders o JOIN referrals r ON r.referee_id = o.user_id WHERE r.referrer_id = ? AND o.status='approved'", (uid,), one=True) or {'c': 0}
-    cfg = query_db("SELECT value FROM settings WHERE key = 'referral_commission_percent'", one=True)
-    percent = int((cfg.get('value') if cfg else '10') or 10)
+    percent = int(get_setting('referral_commission_percent', '10') or 10)
     text = (
         "معرفی به دوستان\n\n"
         f"لینک اختصاصی شما:\n{link}\n\n"
@@ -1091,7 +1089,7 @@ async def reseller_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = query.from_user.id
     # Mark intent so direct uploads are accepted even if button wasn't pressed
     context.user_data['reseller_intent'] = True
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")} or {}
+    settings = get_settings()
     if settings.get('reseller_enabled', '1') != '1':
         await query.message.edit_text("قابلیت نمایندگی موقتا غیرفعال است.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("\U0001F519 بازگشت", callback_data='start_main')]]))
         return ConversationHandler.END
@@ -1149,7 +1147,7 @@ async def reseller_pay_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
     context.user_data['reseller_intent'] = True
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")} or {}
+    settings = get_settings()
     fee = int((settings.get('reseller_fee_toman') or '200000') or 200000)
     text = (
         f"پرداخت هزینه نمایندگی ({fee:,} تومان)\n\nروش پرداخت خود را انتخاب کنید:"
@@ -1167,7 +1165,7 @@ async def reseller_pay_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def reseller_pay_card(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")} or {}
+    settings = get_settings()
     fee = int((settings.get('reseller_fee_toman') or '200000') or 200000)
     cards = query_db("SELECT card_number, holder_name FROM cards") or []
     if not cards:
@@ -1186,7 +1184,7 @@ async def reseller_pay_card(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def reseller_pay_crypto(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")} or {}
+    settings = get_settings()
     fee = int((settings.get('reseller_fee_toman') or '200000') or 200000)
     wallets = query_db("SELECT asset, chain, address, memo FROM wallets ORDER BY id DESC") or []
     if not wallets:
@@ -1206,7 +1204,7 @@ async def reseller_pay_crypto(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def reseller_pay_gateway(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")} or {}
+    settings = get_settings()
     fee = int((settings.get('reseller_fee_toman') or '200000') or 200000)
     gateway_type = (settings.get('gateway_type') or 'zarinpal').lower()
     callback_url = (settings.get('gateway_callback_url') or '').strip()
@@ -1262,7 +1260,7 @@ async def reseller_verify_gateway(update: Update, context: ContextTypes.DEFAULT_
         await query.message.edit_text("اطلاعات پرداخت یافت نشد.")
         return ConversationHandler.END
     ok = False
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")} or {}
+    settings = get_settings()
     if gw.get('type') == 'zarinpal':
         from .purchase import _zarinpal_verify
         ok, ref_id = _zarinpal_verify(settings.get('zarinpal_merchant_id') or '', gw.get('amount_rial', 0), gw.get('authority',''))
@@ -1277,7 +1275,7 @@ async def reseller_verify_gateway(update: Update, context: ContextTypes.DEFAULT_
         return ConversationHandler.END
     # Log request and notify admins
     user = query.from_user
-    settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")} or {}
+    settings = get_settings()
     fee = int((settings.get('reseller_fee_toman') or '200000') or 200000)
     rr_id = execute_db(
         "INSERT INTO reseller_requests (user_id, amount, method, status, created_at, reference) VALUES (?, ?, ?, 'pending', ?, ?)",
@@ -1317,7 +1315,7 @@ async def reseller_upload_router(update: Update, context: ContextTypes.DEFAULT_T
     method = pay.get('method') or 'card'
     amount = int(pay.get('amount') or 0)
     if amount <= 0:
-        settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")} or {}
+        settings = get_settings()
         amount = int((settings.get('reseller_fee_toman') or '200000') or 200000)
     file_id = None
     caption_extra = ''
@@ -1544,7 +1542,7 @@ async def purchase_method_selected(update: Update, context: ContextTypes.DEFAULT
             return ConversationHandler.END
 
         # Attempt auto-approval
-        auto_approved = await auto_approve_wallet_order(order_id, context, update.effective_user)
+        auto_approved = await auto_approve_wallet_order(order_id, context)
 
         if auto_approved:
             # On success, now we can deduct balance and log the transaction
@@ -1585,7 +1583,7 @@ async def purchase_method_selected(update: Update, context: ContextTypes.DEFAULT
         return ConversationHandler.END
 
     if payment_method == 'gateway':
-        settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+        settings = get_settings()
         # ... existing code ...
 
 async def purchase_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1,30 +1,94 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from ..db import query_db
+from ..settings import get_setting
+
+# Rendered menus keyed by what they depend on. Markup objects are immutable, so one
+# instance can be sent to every user; the admin message/button editors call
+# invalidate_menu_cache() whenever `messages` or `buttons` change.
+_start_menu_cache: dict[bool, InlineKeyboardMarkup | None] = {}
+_message_cache: dict[tuple[str, str], dict | None] = {}
+_message_names: frozenset[str] | None = None
+
+
+def invalidate_menu_cache() -> None:
+    global _message_names
+    _start_menu_cache.clear()
+    _message_cache.clear()
+    _message_names = None
+
+
+def _rows_to_keyboard(buttons_data: list[dict]) -> list[list[InlineKeyboardButton]]:
+    if not buttons_data:
+        return []
+    max_row = max((b['row'] for b in buttons_data), default=0)
+    keyboard_rows = [[] for _ in range(max_row + 1)]
+    for b in buttons_data:
+        btn = (
+            InlineKeyboardButton(b['text'], url=b['target'])
+            if b['is_url']
+            else InlineKeyboardButton(b['text'], callback_data=b['target'])
+        )
+        if 0 < b['row'] <= len(keyboard_rows):
+            # Adjust for 1-based row from DB vs 0-based list index
+            keyboard_rows[b['row'] - 1].append(btn)
+    return [row for row in keyboard_rows if row]
+
+
+def is_dynamic_message(message_name: str) -> bool:
+    global _message_names
+    if _message_names is None:
+        _message_names = frozenset(r['message_name'] for r in (query_db("SELECT message_name FROM messages") or []))
+    return message_name in _message_names
+
+
+def get_rendered_message(message_name: str, back_to: str = 'start_main') -> dict | None:
+    """Return {'text', 'file_id', 'file_type', 'reply_markup'} for a dynamic message, or None."""
+    if message_name == 'start_main':
+        # The start menu keyboard also depends on the free-trial toggle; it has its own cache
+        key = (message_name, '')
+    else:
+        key = (message_name, back_to)
+    if key not in _message_cache:
+        message_data = query_db("SELECT text, file_id, file_type FROM messages WHERE message_name = ?", (message_name,), one=True)
+        if not message_data:
+            return None
+        rendered = {
+            'text': message_data.get('text'),
+            'file_id': message_data.get('file_id'),
+            'file_type': message_data.get('file_type'),
+            'reply_markup': None,
+        }
+        if message_name != 'start_main':
+            buttons_data = query_db(
+                "SELECT text, target, is_url, row, col FROM buttons WHERE menu_name = ? ORDER BY row, col",
+                (message_name,),
+            )
+            keyboard = _rows_to_keyboard(buttons_data)
+            keyboard.append([InlineKeyboardButton("\U0001F519 بازگشت", callback_data=back_to)])
+            rendered['reply_markup'] = InlineKeyboardMarkup(keyboard)
+        _message_cache[key] = rendered
+    rendered = _message_cache[key]
+    if message_name == 'start_main':
+        return {**rendered, 'reply_markup': build_start_menu_keyboard()}
+    return rendered
 
 
 def build_start_menu_keyboard() -> InlineKeyboardMarkup:
+    trial_enabled = get_setting('free_trial_status') == '1'
+    if trial_enabled not in _start_menu_cache:
+        _start_menu_cache[trial_enabled] = _render_start_menu_keyboard(trial_enabled)
+    return _start_menu_cache[trial_enabled]
+
+
+def _render_start_menu_keyboard(trial_enabled: bool) -> InlineKeyboardMarkup:
     buttons_data = query_db(
         "SELECT text, target, is_url, row, col FROM buttons WHERE menu_name = 'start_main' ORDER BY row, col"
     )
 
-    trial_status = query_db("SELECT value FROM settings WHERE key = 'free_trial_status'", one=True)
-    if not trial_status or trial_status.get('value') != '1':
+    if not trial_enabled:
         buttons_data = [b for b in buttons_data if b.get('target') != 'get_free_config']
 
-    keyboard = []
-    if buttons_data:
-        max_row = max((b['row'] for b in buttons_data), default=0)
-        keyboard_rows = [[] for _ in range(max_row + 1)]
-        for b in buttons_data:
-            btn = (
-                InlineKeyboardButton(b['text'], url=b['target'])
-                if b['is_url']
-                else InlineKeyboardButton(b['text'], callback_data=b['target'])
-            )
-            if 0 < b['row'] <= len(keyboard_rows):
-                # Adjust for 1-based row from DB vs 0-based list index
-                keyboard_rows[b['row'] - 1].append(btn)
-        keyboard = [row for row in keyboard_rows if row]
+    keyboard = _rows_to_keyboard(buttons_data)
 
     # --- Fallback Logic ---
     # Ensures core buttons are present if not defined in the database
@@ -34,7 +98,7 @@ def build_start_menu_keyboard() -> InlineKeyboardMarkup:
     top_row = []
     if missing('buy_config_main'):
         top_row.append(InlineKeyboardButton("\U0001F4E1 خرید کانفیگ", callback_data='buy_config_main'))
-    if trial_status and trial_status.get('value') == '1' and missing('get_free_config'):
+    if trial_enabled and missing('get_free_config'):
         top_row.append(InlineKeyboardButton("\U0001F381 دریافت تست", callback_data='get_free_config'))
     if top_row:
         keyboard.append(top_row)
@@ -0,0 +1,82 @@
+import time
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+
+from ..config import (
+    CHANNEL_CHAT,
+    CHANNEL_ID,
+    CHANNEL_USERNAME,
+    CHANNEL_MEMBER_TTL_SECONDS,
+    CHANNEL_NONMEMBER_TTL_SECONDS,
+    CHANNEL_INFO_TTL_SECONDS,
+    logger,
+)
+
+# Cache for the force-join gate. The gate runs on every update, so membership answers are
+# kept per user: members for CHANNEL_MEMBER_TTL_SECONDS, non-members only briefly so a user
+# who just joined gets through quickly (the "عضو شدم" button always asks Telegram again).
+# When the bot is an admin of the channel, chat_member updates refresh entries as they happen.
+# Failed lookups are not cached.
+
+_MEMBER_STATUSES = ('member', 'administrator', 'creator')
+_MAX_ENTRIES = 50000
+
+_members: dict[int, tuple[float, bool]] = {}  # user_id -> (expires_at, is_member)
+_chat_info = {'expires_at': 0.0, 'chat': None}
+
+
+def channel_chat_id():
+    return CHANNEL_CHAT if CHANNEL_CHAT is not None else (CHANNEL_ID or CHANNEL_USERNAME)
+
+
+def _remember(user_id: int, is_member: bool) -> None:
+    now = time.monotonic()
+    if len(_members) >= _MAX_ENTRIES:
+        for uid in [uid for uid, (expires_at, _) in _members.items() if expires_at <= now]:
+            del _members[uid]
+        if len(_members) >= _MAX_ENTRIES:
+            _members.clear()
+    ttl = CHANNEL_MEMBER_TTL_SECONDS if is_member else CHANNEL_NONMEMBER_TTL_SECONDS
+    _members[user_id] = (now + ttl, is_member)
+
+
+async def is_channel_member(bot, user_id: int, fresh: bool = False) -> bool:
+    """Whether the user is in the required channel; TelegramError propagates and is not cached."""
+    if not fresh:
+        cached = _members.get(user_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+    member = await bot.get_chat_member(chat_id=channel_chat_id(), user_id=user_id)
+    is_member = getattr(member, 'status', None) in _MEMBER_STATUSES
+    _remember(user_id, is_member)
+    return is_member
+
+
+async def get_channel_chat(bot):
+    """The channel's Chat (username / invite link for the join button), cached for hours."""
+    if _chat_info['chat'] is not None and _chat_info['expires_at'] > time.monotonic():
+        return _chat_info['chat']
+    chat = await bot.get_chat(chat_id=channel_chat_id())
+    _chat_info['chat'] = chat
+    _chat_info['expires_at'] = time.monotonic() + CHANNEL_INFO_TTL_SECONDS
+    return chat
+
+
+def forget_membership(user_id: int) -> None:
+    _members.pop(user_id, None)
+
+
+async def track_channel_membership(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """chat_member updates from the channel: refresh the cached answer, then stop processing."""
+    cmu = update.chat_member
+    if not cmu:
+        return
+    chat = cmu.chat
+    target = channel_chat_id()
+    if chat.id == target or (chat.username and str(target).lstrip('@').lower() == chat.username.lower()):
+        user_id = cmu.new_chat_member.user.id
+        _remember(user_id, cmu.new_chat_member.status in _MEMBER_STATUSES)
+        logger.debug(f"Channel membership of {user_id} is now {cmu.new_chat_member.status}")
+    # Not a user interaction; keep it away from the join gate and other handlers
+    raise ApplicationHandlerStop
@@ -1,6 +1,9 @@
+import asyncio
+
 from telegram.error import BadRequest, TelegramError
-from ..db import query_db
 from ..config import ADMIN_ID, logger
+from ..admins import extra_admin_ids
+from ..send_scheduler import scheduled_send, PRIORITY_HIGH
 
 
 async def safe_edit_text(message, text, reply_markup=None, parse_mode=None):
@@ -99,10 +102,6 @@ async def answer_safely(query, text: str | None = None, show_alert: bool = False
 
 
 def get_all_admin_ids() -> list[int]:
-    try:
-        rows = query_db("SELECT user_id FROM admins") or []
-    except Exception:
-        rows = []
     admin_ids: list[int] = []
     try:
         primary_id = int(ADMIN_ID)
@@ -110,24 +109,20 @@ def get_all_admin_ids() -> list[int]:
             admin_ids.append(primary_id)
     except Exception:
         pass
-    for r in rows:
-        try:
-            uid = int(r.get('user_id'))
-            if uid not in admin_ids:
-                admin_ids.append(uid)
-        except Exception:
-            continue
+    for uid in extra_admin_ids():
+        if uid not in admin_ids:
+            admin_ids.append(uid)
     return admin_ids
 
 
 async def notify_admins(bot, *, text: str | None = None, parse_mode=None, reply_markup=None, photo: str | None = None, document: str | None = None, caption: str | None = None):
-    for admin_id in get_all_admin_ids():
-        try:
-            if photo:
-                await bot.send_photo(chat_id=admin_id, photo=photo, caption=caption, parse_mode=parse_mode, reply_markup=reply_markup)
-            elif document:
-                await bot.send_document(chat_id=admin_id, document=document, caption=caption, parse_mode=parse_mode, reply_markup=reply_markup)
-            elif text:
-                await bot.send_message(chat_id=admin_id, text=text, parse_mode=parse_mode, reply_markup=reply_markup)
-        except Exception:
-            continue
\ No newline at end of file
+    # Admin notifications (payments, receipts) go out together, ahead of bulk traffic
+    async def _notify(admin_id):
+        if photo:
+            await scheduled_send(bot.send_photo, chat_id=admin_id, priority=PRIORITY_HIGH, photo=photo, caption=caption, parse_mode=parse_mode, reply_markup=reply_markup)
+        elif document:
+            await scheduled_send(bot.send_document, chat_id=admin_id, priority=PRIORITY_HIGH, document=document, caption=caption, parse_mode=parse_mode, reply_markup=reply_markup)
+        elif text:
+            await scheduled_send(bot.send_message, chat_id=admin_id, priority=PRIORITY_HIGH, text=text, parse_mode=parse_mode, reply_markup=reply_markup)
+
+    await asyncio.gather(*(_notify(admin_id) for admin_id in get_all_admin_ids()), return_exceptions=True)
@@ -1,11 +1,15 @@
+import asyncio
+import time
 from datetime import datetime
 from telegram.constants import ParseMode
 from telegram.error import Forbidden, BadRequest
 from telegram.ext import ContextTypes
 
-from .config import logger
-from .db import query_db, execute_db
+from .config import logger, ADMIN_ID, EXPIRY_PANEL_CONCURRENCY, EXPIRY_PANEL_TIMEOUT_SECONDS
+from .db import query_db, execute_db, arun_transaction
 from .panel import VpnPanelAPI
+from .reachability import REACHABLE_CLAUSE
+from .send_scheduler import scheduled_send, PRIORITY_BULK
 from .utils import bytes_to_gb
 
 
@@ -20,14 +24,20 @@ async def check_expirations(context: ContextTypes.DEFAULT_TYPE):
 
     active_orders = query_db(
         "SELECT id, user_id, marzban_username, panel_id, last_reminder_date FROM orders "
-        "WHERE status = 'approved' AND marzban_username IS NOT NULL AND panel_id IS NOT NULL"
-    )
+        "WHERE status = 'approved' AND marzban_username IS NOT NULL AND panel_id IS NOT NULL "
+        f"AND {REACHABLE_CLAUSE.format(col='orders.user_id')}"
+    ) or []
+    # Services of users who blocked the bot: no panel lookup, no reminder
+    skipped_unreachable = (query_db(
+        "SELECT COUNT(*) AS c FROM orders WHERE status = 'approved' AND marzban_username IS NOT NULL AND panel_id IS NOT NULL "
+        "AND user_id IN (SELECT user_id FROM users WHERE reachable = 0)",
+        one=True,
+    ) or {}).get('c', 0)
 
+    # (panel_id, username) -> orders, so each panel is asked only about its own services
     orders_map = {}
     for order in active_orders:
-        if order['marzban_username'] not in orders_map:
-            orders_map[order['marzban_username']] = []
-        orders_map[order['marzban_username']].append(order)
+        orders_map.setdefault((order['panel_id'], order['marzban_username']), []).append(order)
 
     # Deactivate expired resellers daily
     try:
@@ -43,50 +53,118 @@ async def check_expirations(context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"Reseller expiry check failed: {e}")
 
-    all_panels = query_db("SELECT id FROM panels")
-    for panel_data in all_panels:
+    usernames_by_panel = {}
+    for (panel_id, username) in orders_map:
+        usernames_by_panel.setdefault(panel_id, []).append(username)
+    panel_names = {p['id']: p['name'] for p in (query_db("SELECT id, name FROM panels") or [])}
+
+    # All panels are queried at once (bounded by EXPIRY_PANEL_CONCURRENCY); reminders for a
+    # panel go out as soon as its users arrive, so a dead panel only delays itself
+    started = time.monotonic()
+    semaphore = asyncio.Semaphore(EXPIRY_PANEL_CONCURRENCY)
+    tasks = [
+        asyncio.create_task(_fetch_panel_users(panel_id, usernames, semaphore))
+        for panel_id, usernames in usernames_by_panel.items()
+        if panel_id in panel_names
+    ]
+    report = []
+    for next_done in asyncio.as_completed(tasks):
+        panel_id, users_info, msg, elapsed = await next_done
+        name = panel_names.get(panel_id) or panel_id
+        if users_info is None:
+            logger.warning(f"Expiration check: panel {panel_id} ({name}) failed after {elapsed:.1f}s: {msg}")
+            report.append(f"\u274C {name}: {msg} ({elapsed:.1f} ثانیه)")
+            continue
         try:
-            panel_api = VpnPanelAPI(panel_id=panel_data['id'])
-            all_users, msg = await panel_api.get_all_users()
-            if not all_users:
-                logger.warning(f"Skipping panel ID {panel_data['id']} due to get_all_users error: {msg}")
-                continue
+            await arun_transaction(_store_expiry, panel_id, users_info)
+        except Exception as e:
+            logger.warning(f"Expiration check: could not store expiry for panel {panel_id}: {e}")
+        try:
+            sent = await _send_panel_reminders(context, panel_id, users_info, orders_map, reminder_msg_template, today_str)
+        except Exception as e:
+            logger.error(f"Failed to process reminders for panel ID {panel_id}: {e}")
+            report.append(f"\u274C {name}: {e} ({elapsed:.1f} ثانیه)")
+            continue
+        logger.info(f"Expiration check: panel {panel_id} ({name}) returned {len(users_info)} users in {elapsed:.1f}s, {sent} reminders sent")
+        report.append(f"\u2705 {name}: {len(users_info)} کاربر، {sent} یادآوری ({elapsed:.1f} ثانیه)")
 
-            for m_user in all_users:
-                username = m_user.get('username')
-                if username not in orders_map:
-                    continue
-
-                user_orders = orders_map[username]
-                for order in user_orders:
-                    if order['last_reminder_date'] == today_str:
-                        continue
-
-                    details_str = ""
-                    # Time-based check
-                    if m_user.get('expire'):
-                        expire_dt = datetime.fromtimestamp(m_user['expire'])
-                        days_left = (expire_dt - datetime.now()).days
-                        if 0 <= days_left <= 3:
-                            details_str = f"تنها **{days_left+1} روز** تا پایان اعتبار زمانی سرویس شما باقی مانده است."
-
-                    # Usage-based check
-                    if not details_str and m_user.get('data_limit', 0) > 0:
-                        usage_percent = (m_user.get('used_traffic', 0) / m_user['data_limit']) * 100
-                        if usage_percent >= 80:
-                            details_str = f"بیش از **{int(usage_percent)} درصد** از حجم سرویس شما مصرف شده است."
-
-                    if details_str:
-                        try:
-                            final_msg = reminder_msg_template.format(marzban_username=username, details=details_str)
-                            await context.bot.send_message(order['user_id'], final_msg, parse_mode=ParseMode.MARKDOWN)
-                            execute_db("UPDATE orders SET last_reminder_date = ? WHERE id = ?", (today_str, order['id']))
-                            logger.info(f"Sent reminder to user {order['user_id']} for service {username}")
-                        except (Forbidden, BadRequest):
-                            logger.warning(f"Could not send reminder to blocked user {order['user_id']}")
-                        except Exception as e:
-                            logger.error(f"Error sending reminder to {order['user_id']}: {e}")
-                        import asyncio as _asyncio
-                        await _asyncio.sleep(0.5)
+    total = time.monotonic() - started
+    logger.info(f"Expiration check finished for {len(tasks)} panels in {total:.1f}s, {skipped_unreachable} services of unreachable users skipped")
+    if report and ADMIN_ID:
+        try:
+            text = "\U0001F4CA گزارش بررسی انقضا\n\n" + "\n".join(report) + f"\n\nزمان کل: {total:.1f} ثانیه"
+            if skipped_unreachable:
+                text += f"\nسرویس‌های رد شده (کاربر ربات را مسدود کرده): {skipped_unreachable}"
+            await context.bot.send_message(ADMIN_ID, text)
+        except Exception as e:
+            logger.error(f"Could not send expiration report to admin: {e}")
+
+
+async def _fetch_panel_users(panel_id, usernames, semaphore):
+    """Return (panel_id, users_info, msg, elapsed) without ever raising."""
+    async with semaphore:
+        started = time.monotonic()
+        try:
+            panel_api = VpnPanelAPI(panel_id=panel_id)
+            # The panel worker thread can't be interrupted; on timeout it finishes in the
+            # background and its result is dropped
+            users_info, msg = await asyncio.wait_for(panel_api.get_users_bulk(usernames), EXPIRY_PANEL_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            users_info, msg = None, f"timeout ({EXPIRY_PANEL_TIMEOUT_SECONDS}s)"
         except Exception as e:
-            logger.error(f"Failed to process reminders for panel ID {panel_data['id']}: {e}")
\ No newline at end of file
+            users_info, msg = None, str(e)
+        return panel_id, users_info, msg, time.monotonic() - started
+
+
+def _store_expiry(conn, panel_id, users_info) -> None:
+    # Feeds the "expiring in N days" broadcast segment (broadcast.py)
+    conn.executemany(
+        "UPDATE orders SET expire_at = ? WHERE panel_id = ? AND marzban_username = ? AND status = 'approved'",
+        [
+            (int(info['expire']) if isinstance(info.get('expire'), (int, float)) and info['expire'] > 0 else None, panel_id, username)
+            for username, info in users_info.items()
+        ],
+    )
+
+
+async def _send_panel_reminders(context, panel_id, users_info, orders_map, reminder_msg_template, today_str) -> int:
+    reminders = []
+    for username, m_user in users_info.items():
+        user_orders = orders_map.get((panel_id, username)) or []
+        for order in user_orders:
+            if order['last_reminder_date'] == today_str:
+                continue
+
+            details_str = ""
+            # Time-based check
+            if m_user.get('expire'):
+                expire_dt = datetime.fromtimestamp(m_user['expire'])
+                days_left = (expire_dt - datetime.now()).days
+                if 0 <= days_left <= 3:
+                    details_str = f"تنها **{days_left+1} روز** تا پایان اعتبار زمانی سرویس شما باقی مانده است."
+
+            # Usage-based check
+            if not details_str and (m_user.get('data_limit') or 0) > 0:
+                usage_percent = ((m_user.get('used_traffic') or 0) / m_user['data_limit']) * 100
+                if usage_percent >= 80:
+                    details_str = f"بیش از **{int(usage_percent)} درصد** از حجم سرویس شما مصرف شده است."
+
+            if details_str:
+                final_msg = reminder_msg_template.format(marzban_username=username, details=details_str)
+                reminders.append(_send_reminder(context, order, username, final_msg, today_str))
+    # The send scheduler paces these; gathering them keeps it busy up to the rate limit
+    results = await asyncio.gather(*reminders)
+    return sum(1 for ok in results if ok)
+
+
+async def _send_reminder(context, order, username, text, today_str) -> bool:
+    try:
+        await scheduled_send(context.bot.send_message, chat_id=order['user_id'], priority=PRIORITY_BULK, text=text, parse_mode=ParseMode.MARKDOWN)
+        execute_db("UPDATE orders SET last_reminder_date = ? WHERE id = ?", (today_str, order['id']))
+        logger.info(f"Sent reminder to user {order['user_id']} for service {username}")
+        return True
+    except (Forbidden, BadRequest):
+        logger.warning(f"Could not send reminder to blocked user {order['user_id']}")
+    except Exception as e:
+        logger.error(f"Error sending reminder to {order['user_id']}: {e}")
+    return False
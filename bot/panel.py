@@ -1,25 +1,522 @@
+import base64
+import inspect
+import threading
 import requests
+from requests.cookies import get_cookie_header
 import uuid
 from datetime import datetime, timedelta
 import json
 import re
 from urllib.parse import urlsplit
-from .config import logger, NETICO_AGENT_ID
-from .db import query_db
+from .config import logger, NETICO_AGENT_ID, PANEL_AUTH_TTL_SECONDS
+from .db import query_db, execute_db
+from .panel_http import new_session, offload, iter_bounded
 import time as _time
 
 
+def _jwt_exp(token) -> float | None:
+    try:
+        payload = str(token).split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        return float(exp) if exp else None
+    except Exception:
+        return None
+
+
+def _cached_login(login_fn):
+    """Wrap an adapter's login (get_token/_ensure_token) so a live token/cookie is reused.
+
+    `force=True` discards the current credentials first; used when a request shows the
+    session has expired (see BasePanelAPI._session_expired).
+    """
+    def wrapper(self, force: bool = False):
+        with self._auth_guard():
+            if not force and self._auth_expires_at > _time.monotonic():
+                return True
+            if force:
+                saved = self._reset_auth()
+            self._login_thread = threading.get_ident()
+            try:
+                ok = login_fn(self)
+            finally:
+                self._login_thread = None
+            if ok:
+                self._auth_expires_at = self._auth_expiry()
+                self._last_login_at = _time.monotonic()
+            else:
+                self._auth_expires_at = 0.0
+                if force:
+                    self._restore_auth(saved)
+            return ok
+
+    wrapper.__name__ = login_fn.__name__
+    wrapper.__doc__ = login_fn.__doc__
+    return wrapper
+
+
+_auth_guard_lock = threading.Lock()
+
+# A 404, redirect or HTML page this soon after logging in is a real answer (e.g. an endpoint
+# variant the fork lacks), not an expired session
+_SOFT_REAUTH_GRACE_SECONDS = 60
+
+# API path prefixes used across X-UI forks, longest first so '/xui/api' wins over '/xui'
+_API_PREFIXES = ('/panel/API', '/panel/api', '/xui/API', '/xui/api', '/tx/api', '/panel', '/xui')
+
+# Page size for get_users_bulk on Marzban/Marzneshin (Marzneshin caps pages at 100)
+_BULK_PAGE_SIZE = 100
+
+
 class BasePanelAPI:
+    # Clients are shared across requests by the VpnPanelAPI registry, so login state lives
+    # on the instance until it expires (JWT exp / cookie expiry / PANEL_AUTH_TTL_SECONDS)
+    # or a response shows the panel dropped the session, in which case _reauth_on_expiry
+    # logs in again and retries once.
+    _auth_expires_at = 0.0
+    _last_login_at = 0.0
+    _login_thread = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Adapter coroutines do blocking HTTP internally; run them on the panel worker pool
+        for name, attr in list(vars(cls).items()):
+            if inspect.iscoroutinefunction(attr):
+                setattr(cls, name, offload(attr))
+        for name in ('get_token', '_ensure_token'):
+            if name in vars(cls):
+                setattr(cls, name, _cached_login(vars(cls)[name]))
+
+    def _auth_guard(self) -> threading.RLock:
+        lock = self.__dict__.get('_auth_lock')
+        if lock is None:
+            with _auth_guard_lock:
+                lock = self.__dict__.setdefault('_auth_lock', threading.RLock())
+        return lock
+
+    def _login(self, force: bool = False) -> bool:
+        login = getattr(self, 'get_token', None) or getattr(self, '_ensure_token', None)
+        return bool(login and login(force=force))
+
+    def _bearer_token(self):
+        return getattr(self, 'access_token', None) or getattr(self, 'token', None)
+
+    def _auth_expiry(self) -> float:
+        now = _time.time()
+        ttl = float(PANEL_AUTH_TTL_SECONDS)
+        exp = _jwt_exp(self._bearer_token())
+        if exp:
+            ttl = min(ttl, exp - now - 30)
+        session = getattr(self, 'session', None)
+        for cookie in (session.cookies if session is not None else []):
+            if cookie.expires:
+                ttl = min(ttl, cookie.expires - now - 30)
+        return _time.monotonic() + max(0.0, ttl)
+
+    def _reset_auth(self):
+        saved = {k: getattr(self, k) for k in ('access_token', 'token', 'cookies') if hasattr(self, k)}
+        cookies = self.session.cookies.copy() if getattr(self, 'session', None) is not None else None
+        if 'access_token' in saved:
+            self.access_token = None
+        if 'token' in saved:
+            self.token = ''
+        if 'cookies' in saved:
+            self.cookies = None
+        if cookies is not None:
+            self.session.cookies.clear()
+        return saved, cookies
+
+    def _restore_auth(self, saved) -> None:
+        attrs, cookies = saved
+        for k, v in attrs.items():
+            setattr(self, k, v)
+        if cookies is not None:
+            self.session.cookies.update(cookies)
+
+    def _api_prefix_of(self, endpoint: str) -> str | None:
+        path = endpoint[len(self.base_url):] if endpoint.startswith(self.base_url) else endpoint
+        for prefix in _API_PREFIXES:
+            if path.startswith(prefix + '/'):
+                return prefix
+        return None
+
+    def _ordered_endpoints(self, endpoints: list[str]) -> list[str]:
+        """Put endpoint variants under the prefix this panel last answered on first."""
+        preferred = getattr(self, 'api_prefix', None)
+        if not preferred:
+            return list(endpoints)
+        return sorted(endpoints, key=lambda e: self._api_prefix_of(e) != preferred)
+
+    def _remember_endpoint(self, endpoint: str) -> None:
+        prefix = self._api_prefix_of(endpoint)
+        if not prefix or prefix == getattr(self, 'api_prefix', None):
+            return
+        self.api_prefix = prefix
+        try:
+            execute_db("UPDATE panels SET api_prefix = ? WHERE id = ?", (prefix, self.panel_id))
+        except Exception:
+            pass
+        logger.info(f"Panel {getattr(self, 'panel_id', '?')}: API prefix is {prefix}")
+
+    # X-UI family: email -> (inbound_id, client_id) index so get_user fetches one inbound
+    # instead of every inbound's full client list. Seeded from the orders table and
+    # refreshed from every inbound scanned.
+    def _client_index(self) -> dict:
+        index = self.__dict__.get('_email_index')
+        if index is None:
+            index = self.__dict__.setdefault('_email_index', {})
+        return index
+
+    @staticmethod
+    def _inbound_clients(inbound) -> list:
+        settings_str = (inbound or {}).get('settings')
+        try:
+            settings_obj = json.loads(settings_str) if isinstance(settings_str, str) else (settings_str or {})
+        except Exception:
+            settings_obj = {}
+        clients = settings_obj.get('clients') if isinstance(settings_obj, dict) else None
+        return clients if isinstance(clients, list) else []
+
+    def _index_inbound(self, inbound_id, clients: list) -> None:
+        index = self._client_index()
+        for c in clients:
+            email = c.get('email') if isinstance(c, dict) else None
+            if email:
+                index[email] = (int(inbound_id), c.get('id') or c.get('password') or email)
+
+    def _indexed_inbound(self, username: str):
+        entry = self._client_index().get(username)
+        if entry:
+            return entry[0]
+        try:
+            row = query_db(
+                "SELECT xui_inbound_id, xui_client_id FROM orders WHERE panel_id = ? AND marzban_username = ? "
+                "AND xui_inbound_id IS NOT NULL ORDER BY id DESC LIMIT 1",
+                (self.panel_id, username), one=True,
+            )
+        except Exception:
+            row = None
+        if row and row.get('xui_inbound_id'):
+            self._client_index()[username] = (int(row['xui_inbound_id']), row.get('xui_client_id') or username)
+            return int(row['xui_inbound_id'])
+        return None
+
+    def _find_client(self, username: str):
+        """Return (inbound_id, client, msg) for the client whose email is `username`.
+
+        Known clients cost one inbound fetch; unknown or moved ones fall back to a full scan.
+        """
+        inbound_id = self._indexed_inbound(username)
+        if inbound_id:
+            inbound = self._fetch_inbound_detail(inbound_id)
+            clients = self._inbound_clients(inbound)
+            self._index_inbound(inbound_id, clients)
+            for c in clients:
+                if c.get('email') == username:
+                    return inbound_id, c, "Success"
+            if inbound:
+                # Client left that inbound (deleted or recreated elsewhere); forget and rescan
+                self._client_index().pop(username, None)
+        inbounds, msg = self.list_inbounds()
+        if not inbounds:
+            return None, None, msg
+        for ib in inbounds:
+            ib_id = ib.get('id')
+            if ib_id is None or ib_id == inbound_id:
+                continue
+            clients = self._inbound_clients(self._fetch_inbound_detail(ib_id))
+            self._index_inbound(ib_id, clients)
+            for c in clients:
+                if c.get('email') == username:
+                    return ib_id, c, "Success"
+        return None, None, "کاربر یافت نشد"
+
+    def _seed_index_from_orders(self) -> None:
+        try:
+            rows = query_db(
+                "SELECT marzban_username, xui_inbound_id, xui_client_id FROM orders WHERE panel_id = ? "
+                "AND marzban_username IS NOT NULL AND xui_inbound_id IS NOT NULL ORDER BY id",
+                (self.panel_id,),
+            ) or []
+        except Exception:
+            rows = []
+        index = self._client_index()
+        for r in rows:
+            index.setdefault(r['marzban_username'], (int(r['xui_inbound_id']), r.get('xui_client_id') or r['marzban_username']))
+
+    def _sub_link(self, subid: str) -> str:
+        if not subid:
+            return ''
+        if self.sub_base:
+            origin = self.sub_base
+        else:
+            parts = urlsplit(self.base_url)
+            host = parts.hostname or ''
+            port = ''
+            if parts.port and not ((parts.scheme == 'http' and parts.port == 80) or (parts.scheme == 'https' and parts.port == 443)):
+                port = f":{parts.port}"
+            origin = f"{parts.scheme}://{host}{port}"
+        return f"{origin}/sub/{subid}"
+
+    def _xui_client_info(self, c: dict, stats: dict | None) -> dict:
+        # Same fields and precedence as the X-UI family get_user
+        try:
+            used_bytes = int(c.get('total', 0) or 0)
+        except Exception:
+            used_bytes = 0
+        if used_bytes == 0 and stats:
+            try:
+                used_bytes = int(stats.get('down') or stats.get('download') or 0) + int(stats.get('up') or stats.get('upload') or 0)
+            except Exception:
+                used_bytes = 0
+        expiry_ms = int(c.get('expiryTime', 0) or 0)
+        return {
+            'username': c.get('email'),
+            'data_limit': int(c.get('totalGB', 0) or 0),
+            'used_traffic': used_bytes,
+            'expire': int(expiry_ms / 1000) if expiry_ms > 0 else 0,
+            'subscription_url': self._sub_link(c.get('subId') or ''),
+        }
+
+    def _inbound_snapshot(self, inbound_id, wanted: set | None = None):
+        """Fetch one inbound: (inbound_id, clients, stats_by_email).
+
+        Traffic stats are only fetched when a client in `wanted` (any client if None) is present.
+        """
+        inbound = self._fetch_inbound_detail(inbound_id)
+        clients = self._inbound_clients(inbound)
+        if not any(wanted is None or c.get('email') in wanted for c in clients):
+            return inbound_id, clients, {}
+        # 3x-UI embeds clientStats in the inbound; otherwise one getClientTraffics per inbound
+        stats = inbound.get('clientStats')
+        fetch_traffics = getattr(self, '_fetch_client_traffics', None)
+        if not isinstance(stats, list) and callable(fetch_traffics):
+            try:
+                stats = fetch_traffics(inbound_id)
+            except Exception:
+                stats = None
+        return inbound_id, clients, {(s.get('email') or s.get('name')): s for s in (stats or []) if isinstance(s, dict)}
+
+    def _collect_from_inbounds(self, inbound_ids, wanted: set, found: dict, visited: set) -> None:
+        ids = [i for i in dict.fromkeys(inbound_ids) if i is not None and i not in visited]
+        visited.update(ids)
+        for inbound_id, clients, stats in iter_bounded(lambda i: self._inbound_snapshot(i, wanted), ids):
+            self._index_inbound(inbound_id, clients)
+            for c in clients:
+                email = c.get('email')
+                if email in wanted and email not in found:
+                    found[email] = self._xui_client_info(c, stats.get(email))
+
+    def _iter_xui_users(self, inbounds):
+        """Yield a normalised dict for every client across `inbounds`, as each inbound arrives;
+        besides the get_user fields it carries the client's inbound_id and enable flag."""
+        seen = set()
+        ids = [ib.get('id') for ib in inbounds if ib.get('id') is not None]
+        for inbound_id, clients, stats in iter_bounded(self._inbound_snapshot, ids):
+            self._index_inbound(inbound_id, clients)
+            for c in clients:
+                email = c.get('email')
+                if email and email not in seen:
+                    seen.add(email)
+                    info = self._xui_client_info(c, stats.get(email))
+                    info['inbound_id'] = inbound_id
+                    info['enable'] = c.get('enable', True)
+                    yield info
+
+    def _xui_all_users(self):
+        if not self.get_token():
+            return None, "خطا در ورود به پنل"
+        inbounds, msg = self.list_inbounds()
+        if inbounds is None:
+            return None, msg
+        return list(self._iter_xui_users(inbounds)), "Success"
+
+    def _xui_users_bulk(self, usernames):
+        wanted = {u for u in (usernames or []) if u}
+        if not wanted:
+            return {}, "Success"
+        if not self.get_token():
+            return None, "خطا در ورود به پنل"
+        self._seed_index_from_orders()
+        index = self._client_index()
+        found, visited = {}, set()
+        self._collect_from_inbounds({index[u][0] for u in wanted if u in index}, wanted, found, visited)
+        if wanted - found.keys():
+            inbounds, msg = self.list_inbounds()
+            if not inbounds and not found:
+                return None, msg
+            self._collect_from_inbounds([ib.get('id') for ib in (inbounds or [])], wanted, found, visited)
+        return found, "Success"
+
+    def activate_client_on_inbound(self, inbound_id: int, username: str, plan):
+        """X-UI family: enable a pre-created (account pool) client and give it the plan's traffic
+        and expiry, counted from now. Returns (ok, msg)."""
+        if not self._login():
+            return False, "خطا در ورود به پنل"
+        client = next((c for c in self._inbound_clients(self._fetch_inbound_detail(inbound_id)) if c.get('email') == username), None)
+        if not client:
+            return False, "کلاینت یافت نشد"
+        try:
+            traffic_gb = float(plan['traffic_gb'])
+        except Exception:
+            traffic_gb = 0.0
+        try:
+            days = int(plan['duration_days'])
+        except Exception:
+            days = 0
+        updated = dict(client)
+        updated['enable'] = True
+        updated['totalGB'] = int(traffic_gb * (1024 ** 3)) if traffic_gb > 0 else 0
+        updated['expiryTime'] = int((datetime.now() + timedelta(days=days)).timestamp() * 1000) if days > 0 else 0
+        # updateClient/{clientId}: uuid for vless/vmess, password for trojan, email for shadowsocks
+        client_key = client.get('id') or client.get('password') or username
+        settings_payload = json.dumps({"clients": [updated]})
+        endpoints = self._ordered_endpoints([
+            f"{self.base_url}{prefix}/inbounds/updateClient/{client_key}"
+            for prefix in _API_PREFIXES if prefix.lower().endswith('/api')
+        ])
+        last_error = "به‌روزرسانی کلاینت ناموفق بود"
+        for ep in endpoints:
+            for body in ({'json': {"id": int(inbound_id), "settings": settings_payload}},
+                         {'data': {"id": str(int(inbound_id)), "settings": settings_payload}}):
+                try:
+                    r = self.session.post(ep, headers={'Accept': 'application/json'}, timeout=15, **body)
+                except requests.RequestException as e:
+                    last_error = str(e)
+                    break
+                if r.status_code not in (200, 201):
+                    last_error = f"HTTP {r.status_code}"
+                    break
+                # Success bodies differ between forks; trust the panel's copy of the client
+                check = next((c for c in self._inbound_clients(self._fetch_inbound_detail(inbound_id)) if c.get('email') == username), None)
+                if check and check.get('enable') and int(check.get('totalGB', 0) or 0) == updated['totalGB']:
+                    self._remember_endpoint(ep)
+                    return True, "Success"
+        return False, last_error
+
+    def delete_client_on_inbound(self, inbound_id: int, username: str):
+        """X-UI family: remove the client from the inbound. Returns (gone, msg); gone is also
+        true when the panel no longer had the client."""
+        if not self._login():
+            return False, "خطا در ورود به پنل"
+
+        def current():
+            inbound = self._fetch_inbound_detail(inbound_id)
+            if not inbound:
+                return False, None
+            return True, next((c for c in self._inbound_clients(inbound) if c.get('email') == username), None)
+
+        fetched, client = current()
+        if not fetched:
+            return False, "دریافت اینباند ناموفق بود"
+        if not client:
+            return True, "کلاینت یافت نشد"
+        client_key = client.get('id') or client.get('password') or username
+        # 3x-ui: inbounds/{id}/delClient/{clientId}; older forks take the inbound id in the body
+        endpoints = self._ordered_endpoints([
+            url
+            for prefix in _API_PREFIXES if prefix.lower().endswith('/api')
+            for url in (f"{self.base_url}{prefix}/inbounds/{int(inbound_id)}/delClient/{client_key}",
+                        f"{self.base_url}{prefix}/inbounds/delClient/{client_key}")
+        ])
+        last_error = "حذف کلاینت ناموفق بود"
+        for ep in endpoints:
+            try:
+                r = self.session.post(ep, headers={'Accept': 'application/json'}, json={"id": int(inbound_id)}, timeout=15)
+            except requests.RequestException as e:
+                last_error = str(e)
+                continue
+            if r.status_code not in (200, 201):
+                last_error = f"HTTP {r.status_code}"
+                continue
+            fetched, client = current()
+            if fetched and not client:
+                self._remember_endpoint(ep)
+                self._client_index().pop(username, None)
+                return True, "Success"
+        return False, last_error
+
+    def _install_auth_hooks(self) -> None:
+        session = getattr(self, 'session', None)
+        if session is not None and self._reauth_on_expiry not in session.hooks['response']:
+            session.hooks['response'].append(self._reauth_on_expiry)
+
+    def _sent_with_current_auth(self, req) -> bool:
+        auth = req.headers.get('Authorization') or ''
+        if auth.lower().startswith('bearer '):
+            return auth[7:].strip() == (self._bearer_token() or '')
+        # The jar only renders a Cookie header for a request that has none yet
+        probe = req.copy()
+        probe.headers.pop('Cookie', None)
+        return req.headers.get('Cookie') == get_cookie_header(self.session.cookies, probe)
+
+    def _session_expired(self, resp) -> bool:
+        if resp.status_code == 401:
+            return True
+        # X-UI forks never answer 401 on their API paths: checkAPIAuth gives a 404, other
+        # routes redirect to the login page, which ends in an HTML 200 where JSON was expected
+        if self._api_prefix_of(resp.request.url) is None:
+            return False
+        if resp.status_code == 404 or resp.is_redirect:
+            return True
+        return resp.status_code == 200 and 'text/html' in (resp.headers.get('Content-Type') or '').lower()
+
+    def _reauth_on_expiry(self, resp, *args, **kwargs):
+        req = resp.request
+        if (
+            not self._session_expired(resp)
+            or getattr(req, '_panel_reauthed', False)
+            or self._login_thread == threading.get_ident()
+            or hasattr(req.body, 'read')
+        ):
+            return resp
+        # Free the response's pooled connection first: pools block when full, and the
+        # re-login below may need a connection to the same host
+        resp.content
+        resp.close()
+        with self._auth_guard():
+            # Concurrent expiries share one re-login: skip if another thread already refreshed
+            if self._sent_with_current_auth(req):
+                if resp.status_code != 401 and _time.monotonic() - self._last_login_at < _SOFT_REAUTH_GRACE_SECONDS:
+                    return resp
+                logger.info(f"Panel {getattr(self, 'panel_id', '?')}: session expired ({resp.status_code} from {req.url}), re-authenticating")
+                if not self._login(force=True):
+                    return resp
+        retry = req.copy()
+        retry._panel_reauthed = True
+        auth = retry.headers.get('Authorization') or ''
+        token = self._bearer_token()
+        if auth.lower().startswith('bearer ') and token:
+            retry.headers['Authorization'] = f"Bearer {token}"
+        retry.headers.pop('Cookie', None)
+        retry.prepare_cookies(self.session.cookies)
+        new_resp = self.session.send(retry, **kwargs)
+        new_resp.history.insert(0, resp)
+        return new_resp
+
     async def get_all_users(self):
         raise NotImplementedError
 
     async def get_user(self, username):
         raise NotImplementedError
 
+    async def get_users_bulk(self, usernames):
+        """Return ({username: info}, msg) for `usernames`; users missing on the panel are left out.
+
+        `info` has the get_user fields (data_limit, used_traffic, expire, subscription_url).
+        Adapters override this with as few requests as their API allows; this fallback asks one by one.
+        """
+        found = {}
+        for username in dict.fromkeys(u for u in (usernames or []) if u):
+            info, _ = await self.get_user(username)
+            if info:
+                found[username] = info
+        return found, "Success"
+
     async def renew_user_in_panel(self, username, plan):
         raise NotImplementedError
 
-    async def create_user(self, user_id, plan):
+    async def create_user(self, user_id, plan, username=None):
         raise NotImplementedError
 
 
@@ -32,7 +529,7 @@ class MarzbanAPI(BasePanelAPI):
         self.base_url = _raw
         self.username = panel_row['username']
         self.password = panel_row['password']
-        self.session = requests.Session()
+        self.session = new_session()
         self.access_token = None
 
     def get_token(self):
@@ -164,26 +661,60 @@ class MarzbanAPI(BasePanelAPI):
             if r.status_code == 404:
                 return None, "کاربر یافت نشد"
             r.raise_for_status()
-            data = r.json()
-            # Try to compute used_traffic if not provided
+            return self._with_used_traffic(r.json()), "Success"
+        except requests.RequestException as e:
+            logger.error(f"Failed to get user {marzban_username}: {e}")
+            return None, f"خطای پنل: {e}"
+
+    @staticmethod
+    def _with_used_traffic(data: dict) -> dict:
+        # Try to compute used_traffic if not provided
+        try:
+            used = int(data.get('used_traffic', 0) or 0)
+        except Exception:
+            used = 0
+        if used == 0:
             try:
-                used = int(data.get('used_traffic', 0) or 0)
+                down = int(data.get('download', 0) or data.get('downlink', 0) or 0)
             except Exception:
-                used = 0
-            if used == 0:
-                try:
-                    down = int(data.get('download', 0) or data.get('downlink', 0) or 0)
-                except Exception:
-                    down = 0
-                try:
-                    up = int(data.get('upload', 0) or data.get('uplink', 0) or 0)
-                except Exception:
-                    up = 0
-                used = down + up
-                data['used_traffic'] = used
-            return data, "Success"
+                down = 0
+            try:
+                up = int(data.get('upload', 0) or data.get('uplink', 0) or 0)
+            except Exception:
+                up = 0
+            data['used_traffic'] = down + up
+        return data
+
+    async def get_users_bulk(self, usernames):
+        wanted = {u for u in (usernames or []) if u}
+        if not wanted:
+            return {}, "Success"
+        if not self.access_token and not self.get_token():
+            return None, "خطا در اتصال به پنل"
+        headers = {'Authorization': f'Bearer {self.access_token}', 'accept': 'application/json'}
+        found = {}
+        offset = 0
+        try:
+            while len(found) < len(wanted):
+                r = self.session.get(
+                    f"{self.base_url}/api/users",
+                    params={'offset': offset, 'limit': _BULK_PAGE_SIZE},
+                    headers=headers,
+                    timeout=20,
+                )
+                r.raise_for_status()
+                data = r.json()
+                page = data.get('users', [])
+                for u in page:
+                    if u.get('username') in wanted:
+                        found[u['username']] = self._with_used_traffic(u)
+                offset += len(page)
+                # Older releases ignore offset/limit and return everything without 'total'
+                if len(page) < _BULK_PAGE_SIZE or offset >= int(data.get('total') or 0):
+                    break
+            return found, "Success"
         except requests.RequestException as e:
-            logger.error(f"Failed to get user {marzban_username}: {e}")
+            logger.error(f"Failed to page users from {self.base_url}: {e}")
             return None, f"خطای پنل: {e}"
 
     def revoke_subscription(self, marzban_username: str):
@@ -236,7 +767,7 @@ class MarzbanAPI(BasePanelAPI):
             logger.error(f"Failed to renew user {marzban_username}: {e} - {error_detail}")
             return None, f"خطای پنل هنگام تمدید: {error_detail}"
 
-    async def create_user(self, user_id, plan):
+    async def create_user(self, user_id, plan, username=None):
         if not self.access_token and not self.get_token():
             return None, None, "خطا در اتصال به پنل. لطفا تنظیمات را بررسی کنید."
 
@@ -265,7 +796,7 @@ class MarzbanAPI(BasePanelAPI):
         if not inbounds_by_protocol:
             return None, None, "خطا: اینباندهای تنظیم شده در دیتابیس معتبر نیستند."
 
-        new_username = f"user_{user_id}_{uuid.uuid4().hex[:6]}"
+        new_username = username or f"user_{user_id}_{uuid.uuid4().hex[:6]}"
         traffic_gb = float(plan['traffic_gb'])
         data_limit_bytes = int(traffic_gb * 1024 * 1024 * 1024) if traffic_gb > 0 else 0
         expire_timestamp = int((datetime.now() + timedelta(days=int(plan['duration_days']))).timestamp()) if int(plan['duration_days']) > 0 else 0
@@ -332,7 +863,8 @@ class XuiAPI(BasePanelAPI):
         if _sb and '://' not in _sb:
             _sb = f"http://{_sb}"
         self.sub_base = _sb
-        self.session = requests.Session()
+        self.session = new_session()
+        self.api_prefix = panel_row.get('api_prefix') if isinstance(panel_row, dict) else None
         self._json_headers = {
             'Accept': 'application/json',
             'Content-Type': 'application/json',
@@ -382,7 +914,7 @@ class XuiAPI(BasePanelAPI):
             f"{self.base_url}/xui/api/inbounds/getClientTraffics/{inbound_id}",
             f"{self.base_url}/panel/api/inbounds/getClientTraffics/{inbound_id}",
         ]
-        for url in endpoints:
+        for url in self._ordered_endpoints(endpoints):
             try:
                 resp = self.session.get(url, headers={'Accept': 'application/json'}, timeout=12)
                 if resp.status_code != 200:
@@ -390,6 +922,7 @@ class XuiAPI(BasePanelAPI):
                 data = resp.json()
                 items = data.get('obj') if isinstance(data, dict) else data
                 if isinstance(items, list):
+                    self._remember_endpoint(url)
                     return items
             except Exception:
                 continue
@@ -402,7 +935,7 @@ class XuiAPI(BasePanelAPI):
             f"{self.base_url}/xui/API/inbounds/getClientTraffics/{email}",
             f"{self.base_url}/panel/API/inbounds/getClientTraffics/{email}",
         ]
-        for url in endpoints:
+        for url in self._ordered_endpoints(endpoints):
             try:
                 resp = self.session.get(url, headers={'Accept': 'application/json'}, timeout=12)
                 if resp.status_code != 200:
@@ -410,6 +943,7 @@ class XuiAPI(BasePanelAPI):
                 data = resp.json()
                 obj = data.get('obj') if isinstance(data, dict) else data
                 if isinstance(obj, dict):
+                    self._remember_endpoint(url)
                     return obj
             except Exception:
                 continue
@@ -429,7 +963,7 @@ class XuiAPI(BasePanelAPI):
             ]
             last_error = None
             for attempt in range(2):
-                for url in endpoints:
+                for url in self._ordered_endpoints(endpoints):
                     try:
                         resp = self.session.get(url, headers={'Accept': 'application/json'}, timeout=12)
                     except requests.RequestException as e:
@@ -475,20 +1009,21 @@ class XuiAPI(BasePanelAPI):
                             'protocol': it.get('protocol') or it.get('type') or 'unknown',
                             'port': it.get('port') or it.get('listen_port') or 0,
                         })
+                    self._remember_endpoint(url)
                     return inbounds, "Success"
                 # retry after re-login once
                 if attempt == 0:
-                    self.get_token()
+                    self.get_token(force=True)
             return None, (last_error or 'Unknown')
         except requests.RequestException as e:
             logger.error(f"X-UI list_inbounds error: {e}")
             return None, str(e)
 
-    def create_user_on_inbound(self, inbound_id: int, user_id: int, plan):
+    def create_user_on_inbound(self, inbound_id: int, user_id: int, plan, enable: bool = True, username=None):
         if not self.get_token():
             return None, None, "خطا در ورود به پنل X-UI"
         try:
-            new_username = f"user_{user_id}_{uuid.uuid4().hex[:6]}"
+            new_username = username or f"user_{user_id}_{uuid.uuid4().hex[:6]}"
             import random, string
             subid = ''.join(random.choices(string.ascii_lowercase + string.digits, k=12))
             try:
@@ -508,7 +1043,7 @@ class XuiAPI(BasePanelAPI):
                     "email": new_username,
                     "totalGB": total_bytes,
                     "expiryTime": expiry_ms,
-                    "enable": True,
+                    "enable": enable,
                     "limitIp": 0,
                     "subId": subid,
                     "reset": 0
@@ -539,94 +1074,85 @@ class XuiAPI(BasePanelAPI):
             return None, None, str(e)
 
     async def get_all_users(self):
-        return None, "Not supported for X-UI"
+        return self._xui_all_users()
+
+    async def get_users_bulk(self, usernames):
+        return self._xui_users_bulk(usernames)
+
+    def _sub_link(self, subid: str) -> str:
+        link = super()._sub_link(subid)
+        return f"{link}?name={subid}" if link else ''
 
     async def get_user(self, username):
         # Find client by email across inbounds and map to common fields
         if not self.get_token():
             return None, "خطا در ورود به پنل X-UI"
-        inbounds, msg = self.list_inbounds()
-        if not inbounds:
+        inbound_id, c, msg = self._find_client(username)
+        if c is None:
             return None, msg
-        for ib in inbounds:
-            inbound_id = ib.get('id')
-            inbound = self._fetch_inbound_detail(inbound_id)
-            if not inbound:
-                continue
-            settings_str = inbound.get('settings')
-            try:
-                settings_obj = json.loads(settings_str) if isinstance(settings_str, str) else {}
-            except Exception:
-                settings_obj = {}
-            clients = settings_obj.get('clients') or []
-            if not isinstance(clients, list):
-                continue
-            for c in clients:
-                if c.get('email') == username:
-                    total_bytes = int(c.get('totalGB', 0) or 0)
-                    # Try compute used traffic if present in client or stats
-                    used_bytes = 0
+        total_bytes = int(c.get('totalGB', 0) or 0)
+        # Try compute used traffic if present in client or stats
+        used_bytes = 0
+        try:
+            down = int(c.get('downlink', 0) or 0)
+        except Exception:
+            down = 0
+        try:
+            up = int(c.get('uplink', 0) or 0)
+        except Exception:
+            up = 0
+        try:
+            used_bytes = int(c.get('total', 0) or 0)
+        except Exception:
+            used_bytes = down + up
+        if used_bytes == 0:
+            # Fetch from getClientTraffics endpoint (by inbound)
+            stats = self._fetch_client_traffics(inbound_id) or []
+            for s in stats:
+                if (s.get('email') or s.get('name')) == username:
                     try:
-                        down = int(c.get('downlink', 0) or 0)
+                        d = int(s.get('down') or s.get('download') or 0)
                     except Exception:
-                        down = 0
+                        d = 0
                     try:
-                        up = int(c.get('uplink', 0) or 0)
+                        u = int(s.get('up') or s.get('upload') or 0)
                     except Exception:
-                        up = 0
+                        u = 0
+                    used_bytes = d + u
+                    break
+            if used_bytes == 0:
+                # Direct by email
+                s = self._fetch_client_traffic_by_email(username)
+                if isinstance(s, dict):
                     try:
-                        used_bytes = int(c.get('total', 0) or 0)
+                        d = int(s.get('down') or s.get('download') or 0)
                     except Exception:
-                        used_bytes = down + up
-                    if used_bytes == 0:
-                        # Fetch from getClientTraffics endpoint (by inbound)
-                        stats = self._fetch_client_traffics(inbound_id) or []
-                        for s in stats:
-                            if (s.get('email') or s.get('name')) == username:
-                                try:
-                                    d = int(s.get('down') or s.get('download') or 0)
-                                except Exception:
-                                    d = 0
-                                try:
-                                    u = int(s.get('up') or s.get('upload') or 0)
-                                except Exception:
-                                    u = 0
-                                used_bytes = d + u
-                                break
-                        if used_bytes == 0:
-                            # Direct by email
-                            s = self._fetch_client_traffic_by_email(username)
-                            if isinstance(s, dict):
-                                try:
-                                    d = int(s.get('down') or s.get('download') or 0)
-                                except Exception:
-                                    d = 0
-                                try:
-                                    u = int(s.get('up') or s.get('upload') or 0)
-                                except Exception:
-                                    u = 0
-                                used_bytes = d + u
-                    expiry_ms = int(c.get('expiryTime', 0) or 0)
-                    expire = int(expiry_ms / 1000) if expiry_ms > 0 else 0
-                    subid = c.get('subId') or ''
-                    # Build subscription URL
-                    if self.sub_base:
-                        origin = self.sub_base
-                    else:
-                        parts = urlsplit(self.base_url)
-                        host = parts.hostname or ''
-                        port = ''
-                        if parts.port and not ((parts.scheme == 'http' and parts.port == 80) or (parts.scheme == 'https' and parts.port == 443)):
-                            port = f":{parts.port}"
-                        origin = f"{parts.scheme}://{host}{port}"
-                    sub_link = f"{origin}/sub/{subid}?name={subid}" if subid else ''
-                    return {
-                        'data_limit': total_bytes,
-                        'used_traffic': used_bytes,
-                        'expire': expire,
-                        'subscription_url': sub_link,
-                    }, "Success"
-        return None, "کاربر یافت نشد"
+                        d = 0
+                    try:
+                        u = int(s.get('up') or s.get('upload') or 0)
+                    except Exception:
+                        u = 0
+                    used_bytes = d + u
+        expiry_ms = int(c.get('expiryTime', 0) or 0)
+        expire = int(expiry_ms / 1000) if expiry_ms > 0 else 0
+        subid = c.get('subId') or ''
+        # Build subscription URL
+        if self.sub_base:
+            origin = self.sub_base
+        else:
+            parts = urlsplit(self.base_url)
+            host = parts.hostname or ''
+            port = ''
+            if parts.port and not ((parts.scheme == 'http' and parts.port == 80) or (parts.scheme == 'https' and parts.port == 443)):
+                port = f":{parts.port}"
+            origin = f"{parts.scheme}://{host}{port}"
+        sub_link = f"{origin}/sub/{subid}?name={subid}" if subid else ''
+        return {
+            'data_limit': total_bytes,
+            'used_traffic': used_bytes,
+            'expire': expire,
+            'subscription_url': sub_link,
+        }, "Success"
 
     def _fetch_inbound_detail(self, inbound_id: int):
         # Try multiple endpoints to fetch inbound detail including settings
@@ -636,7 +1162,7 @@ class XuiAPI(BasePanelAPI):
             f"/xui/api/inbounds/get/{inbound_id}",
             f"/panel/api/inbounds/get/{inbound_id}",
         ]
-        for p in paths:
+        for p in self._ordered_endpoints(paths):
             try:
                 resp = self.session.get(f"{self.base_url}{p}", headers={'Accept': 'application/json'}, timeout=12)
                 if resp.status_code != 200:
@@ -644,6 +1170,7 @@ class XuiAPI(BasePanelAPI):
                 data = resp.json()
                 inbound = data.get('obj') if isinstance(data, dict) else data
                 if isinstance(inbound, dict):
+                    self._remember_endpoint(p)
                     return inbound
             except Exception:
                 continue
@@ -762,7 +1289,7 @@ class XuiAPI(BasePanelAPI):
                     return None, (last_err or "به‌روزرسانی کلاینت ناموفق بود")
         return None, "کلاینت برای تمدید یافت نشد"
 
-    async def create_user(self, user_id, plan):
+    async def create_user(self, user_id, plan, username=None):
         return None, None, "برای X-UI ابتدا اینباند را انتخاب کنید."
 
     def renew_user_on_inbound(self, inbound_id: int, username: str, add_gb: float, add_days: int):
@@ -1333,7 +1860,8 @@ class ThreeXuiAPI(BasePanelAPI):
         if _sb and '://' not in _sb:
             _sb = f"http://{_sb}"
         self.sub_base = _sb
-        self.session = requests.Session()
+        self.session = new_session()
+        self.api_prefix = panel_row.get('api_prefix') if isinstance(panel_row, dict) else None
         self._json_headers = {
             'Accept': 'application/json',
             'Content-Type': 'application/json',
@@ -1391,7 +1919,7 @@ class ThreeXuiAPI(BasePanelAPI):
             ]
             last_error = None
             for attempt in range(2):
-                for url in endpoints:
+                for url in self._ordered_endpoints(endpoints):
                     try:
                         resp = self.session.get(url, headers=self._json_headers, timeout=12)
                     except requests.RequestException as e:
@@ -1433,9 +1961,10 @@ class ThreeXuiAPI(BasePanelAPI):
                             'protocol': it.get('protocol') or it.get('type') or 'unknown',
                             'port': it.get('port') or it.get('listen_port') or 0,
                         })
+                    self._remember_endpoint(url)
                     return inbounds, "Success"
                 if attempt == 0:
-                    self.get_token()
+                    self.get_token(force=True)
             return None, (last_error or 'Unknown')
         except requests.RequestException as e:
             logger.error(f"3x-UI list_inbounds error: {e}")
@@ -1448,7 +1977,7 @@ class ThreeXuiAPI(BasePanelAPI):
             f"{self.base_url}/xui/API/inbounds/getClientTraffics/{inbound_id}",
             f"{self.base_url}/panel/API/inbounds/getClientTraffics/{inbound_id}",
         ]
-        for url in endpoints:
+        for url in self._ordered_endpoints(endpoints):
             try:
                 resp = self.session.get(url, headers=self._json_headers, timeout=12)
                 if resp.status_code != 200:
@@ -1456,6 +1985,7 @@ class ThreeXuiAPI(BasePanelAPI):
                 data = resp.json()
                 items = data.get('obj') if isinstance(data, dict) else data
                 if isinstance(items, list):
+                    self._remember_endpoint(url)
                     return items
             except Exception:
                 continue
@@ -1468,7 +1998,7 @@ class ThreeXuiAPI(BasePanelAPI):
             f"{self.base_url}/xui/API/inbounds/getClientTraffics/{email}",
             f"{self.base_url}/panel/API/inbounds/getClientTraffics/{email}",
         ]
-        for url in endpoints:
+        for url in self._ordered_endpoints(endpoints):
             try:
                 resp = self.session.get(url, headers=self._json_headers, timeout=12)
                 if resp.status_code != 200:
@@ -1476,16 +2006,17 @@ class ThreeXuiAPI(BasePanelAPI):
                 data = resp.json()
                 obj = data.get('obj') if isinstance(data, dict) else data
                 if isinstance(obj, dict):
+                    self._remember_endpoint(url)
                     return obj
             except Exception:
                 continue
         return None
 
-    def create_user_on_inbound(self, inbound_id: int, user_id: int, plan):
+    def create_user_on_inbound(self, inbound_id: int, user_id: int, plan, enable: bool = True, username=None):
         if not self.get_token():
             return None, None, "خطا در ورود به پنل 3x-UI"
         try:
-            new_username = f"user_{user_id}_{uuid.uuid4().hex[:6]}"
+            new_username = username or f"user_{user_id}_{uuid.uuid4().hex[:6]}"
             import random, string
             subid = ''.join(random.choices(string.ascii_lowercase + string.digits, k=12))
             try:
@@ -1505,7 +2036,7 @@ class ThreeXuiAPI(BasePanelAPI):
                 "email": new_username,
                 "totalGB": total_bytes,
                 "expiryTime": expiry_ms,
-                "enable": True,
+                "enable": enable,
                 "limitIp": 0,
                 "subId": subid,
                 "reset": 0
@@ -1605,95 +2136,82 @@ class ThreeXuiAPI(BasePanelAPI):
             return None, None, str(e)
 
     async def get_all_users(self):
-        return None, "Not supported for 3x-UI"
+        return self._xui_all_users()
+
+    async def get_users_bulk(self, usernames):
+        return self._xui_users_bulk(usernames)
 
     async def get_user(self, username):
         if not self.get_token():
             return None, "خطا در ورود به پنل 3x-UI"
-        inbounds, msg = self.list_inbounds()
-        if not inbounds:
+        inbound_id, c, msg = self._find_client(username)
+        if c is None:
             return None, msg
-        for ib in inbounds:
-            inbound_id = ib.get('id')
-            inbound = self._fetch_inbound_detail(inbound_id)
-            if not inbound:
-                continue
-            settings_str = inbound.get('settings')
+        total_bytes = int(c.get('totalGB', 0) or 0)
+        used_bytes = 0
+        try:
+            down = int(c.get('downlink', 0) or 0)
+        except Exception:
+            down = 0
+        try:
+            up = int(c.get('uplink', 0) or 0)
+        except Exception:
+            up = 0
+        try:
+            used_bytes = int(c.get('total', 0) or 0)
+        except Exception:
+            used_bytes = down + up
+        if used_bytes == 0:
+            # try stats endpoint
+            stats = []
             try:
-                settings_obj = json.loads(settings_str) if isinstance(settings_str, str) else {}
+                stats = self._fetch_client_traffics(inbound_id)
             except Exception:
-                settings_obj = {}
-            clients = settings_obj.get('clients') or []
-            if not isinstance(clients, list):
-                continue
-            for c in clients:
-                if c.get('email') == username:
-                    total_bytes = int(c.get('totalGB', 0) or 0)
-                    used_bytes = 0
+                stats = []
+            for s in (stats or []):
+                if (s.get('email') or s.get('name')) == username:
                     try:
-                        down = int(c.get('downlink', 0) or 0)
+                        d = int(s.get('down') or s.get('download') or 0)
                     except Exception:
-                        down = 0
+                        d = 0
                     try:
-                        up = int(c.get('uplink', 0) or 0)
+                        u = int(s.get('up') or s.get('upload') or 0)
                     except Exception:
-                        up = 0
+                        u = 0
+                    used_bytes = d + u
+                    break
+            if used_bytes == 0:
+                # direct by email
+                s = self._fetch_client_traffic_by_email(username)
+                if isinstance(s, dict):
                     try:
-                        used_bytes = int(c.get('total', 0) or 0)
+                        d = int(s.get('down') or s.get('download') or 0)
                     except Exception:
-                        used_bytes = down + up
-                    if used_bytes == 0:
-                        # try stats endpoint
-                        stats = []
-                        try:
-                            stats = self._fetch_client_traffics(inbound_id)
-                        except Exception:
-                            stats = []
-                        for s in (stats or []):
-                            if (s.get('email') or s.get('name')) == username:
-                                try:
-                                    d = int(s.get('down') or s.get('download') or 0)
-                                except Exception:
-                                    d = 0
-                                try:
-                                    u = int(s.get('up') or s.get('upload') or 0)
-                                except Exception:
-                                    u = 0
-                                used_bytes = d + u
-                                break
-                        if used_bytes == 0:
-                            # direct by email
-                            s = self._fetch_client_traffic_by_email(username)
-                            if isinstance(s, dict):
-                                try:
-                                    d = int(s.get('down') or s.get('download') or 0)
-                                except Exception:
-                                    d = 0
-                                try:
-                                    u = int(s.get('up') or s.get('upload') or 0)
-                                except Exception:
-                                    u = 0
-                                used_bytes = d + u
-                    expiry_ms = int(c.get('expiryTime', 0) or 0)
-                    expire = int(expiry_ms / 1000) if expiry_ms > 0 else 0
-                    subid = c.get('subId') or ''
-                    if self.sub_base:
-                        origin = self.sub_base
-                    else:
-                        parts = urlsplit(self.base_url)
-                        host = parts.hostname or ''
-                        port = ''
-                        if parts.port and not ((parts.scheme == 'http' and parts.port == 80) or (parts.scheme == 'https' and parts.port == 443)):
-                            port = f":{parts.port}"
-                        origin = f"{parts.scheme}://{host}{port}"
-                    sub_link = f"{origin}/sub/{subid}" if subid else ''
-                    return {
-                        'data_limit': total_bytes,
-                        'used_traffic': used_bytes,
-                        'expire': expire,
-                        'subscription_url': sub_link,
-                    }, "Success"
-        return None, "کاربر یافت نشد"
+                        d = 0
+                    try:
+                        u = int(s.get('up') or s.get('upload') or 0)
+                    except Exception:
+                        u = 0
+                    used_bytes = d + u
+        expiry_ms = int(c.get('expiryTime', 0) or 0)
+        expire = int(expiry_ms / 1000) if expiry_ms > 0 else 0
+        subid = c.get('subId') or ''
+        if self.sub_base:
+            origin = self.sub_base
+        else:
+            parts = urlsplit(self.base_url)
+            host = parts.hostname or ''
+            port = ''
+            if parts.port and not ((parts.scheme == 'http' and parts.port == 80) or (parts.scheme == 'https' and parts.port == 443)):
+                port = f":{parts.port}"
+            origin = f"{parts.scheme}://{host}{port}"
+        sub_link = f"{origin}/sub/{subid}" if subid else ''
+        return {
+            'data_limit': total_bytes,
+            'used_traffic': used_bytes,
+            'expire': expire,
+            'subscription_url': sub_link,
+        }, "Success"
 
     def _fetch_inbound_detail(self, inbound_id: int):
         paths = [
@@ -1704,7 +2222,7 @@ class ThreeXuiAPI(BasePanelAPI):
             f"/xui/API/inbounds/get/{inbound_id}",
             f"/panel/API/inbounds/get/{inbound_id}",
         ]
-        for p in paths:
+        for p in self._ordered_endpoints(paths):
             try:
                 resp = self.session.get(f"{self.base_url}{p}", headers={'Accept': 'application/json'}, timeout=12)
                 if resp.status_code != 200:
@@ -1712,6 +2230,7 @@ class ThreeXuiAPI(BasePanelAPI):
                 data = resp.json()
                 inbound = data.get('obj') if isinstance(data, dict) else data
                 if isinstance(inbound, dict):
+                    self._remember_endpoint(p)
                     return inbound
             except Exception:
                 continue
@@ -2165,7 +2684,8 @@ class TxUiAPI(BasePanelAPI):
         if _sb and '://' not in _sb:
             _sb = f"http://{_sb}"
         self.sub_base = _sb
-        self.session = requests.Session()
+        self.session = new_session()
+        self.api_prefix = panel_row.get('api_prefix') if isinstance(panel_row, dict) else None
         self._json_headers = {
             'Accept': 'application/json',
             'Content-Type': 'application/json',
@@ -2198,7 +2718,7 @@ class TxUiAPI(BasePanelAPI):
             ]
             last_error = None
             for attempt in range(2):
-                for url in endpoints:
+                for url in self._ordered_endpoints(endpoints):
                     resp = self.session.get(url, headers=self._json_headers, timeout=12)
                     if resp.status_code != 200:
                         last_error = f"HTTP {resp.status_code}"
@@ -2236,9 +2756,10 @@ class TxUiAPI(BasePanelAPI):
                             'protocol': it.get('protocol') or it.get('type') or 'unknown',
                             'port': it.get('port') or it.get('listen_port') or 0,
                         })
+                    self._remember_endpoint(url)
                     return inbounds, "Success"
                 if attempt == 0:
-                    self.get_token()
+                    self.get_token(force=True)
             if last_error:
                 logger.error(f"TX-UI list_inbounds error: {last_error}")
                 return None, last_error
@@ -2247,11 +2768,11 @@ class TxUiAPI(BasePanelAPI):
             logger.error(f"TX-UI list_inbounds error: {e}")
             return None, str(e)
 
-    def create_user_on_inbound(self, inbound_id: int, user_id: int, plan):
+    def create_user_on_inbound(self, inbound_id: int, user_id: int, plan, enable: bool = True, username=None):
         if not self.get_token():
             return None, None, "خطا در ورود به پنل TX-UI"
         try:
-            new_username = f"user_{user_id}_{uuid.uuid4().hex[:6]}"
+            new_username = username or f"user_{user_id}_{uuid.uuid4().hex[:6]}"
             import random, string
             subid = ''.join(random.choices(string.ascii_lowercase + string.digits, k=12))
             try:
@@ -2270,7 +2791,7 @@ class TxUiAPI(BasePanelAPI):
                 "email": new_username,
                 "totalGB": total_bytes,
                 "expiryTime": expiry_ms,
-                "enable": True,
+                "enable": enable,
                 "limitIp": 0,
                 "subId": subid,
                 "reset": 0
@@ -2364,50 +2885,37 @@ class TxUiAPI(BasePanelAPI):
             return None, None, str(e)
 
     async def get_all_users(self):
-        return None, "Not supported for TX-UI"
+        return self._xui_all_users()
+
+    async def get_users_bulk(self, usernames):
+        return self._xui_users_bulk(usernames)
 
     async def get_user(self, username):
         if not self.get_token():
             return None, "خطا در ورود به پنل TX-UI"
-        inbounds, msg = self.list_inbounds()
-        if not inbounds:
+        inbound_id, c, msg = self._find_client(username)
+        if c is None:
             return None, msg
-        for ib in inbounds:
-            inbound_id = ib.get('id')
-            inbound = self._fetch_inbound_detail(inbound_id)
-            if not inbound:
-                continue
-            settings_str = inbound.get('settings')
-            try:
-                settings_obj = json.loads(settings_str) if isinstance(settings_str, str) else {}
-            except Exception:
-                settings_obj = {}
-            clients = settings_obj.get('clients') or []
-            if not isinstance(clients, list):
-                continue
-            for c in clients:
-                if c.get('email') == username:
-                    total_bytes = int(c.get('totalGB', 0) or 0)
-                    expiry_ms = int(c.get('expiryTime', 0) or 0)
-                    expire = int(expiry_ms / 1000) if expiry_ms > 0 else 0
-                    subid = c.get('subId') or ''
-                    if self.sub_base:
-                        origin = self.sub_base
-                    else:
-                        parts = urlsplit(self.base_url)
-                        host = parts.hostname or ''
-                        port = ''
-                        if parts.port and not ((parts.scheme == 'http' and parts.port == 80) or (parts.scheme == 'https' and parts.port == 443)):
-                            port = f":{parts.port}"
-                        origin = f"{parts.scheme}://{host}{port}"
-                    sub_link = f"{origin}/sub/{subid}" if subid else ''
-                    return {
-                        'data_limit': total_bytes,
-                        'used_traffic': 0,
-                        'expire': expire,
-                        'subscription_url': sub_link,
-                    }, "Success"
-        return None, "کاربر یافت نشد"
+        total_bytes = int(c.get('totalGB', 0) or 0)
+        expiry_ms = int(c.get('expiryTime', 0) or 0)
+        expire = int(expiry_ms / 1000) if expiry_ms > 0 else 0
+        subid = c.get('subId') or ''
+        if self.sub_base:
+            origin = self.sub_base
+        else:
+            parts = urlsplit(self.base_url)
+            host = parts.hostname or ''
+            port = ''
+            if parts.port and not ((parts.scheme == 'http' and parts.port == 80) or (parts.scheme == 'https' and parts.port == 443)):
+                port = f":{parts.port}"
+            origin = f"{parts.scheme}://{host}{port}"
+        sub_link = f"{origin}/sub/{subid}" if subid else ''
+        return {
+            'data_limit': total_bytes,
+            'used_traffic': 0,
+            'expire': expire,
+            'subscription_url': sub_link,
+        }, "Success"
 
     def _fetch_inbound_detail(self, inbound_id: int):
         paths = [
@@ -2415,7 +2923,7 @@ class TxUiAPI(BasePanelAPI):
             f"/xui/api/inbounds/get/{inbound_id}",
             f"/panel/api/inbounds/get/{inbound_id}",
         ]
-        for p in paths:
+        for p in self._ordered_endpoints(paths):
             try:
                 resp = self.session.get(f"{self.base_url}{p}", headers={'Accept': 'application/json'}, timeout=12)
                 if resp.status_code != 200:
@@ -2423,6 +2931,7 @@ class TxUiAPI(BasePanelAPI):
                 data = resp.json()
                 inbound = data.get('obj') if isinstance(data, dict) else data
                 if isinstance(inbound, dict):
+                    self._remember_endpoint(p)
                     return inbound
             except Exception:
                 continue
@@ -2802,7 +3311,7 @@ class MarzneshinAPI(BasePanelAPI):
         if _sb and '://' not in _sb:
             _sb = f"http://{_sb}"
         self.sub_base = _sb
-        self.session = requests.Session()
+        self.session = new_session()
         self._json_headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
         self._last_token_error = None
         
@@ -3120,7 +3629,7 @@ class MarzneshinAPI(BasePanelAPI):
             logger.error(f"Marzneshin create_user_on_inbound error: {e}")
             return None, None, str(e)
 
-    async def create_user(self, user_id, plan):
+    async def create_user(self, user_id, plan, username=None):
         """Create a user via Marzneshin API and return subscription link only.
 
         Returns: (username, subscription_url, message)
@@ -3131,7 +3640,7 @@ class MarzneshinAPI(BasePanelAPI):
             return None, None, f"توکن دریافت نشد: {detail}"
         try:
             # Build minimal payload; Marzneshin /api/users accepts username + optional expire/data_limit
-            new_username = f"user_{user_id}_{uuid.uuid4().hex[:6]}"
+            new_username = username or f"user_{user_id}_{uuid.uuid4().hex[:6]}"
             payload_user = {"username": new_username}
             try:
                 days = int(plan['duration_days'])
@@ -3166,6 +3675,60 @@ class MarzneshinAPI(BasePanelAPI):
         except requests.RequestException as e:
             return None, None, str(e)
 
+    async def get_users_bulk(self, usernames):
+        # Marzneshin: page /api/users; each item already carries data_limit/used_traffic/expire
+        wanted = {u for u in (usernames or []) if u}
+        if not wanted:
+            return {}, "Success"
+        if not self.token and not self._ensure_token():
+            detail = (self._last_token_error or "نامشخص")
+            return None, f"توکن دریافت نشد: {detail}"
+        headers = {"Accept": "application/json", "Authorization": f"Bearer {self.token}"}
+        found = {}
+        page_no = 1
+        try:
+            while len(found) < len(wanted):
+                r = self.session.get(
+                    f"{self.base_url}/api/users",
+                    params={'page': page_no, 'size': _BULK_PAGE_SIZE},
+                    headers=headers,
+                    timeout=20,
+                )
+                if r.status_code != 200:
+                    return None, f"HTTP {r.status_code} @ /api/users"
+                data = r.json()
+                items = data.get('items') if isinstance(data, dict) else data
+                for u in (items or []):
+                    name = u.get('username') if isinstance(u, dict) else None
+                    if name not in wanted:
+                        continue
+                    expire_ts = 0
+                    if isinstance(u.get('expire'), (int, float)):
+                        expire_ts = int(u['expire'])
+                    else:
+                        ed = u.get('expire_date') or u.get('expireDate')
+                        if isinstance(ed, str) and ed:
+                            try:
+                                expire_ts = int(datetime.fromisoformat(ed.replace('Z', '+00:00')).timestamp())
+                            except Exception:
+                                expire_ts = 0
+                    sub_url = u.get('subscription_url') or ''
+                    if isinstance(sub_url, str) and sub_url and not sub_url.startswith('http'):
+                        sub_url = f"{self.base_url}{sub_url}"
+                    found[name] = {
+                        'username': name,
+                        'data_limit': int(u.get('data_limit') or 0),
+                        'used_traffic': int(u.get('used_traffic') or 0),
+                        'expire': expire_ts,
+                        'subscription_url': sub_url,
+                    }
+                if not isinstance(data, dict) or page_no >= int(data.get('pages') or 1) or not items:
+                    break
+                page_no += 1
+            return found, "Success"
+        except (requests.RequestException, ValueError) as e:
+            return None, str(e)
+
     async def get_user(self, username):
         # Marzneshin: use /api/users/{username} for core info and /sub/{username}/{key}/info|usage for stats
         # 1) Ensure token and get user
@@ -3336,7 +3899,7 @@ class MarzneshinAPI(BasePanelAPI):
         except requests.RequestException as e:
             return None, str(e)
 
-    async def create_user(self, user_id, plan):
+    async def create_user(self, user_id, plan, username=None):
         # Ensure token
         if not self.token and not self._ensure_token():
             detail = (self._last_token_error or "نامشخص")
@@ -3443,7 +4006,7 @@ class MarzneshinAPI(BasePanelAPI):
             dt = (datetime.utcnow() + timedelta(days=days)).isoformat()
             expire_date = dt
             expire_strategy = "fixed_date"
-        new_username = f"user_{user_id}_{uuid.uuid4().hex[:6]}"
+        new_username = username or f"user_{user_id}_{uuid.uuid4().hex[:6]}"
         payload = {
             "username": new_username,
         }
@@ -3860,7 +4423,7 @@ class NeticoAPI(BasePanelAPI):
         self.base_url = _raw
         self.username = panel_row['username']
         self.password = panel_row['password']
-        self.session = requests.Session()
+        self.session = new_session()
         self.cookies = None
         self.agent_id = panel_row.get('agent_id') or NETICO_AGENT_ID  # Default agent ID
         
@@ -4149,13 +4712,13 @@ class NeticoAPI(BasePanelAPI):
             logger.error(f"Failed to login to Netico panel: {e}")
             return False
     
-    async def create_user(self, user_id, plan):
+    async def create_user(self, user_id, plan, username=None):
         """Create a new user in Netico panel"""
         if not self.cookies and not self.get_token():
             return None, None, "خطا در اتصال به پنل. لطفا تنظیمات را بررسی کنید."
         import uuid
         # Generate random username and password
-        new_username = f"user_{user_id}_{uuid.uuid4().hex[:6]}"
+        new_username = username or f"user_{user_id}_{uuid.uuid4().hex[:6]}"
         import random
         new_password = ''.join([str(random.randint(0, 9)) for _ in range(4)])  # 4-digit password
         
@@ -4367,6 +4930,14 @@ class NeticoAPI(BasePanelAPI):
             processed_users.append(processed_user)
         
         return processed_users, "Success"
+
+    async def get_users_bulk(self, usernames):
+        """Read the requested users from database in one query"""
+        wanted = {u for u in (usernames or []) if u}
+        users, msg = await self.get_all_users()
+        if users is None:
+            return None, msg
+        return {u['username']: u for u in users if u.get('username') in wanted}, "Success"
     
     async def renew_user_in_panel(self, username, plan):
         """Renew user in Netico panel"""
@@ -4411,10 +4982,7 @@ class NeticoAPI(BasePanelAPI):
         return updated_user, "Success"
 
 
-def VpnPanelAPI(panel_id: int) -> BasePanelAPI:
-    panel_row = query_db("SELECT * FROM panels WHERE id = ?", (panel_id,), one=True)
-    if not panel_row:
-        raise ValueError(f"Panel with ID {panel_id} not found in database.")
+def _build_panel_client(panel_row) -> BasePanelAPI:
     ptype = (panel_row.get('panel_type') or 'marzban').lower()
     if ptype == 'marzban':
         return MarzbanAPI(panel_row)
@@ -4430,4 +4998,34 @@ def VpnPanelAPI(panel_id: int) -> BasePanelAPI:
         return NeticoAPI(panel_row)
     logger.error(f"Unknown panel type '{ptype}' for panel {panel_row['name']}")
     return MarzbanAPI(panel_row)
-    
\ No newline at end of file
+
+
+# Process-wide registry: one live client (session, token, cookies) per panel.
+# Rebuilt whenever the panel's connection fields change; admin edits call drop_panel_client().
+_panel_clients: dict[int, tuple[tuple, BasePanelAPI]] = {}
+_panel_clients_lock = threading.Lock()
+_PANEL_FINGERPRINT_FIELDS = ('panel_type', 'url', 'username', 'password', 'token', 'sub_base')
+
+
+def drop_panel_client(panel_id: int | None = None) -> None:
+    with _panel_clients_lock:
+        if panel_id is None:
+            _panel_clients.clear()
+        else:
+            _panel_clients.pop(int(panel_id), None)
+
+
+def VpnPanelAPI(panel_id: int) -> BasePanelAPI:
+    panel_row = query_db("SELECT * FROM panels WHERE id = ?", (panel_id,), one=True)
+    if not panel_row:
+        drop_panel_client(panel_id)
+        raise ValueError(f"Panel with ID {panel_id} not found in database.")
+    fingerprint = tuple(panel_row.get(k) for k in _PANEL_FINGERPRINT_FIELDS)
+    with _panel_clients_lock:
+        cached = _panel_clients.get(int(panel_id))
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+        client = _build_panel_client(panel_row)
+        client._install_auth_hooks()
+        _panel_clients[int(panel_id)] = (fingerprint, client)
+        return client
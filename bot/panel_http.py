@@ -0,0 +1,95 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .config import PANEL_HTTP_WORKERS, PANEL_HTTP_MAX_PER_HOST, PANEL_HTTP_MAX_HOSTS, PANEL_SCAN_CONCURRENCY
+
+# Shared transport for every panel adapter in panel.py.
+#
+# All adapters mount the same HTTPAdapter, so keep-alive connections are pooled per host
+# across panels and calls, and `pool_block=True` caps concurrent connections to any one
+# host at PANEL_HTTP_MAX_PER_HOST. Cookies and auth headers stay on each adapter's own
+# Session. Blocking panel work runs on a dedicated worker pool so a slow or dead panel
+# only ties up panel workers, never the bot's event loop.
+
+_adapter = HTTPAdapter(
+    pool_connections=PANEL_HTTP_MAX_HOSTS,
+    pool_maxsize=PANEL_HTTP_MAX_PER_HOST,
+    pool_block=True,
+    max_retries=0,
+)
+_executor = ThreadPoolExecutor(max_workers=PANEL_HTTP_WORKERS, thread_name_prefix='panel-http')
+_worker = threading.local()
+# Fan-out threads for scans started from a panel worker; separate so a scan never waits on
+# the pool it is running in
+_scan_executor = ThreadPoolExecutor(max_workers=PANEL_HTTP_WORKERS, thread_name_prefix='panel-scan')
+
+
+def new_session() -> requests.Session:
+    session = requests.Session()
+    session.mount('http://', _adapter)
+    session.mount('https://', _adapter)
+    return session
+
+
+def _on_worker() -> bool:
+    return getattr(_worker, 'active', False)
+
+
+def _call_on_worker(fn, *args, **kwargs):
+    _worker.active = True
+    return fn(*args, **kwargs)
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Await a blocking panel call (e.g. `api.list_inbounds`) without stalling the event loop."""
+    if _on_worker():
+        return fn(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(_call_on_worker, fn, *args, **kwargs))
+
+
+def _run_coroutine_here(coro_fn, *args, **kwargs):
+    # Each worker thread keeps its own private loop to drive adapter coroutines
+    loop = getattr(_worker, 'loop', None)
+    if loop is None or loop.is_closed():
+        loop = asyncio.new_event_loop()
+        _worker.loop = loop
+    return loop.run_until_complete(coro_fn(*args, **kwargs))
+
+
+def offload(coro_fn):
+    """Run an adapter coroutine whose body does blocking HTTP on the panel worker pool.
+
+    Calls made from inside a worker (e.g. renew_user_in_panel awaiting get_user) run inline.
+    """
+    @functools.wraps(coro_fn)
+    async def wrapper(*args, **kwargs):
+        if _on_worker():
+            return await coro_fn(*args, **kwargs)
+        return await run_blocking(_run_coroutine_here, coro_fn, *args, **kwargs)
+
+    return wrapper
+
+
+def iter_bounded(fn, items, limit: int = PANEL_SCAN_CONCURRENCY):
+    """Yield fn(item) for every item in completion order, with at most `limit` calls in flight."""
+    pending = set()
+    try:
+        for item in items:
+            pending.add(_scan_executor.submit(fn, item))
+            if len(pending) >= limit:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    yield fut.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                yield fut.result()
+    finally:
+        for fut in pending:
+            fut.cancel()
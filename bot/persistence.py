@@ -0,0 +1,152 @@
+import asyncio
+import json
+import pickle
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from .config import PERSISTENCE_UPDATE_SECONDS, logger
+from .db import arun_transaction, query_db
+
+# user_data and ConversationHandler states kept in the bot's SQLite DB, so a restart does not
+# drop a purchase, renewal or top-up half way through.
+#
+# python-telegram-bot collects what changed and hands it over every PERSISTENCE_UPDATE_SECONDS
+# (never per update). The update_* calls only buffer the new values; one write-behind task
+# then stores the whole batch in a single transaction on the DB writer thread. Everything is
+# loaded back when the application starts. user_data is pickled, as PTB's own persistence
+# does, since flows may keep any Python value there.
+
+
+class SqlitePersistence(BasePersistence):
+    def __init__(self, update_interval: float = PERSISTENCE_UPDATE_SECONDS):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._pending_users: dict[int, bytes | None] = {}  # None = delete
+        self._pending_conversations: dict[tuple[str, str], str | None] = {}
+        self._flush_task = None
+        self._write_lock = asyncio.Lock()
+
+    # --- loading ---
+
+    async def get_user_data(self) -> dict:
+        data = {}
+        for row in query_db("SELECT user_id, data FROM persisted_user_data") or []:
+            try:
+                data[int(row['user_id'])] = pickle.loads(row['data'])
+            except Exception as e:
+                logger.warning(f"Persistence: dropping unreadable user_data of {row['user_id']}: {e}")
+        logger.info(f"Persistence: restored user_data for {len(data)} users")
+        return data
+
+    async def get_conversations(self, name: str) -> dict:
+        conversations = {}
+        for row in query_db("SELECT conv_key, state FROM persisted_conversations WHERE name = ?", (name,)) or []:
+            try:
+                conversations[tuple(json.loads(row['conv_key']))] = json.loads(row['state'])
+            except Exception as e:
+                logger.warning(f"Persistence: dropping unreadable {name} state {row['conv_key']}: {e}")
+        if conversations:
+            logger.info(f"Persistence: restored {len(conversations)} {name} conversations")
+        return conversations
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # --- buffering ---
+
+    def _schedule_flush(self) -> None:
+        # PTB hands over a whole batch in one gather; the task runs once all of it is buffered
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._write_pending())
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        if not data:
+            self._pending_users[user_id] = None
+        else:
+            try:
+                self._pending_users[user_id] = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                # Drop the stored copy too, or its stale flow state would come back on restart
+                logger.warning(f"Persistence: user_data of {user_id} cannot be stored, dropping the saved copy: {e}")
+                self._pending_users[user_id] = None
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending_users[user_id] = None
+        self._schedule_flush()
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        self._pending_conversations[(name, json.dumps(list(key)))] = None if new_state is None else json.dumps(new_state)
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    # --- writing ---
+
+    @staticmethod
+    def _write(conn, users: dict, conversations: dict) -> None:
+        conn.executemany(
+            "INSERT INTO persisted_user_data (user_id, data) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+            [(uid, data) for uid, data in users.items() if data is not None],
+        )
+        conn.executemany(
+            "DELETE FROM persisted_user_data WHERE user_id = ?",
+            [(uid,) for uid, data in users.items() if data is None],
+        )
+        conn.executemany(
+            "INSERT INTO persisted_conversations (name, conv_key, state) VALUES (?, ?, ?) "
+            "ON CONFLICT(name, conv_key) DO UPDATE SET state = excluded.state",
+            [(name, key, state) for (name, key), state in conversations.items() if state is not None],
+        )
+        conn.executemany(
+            "DELETE FROM persisted_conversations WHERE name = ? AND conv_key = ?",
+            [(name, key) for (name, key), state in conversations.items() if state is None],
+        )
+
+    async def _write_pending(self) -> None:
+        async with self._write_lock:
+            users, self._pending_users = self._pending_users, {}
+            conversations, self._pending_conversations = self._pending_conversations, {}
+            if not users and not conversations:
+                return
+            try:
+                await arun_transaction(self._write, users, conversations)
+            except Exception as e:
+                logger.error(f"Persistence: write failed, will retry with the next batch: {e}")
+                # Newer values buffered meanwhile win over the failed ones
+                self._pending_users = {**users, **self._pending_users}
+                self._pending_conversations = {**conversations, **self._pending_conversations}
+
+    async def flush(self) -> None:
+        """Called on shutdown after PTB's final hand-over; waits until everything is written."""
+        if self._flush_task is not None:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self._write_pending()
@@ -0,0 +1,291 @@
+import asyncio
+import time
+from datetime import datetime
+from uuid import uuid4
+from html import escape as html_escape
+
+from telegram.constants import ParseMode
+from telegram.error import BadRequest
+from telegram.ext import CallbackContext
+
+from .config import (
+    PROVISIONING_WORKERS,
+    PROVISIONING_PANEL_CONCURRENCY,
+    PROVISIONING_MAX_ATTEMPTS,
+    PROVISIONING_RETRY_SECONDS,
+    logger,
+)
+from .db import aexecute_db, aquery_db, arun_transaction
+
+# Persistent provisioning jobs: create the panel user of an order and deliver it.
+#
+# Approving an order (or paying it from the wallet) only queues a job, so the callback
+# returns at once with a "processing" note. A dispatcher runs due jobs in the background,
+# at most PROVISIONING_WORKERS at a time and PROVISIONING_PANEL_CONCURRENCY per panel, so
+# one slow panel can't hold every worker. A job that fails before its order is approved is
+# retried after PROVISIONING_RETRY_SECONDS, doubled on each attempt, until
+# PROVISIONING_MAX_ATTEMPTS; then it is marked failed. Jobs left 'running' by a crash are
+# marked failed rather than run again, since their panel user may already exist.
+#
+# Creating a panel user is not idempotent: the panel may create it and the response still
+# be lost. So a job's username is fixed (job_username) before its first create request, and
+# a retry first looks that user up on the panel and delivers it if it is there; panels reject
+# a second user or client with the same name, so a retry never leaves a duplicate behind.
+#
+# The work itself stays with the approval handlers (handlers/admin.py, see _kinds). An
+# executor takes (context, job) and returns (status, note): status is 'done', 'retry' or
+# 'failed', and the HTML note is appended to the admin message the job was queued from.
+
+_IDLE_POLL_SECONDS = 60
+_STOP_WAIT_SECONDS = 30
+
+_running: dict[int, asyncio.Task] = {}
+_panel_load: dict[int, int] = {}  # panel_id -> jobs running on it
+_state = {'wakeup': None, 'dispatcher': None}
+
+
+def _kinds() -> dict:
+    # kind -> (executor, hook run once the job has finally failed)
+    from .handlers.admin import provision_on_panel, provision_on_inbound, provision_wallet_order, wallet_order_to_admins
+    return {
+        'panel': (provision_on_panel, None),
+        'inbound': (provision_on_inbound, None),
+        'wallet': (provision_wallet_order, wallet_order_to_admins),
+    }
+
+
+def _now() -> str:
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _wake() -> None:
+    if _state['wakeup'] is not None:
+        _state['wakeup'].set()
+
+
+def _insert_job(conn, order_id: int, kind: str, panel_id, inbound_id, notice):
+    order = conn.execute("SELECT status FROM orders WHERE id = ?", (order_id,)).fetchone()
+    # Only orders still awaiting review are delivered; approved or rejected ones are settled
+    if not order or order['status'] != 'pending':
+        return None
+    active = conn.execute(
+        "SELECT 1 FROM provisioning_jobs WHERE order_id = ? AND status IN ('queued', 'running')", (order_id,)
+    ).fetchone()
+    if active:
+        return None
+    chat_id, message_id, is_media, text = notice or (None, None, False, None)
+    cur = conn.execute(
+        "INSERT INTO provisioning_jobs (order_id, kind, panel_id, inbound_id, status, next_attempt_at, "
+        "notice_chat_id, notice_message_id, notice_is_media, notice_text, created_at) "
+        "VALUES (?, ?, ?, ?, 'queued', 0, ?, ?, ?, ?, ?)",
+        (order_id, kind, panel_id, inbound_id, chat_id, message_id, 1 if is_media else 0, text, _now()),
+    )
+    return cur.lastrowid
+
+
+async def enqueue_provisioning(order_id: int, kind: str, panel_id=None, inbound_id=None, notice=None):
+    """Queue provisioning of an order; returns the job id, or None when the order is no longer
+    pending or has a job queued. `notice` is (chat_id, message_id, is_media, html_text) of the
+    admin message to report the outcome on."""
+    job_id = await arun_transaction(_insert_job, order_id, kind, panel_id, inbound_id, notice)
+    if job_id:
+        logger.info(f"Provisioning job #{job_id} queued ({kind}, order {order_id}, panel {panel_id})")
+        _wake()
+    return job_id
+
+
+def _cancel_queued(conn, order_id: int, reason: str) -> int:
+    return conn.execute(
+        "UPDATE provisioning_jobs SET status = 'failed', last_error = ?, finished_at = ? WHERE order_id = ? AND status = 'queued'",
+        (reason, _now(), order_id),
+    ).rowcount
+
+
+async def cancel_provisioning(order_id: int, reason: str = 'cancelled') -> int:
+    """Mark the order's queued jobs failed so they never run; returns how many were cancelled.
+    A job already running stops by itself, as executors only deliver pending orders."""
+    cancelled = await arun_transaction(_cancel_queued, order_id, reason)
+    if cancelled:
+        logger.info(f"Cancelled {cancelled} queued provisioning job(s) of order {order_id}: {reason}")
+    return cancelled
+
+
+async def set_job_username(job: dict, username: str) -> None:
+    await aexecute_db("UPDATE provisioning_jobs SET username = ? WHERE id = ?", (username, job['id']))
+    job['username'] = username
+
+
+async def job_username(job: dict, user_id: int) -> str:
+    """The panel username the job creates; picked once and kept on the job row for its retries."""
+    if not job.get('username'):
+        await set_job_username(job, f"user_{user_id}_{uuid4().hex[:6]}")
+    return job['username']
+
+
+def _claim_due(conn, slots: int, panel_load: dict) -> list:
+    rows = conn.execute(
+        "SELECT * FROM provisioning_jobs WHERE status = 'queued' AND next_attempt_at <= ? "
+        "ORDER BY next_attempt_at, id LIMIT 200",
+        (time.time(),),
+    ).fetchall()
+    load = dict(panel_load)
+    jobs = []
+    for row in rows:
+        panel_id = row['panel_id']
+        if panel_id is not None:
+            if load.get(panel_id, 0) >= PROVISIONING_PANEL_CONCURRENCY:
+                continue
+            load[panel_id] = load.get(panel_id, 0) + 1
+        job = dict(row)
+        job['attempts'] += 1
+        jobs.append(job)
+        if len(jobs) >= slots:
+            break
+    conn.executemany(
+        "UPDATE provisioning_jobs SET status = 'running', attempts = attempts + 1 WHERE id = ?",
+        [(job['id'],) for job in jobs],
+    )
+    return jobs
+
+
+def _requeue(conn, job_id: int, next_attempt_at: float, error: str) -> None:
+    conn.execute(
+        "UPDATE provisioning_jobs SET status = 'queued', next_attempt_at = ?, last_error = ? WHERE id = ?",
+        (next_attempt_at, error, job_id),
+    )
+
+
+def _finish(conn, job_id: int, status: str, error) -> None:
+    conn.execute(
+        "UPDATE provisioning_jobs SET status = ?, last_error = ?, finished_at = ? WHERE id = ?",
+        (status, error, _now(), job_id),
+    )
+
+
+async def _edit_notice(bot, job: dict, note: str) -> None:
+    if not job.get('notice_chat_id'):
+        return
+    text = (job.get('notice_text') or '') + note
+    kwargs = dict(chat_id=job['notice_chat_id'], message_id=job['notice_message_id'], parse_mode=ParseMode.HTML, reply_markup=None)
+    try:
+        if job.get('notice_is_media'):
+            await bot.edit_message_caption(caption=text, **kwargs)
+        else:
+            await bot.edit_message_text(text=text, **kwargs)
+    except BadRequest as e:
+        if 'not modified' not in str(e).lower():
+            logger.warning(f"Provisioning job #{job['id']}: notice edit failed: {e}")
+    except Exception as e:
+        logger.warning(f"Provisioning job #{job['id']}: notice edit failed: {e}")
+
+
+async def _run(application, job: dict) -> None:
+    context = CallbackContext(application)
+    label = f"Provisioning job #{job['id']} ({job['kind']}, order {job['order_id']})"
+    try:
+        executor, on_failed = _kinds()[job['kind']]
+        try:
+            status, note = await executor(context, job)
+        except Exception as e:
+            logger.error(f"{label} raised on attempt {job['attempts']}: {e}")
+            status, note = 'retry', f"\n\n❌ <b>خطا:</b> <code>{html_escape(str(e))[:300]}</code>"
+        if status == 'retry' and job['attempts'] >= PROVISIONING_MAX_ATTEMPTS:
+            status = 'failed'
+        if status == 'retry':
+            delay = PROVISIONING_RETRY_SECONDS * 2 ** (job['attempts'] - 1)
+            await arun_transaction(_requeue, job['id'], time.time() + delay, note[:500])
+            logger.warning(f"{label}: attempt {job['attempts']} failed, retrying in {delay}s")
+            await _edit_notice(
+                application.bot, job,
+                note + f"\n⏳ تلاش مجدد ({job['attempts'] + 1}/{PROVISIONING_MAX_ATTEMPTS}) تا {delay} ثانیه دیگر...",
+            )
+            return
+        await arun_transaction(_finish, job['id'], status, None if status == 'done' else note[:500])
+        logger.info(f"{label}: {status} after {job['attempts']} attempt(s)")
+        if status == 'failed' and on_failed is not None:
+            await on_failed(context, job)
+        await _edit_notice(application.bot, job, note)
+    except Exception as e:
+        logger.error(f"{label}: worker error: {e}")
+    finally:
+        _running.pop(job['id'], None)
+        panel_id = job.get('panel_id')
+        if panel_id is not None:
+            _panel_load[panel_id] -= 1
+            if _panel_load[panel_id] <= 0:
+                _panel_load.pop(panel_id, None)
+        _wake()
+
+
+def _start(application, job: dict) -> None:
+    panel_id = job.get('panel_id')
+    if panel_id is not None:
+        _panel_load[panel_id] = _panel_load.get(panel_id, 0) + 1
+    _running[job['id']] = asyncio.get_running_loop().create_task(_run(application, job))
+
+
+async def _dispatch(application) -> None:
+    wakeup = _state['wakeup']
+    while True:
+        wakeup.clear()
+        timeout = _IDLE_POLL_SECONDS
+        try:
+            slots = PROVISIONING_WORKERS - len(_running)
+            if slots > 0:
+                for job in await arun_transaction(_claim_due, slots, dict(_panel_load)):
+                    _start(application, job)
+            # Sleep until the next retry falls due; jobs that are due but held back by a busy
+            # panel or a full pool are picked up when a running job finishes (it wakes us)
+            row = await aquery_db("SELECT MIN(next_attempt_at) AS due FROM provisioning_jobs WHERE status = 'queued'", one=True)
+            due = row.get('due') if row else None
+            if due is not None and due > time.time():
+                timeout = min(timeout, due - time.time())
+        except Exception as e:
+            logger.error(f"Provisioning dispatcher error: {e}")
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+def _settle_interrupted(conn) -> list:
+    rows = [dict(r) for r in conn.execute("SELECT * FROM provisioning_jobs WHERE status = 'running'").fetchall()]
+    conn.execute(
+        "UPDATE provisioning_jobs SET status = 'failed', last_error = 'interrupted', finished_at = ? WHERE status = 'running'",
+        (_now(),),
+    )
+    return rows
+
+
+async def start_provisioning(application) -> None:
+    """Called once at startup: settle jobs interrupted by a restart and start the dispatcher."""
+    _state['wakeup'] = asyncio.Event()
+    try:
+        interrupted = await arun_transaction(_settle_interrupted)
+        if interrupted:
+            logger.warning(f"Provisioning: {len(interrupted)} jobs interrupted by restart were marked failed")
+            context = CallbackContext(application)
+            kinds = _kinds()
+            for job in interrupted:
+                on_failed = kinds.get(job['kind'], (None, None))[1]
+                if on_failed is not None:
+                    await on_failed(context, job)
+                await _edit_notice(
+                    application.bot, job,
+                    "\n\n⚠️ ساخت سرویس با راه‌اندازی مجدد ربات نیمه‌کاره ماند؛ پنل را بررسی و در صورت نیاز دوباره اقدام کنید.",
+                )
+    except Exception as e:
+        logger.error(f"Could not settle interrupted provisioning jobs: {e}")
+    _state['dispatcher'] = asyncio.get_running_loop().create_task(_dispatch(application))
+
+
+async def stop_provisioning() -> None:
+    """Called on shutdown: stop taking jobs and give running ones a moment to finish."""
+    dispatcher = _state['dispatcher']
+    if dispatcher is not None:
+        dispatcher.cancel()
+        await asyncio.gather(dispatcher, return_exceptions=True)
+        _state['dispatcher'] = None
+    if _running:
+        logger.info(f"Provisioning: waiting for {len(_running)} running jobs")
+        await asyncio.wait(list(_running.values()), timeout=_STOP_WAIT_SECONDS)
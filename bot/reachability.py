@@ -0,0 +1,60 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from telegram.constants import ChatAction
+from telegram.error import BadRequest, Forbidden
+from telegram.ext import ContextTypes
+
+from .config import UNREACHABLE_REPROBE_DAYS, logger
+from .db import aexecute_db, aquery_db
+
+# users.reachable goes to 0 when Telegram reports that a user blocked the bot or the chat
+# no longer exists, and back to 1 when the user talks to the bot again (register_new_user)
+# or answers the optional periodic re-probe. Broadcast audiences and reminders skip
+# unreachable users.
+
+# SQL condition for "not known to be unreachable"; `{col}` is the user id column to test
+REACHABLE_CLAUSE = "NOT EXISTS (SELECT 1 FROM users ru WHERE ru.user_id = {col} AND ru.reachable = 0)"
+
+_GONE_MARKERS = ('chat not found', 'user is deactivated', 'bot was blocked', 'bot was kicked', 'user not found')
+
+
+def is_unreachable_error(e: Exception) -> bool:
+    if isinstance(e, Forbidden):
+        return True
+    return isinstance(e, BadRequest) and any(m in str(e).lower() for m in _GONE_MARKERS)
+
+
+async def mark_unreachable(user_id: int) -> None:
+    await aexecute_db(
+        "UPDATE users SET reachable = 0, unreachable_at = ? WHERE user_id = ?",
+        (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), user_id),
+    )
+
+
+async def mark_reachable(user_id: int) -> None:
+    await aexecute_db("UPDATE users SET reachable = 1, unreachable_at = NULL WHERE user_id = ? AND reachable = 0", (user_id,))
+
+
+async def reprobe_unreachable(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Daily job (opt-in via UNREACHABLE_REPROBE_DAYS): a chat action tells if a user unblocked us."""
+    from .send_scheduler import scheduled_send, PRIORITY_BULK
+
+    cutoff = (datetime.now() - timedelta(days=UNREACHABLE_REPROBE_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    rows = await aquery_db(
+        "SELECT user_id FROM users WHERE reachable = 0 AND (unreachable_at IS NULL OR unreachable_at < ?)",
+        (cutoff,),
+    ) or []
+
+    async def _probe(user_id) -> bool:
+        try:
+            await scheduled_send(context.bot.send_chat_action, chat_id=user_id, priority=PRIORITY_BULK, action=ChatAction.TYPING)
+        except Exception:
+            # Still unreachable: scheduled_send refreshed unreachable_at, so it waits another period
+            return False
+        await mark_reachable(user_id)
+        return True
+
+    results = await asyncio.gather(*(_probe(r['user_id']) for r in rows))
+    if rows:
+        logger.info(f"Reachability re-probe: {sum(results)} of {len(rows)} unreachable users are reachable again")
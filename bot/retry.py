@@ -0,0 +1,34 @@
+import asyncio
+import random
+
+# Waiting on a panel from async code without blocking the event loop.
+#
+# Panels often need a moment before a freshly created or renewed client shows up in their
+# API. Handlers used to retry with time.sleep, which froze every other user's update for the
+# whole wait. poll() retries an awaitable call with asyncio.sleep instead: the delay doubles
+# on each try (capped at max_delay) with some random jitter, so many users retrying against
+# the same panel don't hit it in lock-step, and it gives up after `attempts` tries or once
+# `timeout` seconds have passed. Cancelling the caller cancels the wait at once.
+
+
+async def poll(fn, *, attempts: int = 4, delay: float = 1.0, max_delay: float = 8.0,
+               timeout: float | None = None, jitter: float = 0.25, accept=bool):
+    """Await fn() until accept(result) is true and return that result, or the last result
+    when every try failed. Exceptions raised by fn are not retried."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout if timeout is not None else None
+    result = None
+    for attempt in range(max(1, attempts)):
+        result = await fn()
+        if accept(result) or attempt == attempts - 1:
+            break
+        wait = min(delay * 2 ** attempt, max_delay)
+        wait *= 1 + random.uniform(-jitter, jitter)
+        if deadline is not None:
+            left = deadline - loop.time()
+            if left <= 0:
+                break
+            # Never sleep past the deadline; the last try runs right at it
+            wait = min(wait, left)
+        await asyncio.sleep(wait)
+    return result
@@ -0,0 +1,136 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from telegram.error import RetryAfter
+
+from .config import TG_SEND_RATE, TG_SEND_MAX_RETRIES, logger
+from .reachability import is_unreachable_error, mark_unreachable
+
+# Shared outbound scheduler for Telegram sends (reminders, broadcasts, admin notifications).
+#
+# Every send takes a token from the bot-wide bucket (TG_SEND_RATE per second) and one from
+# its chat's bucket (Telegram allows about 1 message/s in a private chat and 20/min in a
+# group). Waiters on the bot-wide bucket are served by priority, so a payment notification
+# for admins overtakes a running broadcast. A RetryAfter pauses every send for the time
+# Telegram asks for, then the send is retried. A user who blocked the bot is flagged
+# unreachable (reachability.py) so later bulk sends skip them.
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+_PRIVATE_CHAT_RATE = 1.0
+_GROUP_CHAT_RATE = 20 / 60.0
+_MAX_IDLE_CHATS = 5000
+
+
+class _TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def reserve(self) -> float:
+        """Take a token now, going into debt if needed; return how long to wait before using it."""
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+# Small burst so any one-second window stays near TG_SEND_RATE
+_global = _TokenBucket(TG_SEND_RATE, max(1, TG_SEND_RATE // 5))
+_chats: dict[int, _TokenBucket] = {}
+_waiters: list = []  # heap of (priority, seq, future)
+_seq = itertools.count()
+_pump_task = None
+_paused_until = 0.0
+
+
+def _chat_bucket(chat_id) -> _TokenBucket:
+    bucket = _chats.get(chat_id)
+    if bucket is None:
+        if len(_chats) >= _MAX_IDLE_CHATS:
+            # Buckets that have refilled completely carry no state worth keeping
+            for cid in [cid for cid, b in _chats.items() if b.wait_time() == 0 and b.tokens >= b.capacity]:
+                del _chats[cid]
+        try:
+            is_group = int(chat_id) < 0
+        except Exception:
+            is_group = True
+        bucket = _chats[chat_id] = _TokenBucket(_GROUP_CHAT_RATE if is_group else _PRIVATE_CHAT_RATE, 1)
+    return bucket
+
+
+async def _pump() -> None:
+    while _waiters:
+        delay = max(_paused_until - time.monotonic(), _global.wait_time())
+        if delay > 0:
+            await asyncio.sleep(delay)
+            continue
+        _, _, fut = heapq.heappop(_waiters)
+        if fut.done():
+            # Waiter was cancelled; its token stays in the bucket
+            continue
+        _global.take()
+        fut.set_result(None)
+
+
+async def _acquire(priority: int) -> None:
+    global _pump_task
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    heapq.heappush(_waiters, (priority, next(_seq), fut))
+    if _pump_task is None or _pump_task.done() or _pump_task.get_loop() is not loop:
+        _pump_task = loop.create_task(_pump())
+    await fut
+
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    value = e.retry_after
+    return float(value.total_seconds() if hasattr(value, 'total_seconds') else value)
+
+
+async def scheduled_send(method, *args, chat_id, priority: int = PRIORITY_NORMAL, **kwargs):
+    """Call a Bot send method (`bot.send_message`, `bot.copy_message`, ...) under the shared limits.
+
+    Errors from `method` propagate as usual, except RetryAfter, which is retried up to
+    TG_SEND_MAX_RETRIES times after the pause Telegram asks for.
+    """
+    global _paused_until
+    attempt = 0
+    while True:
+        delay = _chat_bucket(chat_id).reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await _acquire(priority)
+        try:
+            return await method(*args, chat_id=chat_id, **kwargs)
+        except RetryAfter as e:
+            attempt += 1
+            wait = _retry_after_seconds(e)
+            _paused_until = max(_paused_until, time.monotonic() + wait)
+            logger.warning(f"Telegram flood limit (chat {chat_id}): pausing sends for {wait:.0f}s, attempt {attempt}")
+            if attempt > TG_SEND_MAX_RETRIES:
+                raise
+        except Exception as e:
+            if is_unreachable_error(e) and isinstance(chat_id, int) and chat_id > 0:
+                try:
+                    await mark_unreachable(chat_id)
+                except Exception:
+                    pass
+            raise
@@ -0,0 +1,123 @@
+import threading
+import time
+
+from .db import get_connection, _rollback_quietly
+from .config import SETTINGS_VERSION_CHECK_SECONDS, logger
+
+# In-memory copy of the `settings` table. Reads are served from `_values`; a write bumps
+# `settings_version` (via triggers, see db migration 4), and every process re-reads the
+# counter at most once per SETTINGS_VERSION_CHECK_SECONDS to pick up foreign changes.
+_lock = threading.RLock()
+_values: dict[str, str | None] = {}
+_version = -1
+_checked_at = 0.0
+
+
+def _read_version(conn) -> int:
+    row = conn.execute("SELECT version FROM settings_version WHERE id = 1").fetchone()
+    return int(row[0]) if row else 0
+
+
+def _load(conn) -> None:
+    global _values, _version, _checked_at
+    version = _read_version(conn)
+    _values = {row[0]: row[1] for row in conn.execute("SELECT key, value FROM settings")}
+    _version = version
+    _checked_at = time.monotonic()
+
+
+def _ensure_fresh() -> None:
+    global _checked_at
+    if _version >= 0 and time.monotonic() - _checked_at < SETTINGS_VERSION_CHECK_SECONDS:
+        return
+    with _lock:
+        if _version >= 0 and time.monotonic() - _checked_at < SETTINGS_VERSION_CHECK_SECONDS:
+            return
+        try:
+            conn = get_connection()
+            if _version < 0 or _read_version(conn) != _version:
+                _load(conn)
+            else:
+                _checked_at = time.monotonic()
+        except Exception as e:
+            # Keep serving the last good snapshot; retry on the next interval
+            logger.error(f"Settings cache refresh failed: {e}")
+            _checked_at = time.monotonic()
+
+
+def invalidate() -> None:
+    global _version
+    with _lock:
+        _version = -1
+
+
+def get_settings(prefix: str | None = None) -> dict[str, str | None]:
+    _ensure_fresh()
+    values = _values
+    if prefix:
+        return {k: v for k, v in values.items() if k.startswith(prefix)}
+    return dict(values)
+
+
+def get_setting(key: str, default: str | None = None) -> str | None:
+    _ensure_fresh()
+    return _values.get(key, default)
+
+
+def get_int(key: str, default: int = 0) -> int:
+    try:
+        return int(float(str(get_setting(key) or '').strip()))
+    except Exception:
+        return default
+
+
+def get_float(key: str, default: float = 0.0) -> float:
+    try:
+        return float(str(get_setting(key) or '').strip())
+    except Exception:
+        return default
+
+
+def get_bool(key: str, default: bool = False) -> bool:
+    value = get_setting(key)
+    if value is None or value == '':
+        return default
+    return str(value).strip() == '1'
+
+
+def set_settings(values: dict[str, str | None]) -> bool:
+    """Write-through: persist `values` and update the in-memory copy in one step."""
+    global _values, _version, _checked_at
+    if not values:
+        return True
+    with _lock:
+        conn = get_connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            before = _read_version(conn)
+            conn.executemany(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                [(k, None if v is None else str(v)) for k, v in values.items()],
+            )
+            after = _read_version(conn)
+            if before == _version:
+                # Nobody else wrote since our last sync, so local copy + this change is exact
+                merged = dict(_values)
+                merged.update({k: None if v is None else str(v) for k, v in values.items()})
+                conn.commit()
+                _values = merged
+                _version = after
+                _checked_at = time.monotonic()
+            else:
+                conn.commit()
+                _load(conn)
+            return True
+        except Exception as e:
+            logger.error(f"Settings write failed for {list(values)}: {e}")
+            _rollback_quietly(conn)
+            _version = -1
+            return False
+
+
+def set_setting(key: str, value: str | None) -> bool:
+    return set_settings({key: value})
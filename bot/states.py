@@ -1,4 +1,6 @@
 # --- Conversation States (Only for multi-step processes) ---
+# These numbers are persisted with in-progress conversations (persistence.py): add new states
+# at the end, never in the middle.
 (
     ADMIN_MAIN_MENU,
     # Plan Management
@@ -29,7 +31,7 @@
     # Payment Method Selection
     SELECT_PAYMENT_METHOD,
     # Broadcast
-    BROADCAST_SELECT_AUDIENCE, BROADCAST_SELECT_MODE, BROADCAST_AWAIT_MESSAGE,
+    BROADCAST_SELECT_AUDIENCE, BROADCAST_SELECT_MODE, BROADCAST_AWAIT_MESSAGE, BROADCAST_AWAIT_SEGMENT_VALUE,
     # Renewal Flow States
     RENEW_SELECT_PLAN, RENEW_AWAIT_PAYMENT, RENEW_AWAIT_DISCOUNT_CODE,
     # Discount Code Management
@@ -47,4 +49,4 @@
     SUPPORT_AWAIT_TICKET, ADMIN_AWAIT_TICKET_REPLY,
     # Reseller
     RESELLER_AWAIT_UPLOAD, ADMIN_RESELLER_MENU, ADMIN_RESELLER_AWAIT_VALUE,
-) = range(78)
\ No newline at end of file
+) = range(79)
\ No newline at end of file
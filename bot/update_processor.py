@@ -0,0 +1,78 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from .admins import is_admin
+from .config import UPDATE_CONCURRENCY, ADMIN_UPDATE_SLOTS
+
+# Update processor for Application.concurrent_updates.
+#
+# Updates of one user (or chat, when there is no user) run strictly one after another in
+# arrival order, so a double tap can't interleave two steps of a conversation over the same
+# context.user_data. Updates of different users run in parallel, at most UPDATE_CONCURRENCY
+# at a time; admins may also use ADMIN_UPDATE_SLOTS reserved slots so a flood of user
+# traffic doesn't lock them out. An update waits for its turn in its user's queue before it
+# takes a slot, so a user's backlog never holds slots others could use.
+
+# PTB's own semaphore only bounds how many updates may be waiting here
+_MAX_PENDING_UPDATES = 100000
+
+
+def _update_key(update):
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent: int = UPDATE_CONCURRENCY, admin_slots: int = ADMIN_UPDATE_SLOTS):
+        super().__init__(_MAX_PENDING_UPDATES)
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._admin_slots = asyncio.Semaphore(admin_slots) if admin_slots > 0 else None
+        self._queues: dict = {}  # key -> [lock, updates queued or running]
+
+    async def _acquire_slot(self, admin: bool) -> asyncio.Semaphore:
+        if admin and self._admin_slots is not None:
+            # Take whichever is free; when both are busy wait on the reserved one, which
+            # only admins compete for
+            if self._slots.locked():
+                await self._admin_slots.acquire()
+                return self._admin_slots
+        await self._slots.acquire()
+        return self._slots
+
+    async def do_process_update(self, update, coroutine) -> None:
+        key = _update_key(update)
+        if key is None:
+            slot = await self._acquire_slot(False)
+            try:
+                await coroutine
+            finally:
+                slot.release()
+            return
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = [asyncio.Lock(), 0]
+        queue[1] += 1
+        try:
+            # asyncio.Lock wakes waiters first-come-first-served, preserving update order
+            async with queue[0]:
+                slot = await self._acquire_slot(is_admin(key))
+                try:
+                    await coroutine
+                finally:
+                    slot.release()
+        finally:
+            queue[1] -= 1
+            if queue[1] == 0:
+                self._queues.pop(key, None)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -1,6 +1,8 @@
 from datetime import datetime
 from telegram import User, Update
-from .db import query_db, execute_db
+from .db import aquery_db, aexecute_db
+from .settings import get_settings
+from .reachability import mark_reachable
 from .config import logger
 from telegram.constants import ParseMode
 
@@ -8,7 +10,10 @@ from telegram.constants import ParseMode
 async def register_new_user(user: User, update: Update = None, referrer_hint: int | None = None):
 	if not user:
 		return
-	existing = query_db("SELECT referrer_id FROM users WHERE user_id = ?", (user.id,), one=True)
+	existing = await aquery_db("SELECT referrer_id, reachable FROM users WHERE user_id = ?", (user.id,), one=True)
+	if existing and not existing.get('reachable', 1):
+		# They are talking to us again, so they unblocked the bot
+		await mark_reachable(user.id)
 	if not existing:
 		referrer_id = None
 		if referrer_hint is not None:
@@ -21,18 +26,18 @@ async def register_new_user(user: User, update: Update = None, referrer_hint: in
 					referrer_id = int(parts[1])
 				except Exception:
 					referrer_id = None
-		execute_db(
+		await aexecute_db(
 			"INSERT INTO users (user_id, first_name, join_date, referrer_id) VALUES (?, ?, ?, ?)",
 			(user.id, user.first_name, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), referrer_id),
 		)
 		if referrer_id and referrer_id != user.id:
-			execute_db(
+			await aexecute_db(
 				"INSERT OR IGNORE INTO referrals (referrer_id, referee_id, created_at) VALUES (?, ?, ?)",
 				(referrer_id, user.id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
 			)
 		logger.info(f"Registered new user {user.id} ({user.first_name}), ref={referrer_id}")
 		# Signup bonus: credit wallet once for first-time users
-		settings = {s['key']: s['value'] for s in query_db("SELECT key, value FROM settings")}
+		settings = get_settings()
 		if settings.get('signup_bonus_enabled', '0') == '1':
 			try:
 				amount = int((settings.get('signup_bonus_amount') or '0') or 0)
@@ -40,10 +45,10 @@ async def register_new_user(user: User, update: Update = None, referrer_hint: in
 				amount = 0
 			if amount > 0:
 				# ensure wallet row
-				execute_db("INSERT OR IGNORE INTO user_wallets (user_id, balance) VALUES (?, 0)", (user.id,))
+				await aexecute_db("INSERT OR IGNORE INTO user_wallets (user_id, balance) VALUES (?, 0)", (user.id,))
 				# credit
-				execute_db("UPDATE user_wallets SET balance = COALESCE(balance,0) + ? WHERE user_id = ?", (amount, user.id))
-				execute_db(
+				await aexecute_db("UPDATE user_wallets SET balance = COALESCE(balance,0) + ? WHERE user_id = ?", (amount, user.id))
+				await aexecute_db(
 					"INSERT INTO wallet_transactions (user_id, amount, direction, method, status, created_at, reference, meta) VALUES (?, ?, 'credit', 'bonus', 'approved', ?, ?, ?)",
 					(user.id, amount, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'signup_bonus', None)
 				)
@@ -60,8 +65,8 @@ async def register_new_user(user: User, update: Update = None, referrer_hint: in
 		# Backfill referrer if missing and hint exists
 		current_ref = existing.get('referrer_id')
 		if (current_ref is None or current_ref == '' ) and referrer_hint and referrer_hint != user.id:
-			execute_db("UPDATE users SET referrer_id = ? WHERE user_id = ?", (referrer_hint, user.id))
-			execute_db(
+			await aexecute_db("UPDATE users SET referrer_id = ? WHERE user_id = ?", (referrer_hint, user.id))
+			await aexecute_db(
 				"INSERT OR IGNORE INTO referrals (referrer_id, referee_id, created_at) VALUES (?, ?, ?)",
 				(referrer_hint, user.id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
 			)
@@ -0,0 +1,22 @@
+import os
+import sys
+import tempfile
+
+# The bot reads its settings from the environment at import time, so point it at a throwaway
+# database before anything under bot/ is imported.
+_tmp = tempfile.mkdtemp(prefix='bot-tests-')
+os.environ['DB_NAME'] = os.path.join(_tmp, 'test.db')
+os.environ.setdefault('BOT_TOKEN', '1:test')
+os.environ.setdefault('ADMIN_ID', '1')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def migrated_db():
+    """Path of a database with every migration applied."""
+    from bot.db import db_setup
+    db_setup()
+    return os.environ['DB_NAME']
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from bot import account_pool
+from bot.db import execute_db, query_db
+
+PANEL_ID, INBOUND_ID = 99, 7
+
+
+class _FlakyPanel:
+    """Panel on which activation fails; deleting the client succeeds or not."""
+
+    def __init__(self, can_delete):
+        self.can_delete = can_delete
+        self.deleted = []
+
+    def activate_client_on_inbound(self, inbound_id, username, plan):
+        return False, "HTTP 502"
+
+    def delete_client_on_inbound(self, inbound_id, username):
+        if not self.can_delete:
+            return False, "HTTP 502"
+        self.deleted.append(username)
+        return True, "Success"
+
+
+@pytest.fixture
+def pooled_client(migrated_db):
+    execute_db("DELETE FROM account_pool WHERE panel_id = ?", (PANEL_ID,))
+    row_id = execute_db(
+        "INSERT INTO account_pool (panel_id, inbound_id, username, sub_link, configs, status, created_at) "
+        "VALUES (?, ?, 'user_pool_test', 'https://sub', '[]', 'ready', '')",
+        (PANEL_ID, INBOUND_ID),
+    )
+    yield row_id
+    execute_db("DELETE FROM account_pool WHERE panel_id = ?", (PANEL_ID,))
+
+
+def _claim(monkeypatch, panel):
+    monkeypatch.setattr(account_pool, 'VpnPanelAPI', lambda panel_id: panel)
+    plan = {'traffic_gb': 10, 'duration_days': 30}
+    return asyncio.run(account_pool.claim_pool_account(PANEL_ID, INBOUND_ID, plan))
+
+
+def _status(row_id):
+    return query_db("SELECT status FROM account_pool WHERE id = ?", (row_id,), one=True)['status']
+
+
+def test_failed_activation_removes_the_client_from_the_panel(monkeypatch, pooled_client):
+    panel = _FlakyPanel(can_delete=True)
+    assert _claim(monkeypatch, panel) is None
+    assert panel.deleted == ['user_pool_test']
+    assert _status(pooled_client) == 'failed'
+
+
+def test_client_that_cannot_be_removed_goes_back_to_the_pool(monkeypatch, pooled_client):
+    assert _claim(monkeypatch, _FlakyPanel(can_delete=False)) is None
+    assert _status(pooled_client) == 'ready'
@@ -0,0 +1,12 @@
+import warnings
+
+from bot.app import build_application
+
+
+def test_build_application_wires_every_handler(migrated_db):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        application = build_application()
+    assert application.handlers
+    names = {job.name for job in application.job_queue.jobs()}
+    assert {'account_pool_refill', 'broadcast_segment_counts'} <= names
@@ -0,0 +1,104 @@
+import ast
+import asyncio
+import functools
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from bot import retry
+from bot.db import execute_db
+from bot.handlers import user as user_handlers
+
+BOT_DIR = Path(__file__).resolve().parent.parent / 'bot'
+
+
+@pytest.fixture
+def loop_sleeps(monkeypatch):
+    """Patch time.sleep to record every call made on a thread that is running an event loop."""
+    real_sleep = time.sleep
+    offenders = []
+
+    def guarded_sleep(seconds):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return real_sleep(seconds)
+        offenders.append((threading.current_thread().name, seconds))
+        raise AssertionError(f"time.sleep({seconds}) called on the event loop")
+
+    monkeypatch.setattr(time, 'sleep', guarded_sleep)
+    return offenders
+
+
+def _async_defs_calling_time_sleep():
+    for path in sorted(BOT_DIR.rglob('*.py')):
+        tree = ast.parse(path.read_text(encoding='utf-8'))
+        for func in ast.walk(tree):
+            if not isinstance(func, ast.AsyncFunctionDef):
+                continue
+            # Nested sync defs run wherever they are called (usually a worker thread), skip them
+            stack = list(func.body)
+            while stack:
+                node = stack.pop()
+                if isinstance(node, (ast.FunctionDef, ast.Lambda)):
+                    continue
+                if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'sleep'
+                        and isinstance(node.func.value, ast.Name) and node.func.value.id == 'time'):
+                    yield f"{path.relative_to(BOT_DIR.parent)}:{node.lineno} in {func.name}"
+                stack.extend(ast.iter_child_nodes(node))
+
+
+def test_no_time_sleep_inside_async_functions():
+    assert list(_async_defs_calling_time_sleep()) == []
+
+
+class _SlowPanel:
+    """X-UI panel whose new client shows up on the third fetch; each fetch blocks a little."""
+
+    def __init__(self, panel_id=None):
+        self.fetches = 0
+
+    def get_token(self):
+        time.sleep(0.01)
+        return 'token'
+
+    def get_configs_for_user_on_inbound(self, inbound_id, username, preferred_id=None):
+        time.sleep(0.01)
+        self.fetches += 1
+        return ['vless://fresh'] if self.fetches >= 3 else []
+
+
+def test_refresh_service_link_keeps_sleeps_off_the_loop(migrated_db, monkeypatch, loop_sleeps):
+    panel = _SlowPanel()
+    monkeypatch.setattr(user_handlers, 'VpnPanelAPI', lambda panel_id=None: panel)
+    monkeypatch.setattr(user_handlers, 'poll', functools.partial(retry.poll, jitter=0, max_delay=0.02))
+    order_id = execute_db(
+        "INSERT INTO orders (user_id, plan_id, status, marzban_username, panel_id, panel_type, xui_inbound_id, timestamp) "
+        "VALUES (?, 1, 'approved', 'user_sleep_test', 99, 'xui', 7, '')",
+        (900002,),
+    )
+    sent = []
+
+    async def record(**kwargs):
+        sent.append(kwargs)
+
+    async def answer(*args, **kwargs):
+        pass
+
+    query = SimpleNamespace(
+        data=f"refresh_service_{order_id}",
+        from_user=SimpleNamespace(id=900002),
+        message=SimpleNamespace(chat_id=900002),
+        answer=answer,
+    )
+    context = SimpleNamespace(bot=SimpleNamespace(send_message=record, send_photo=record))
+    try:
+        asyncio.run(user_handlers.refresh_service_link(SimpleNamespace(callback_query=query), context))
+    finally:
+        execute_db("DELETE FROM orders WHERE id = ?", (order_id,))
+    assert loop_sleeps == []
+    assert panel.fetches == 3
+    assert any('vless://fresh' in (m.get('text') or m.get('caption') or '') for m in sent)
@@ -0,0 +1,20 @@
+import asyncio
+
+from bot.persistence import SqlitePersistence
+
+USER_ID = 900005
+
+
+def test_unpicklable_user_data_drops_the_stored_copy(migrated_db):
+    async def main():
+        persistence = SqlitePersistence()
+        await persistence.update_user_data(USER_ID, {'flow': 'buy', 'step': 2})
+        await persistence._flush_task
+        stored = (await persistence.get_user_data()).get(USER_ID)
+        await persistence.update_user_data(USER_ID, {'flow': 'buy', 'callback': lambda: None})
+        await persistence._flush_task
+        return stored, (await persistence.get_user_data()).get(USER_ID)
+
+    stored, after = asyncio.run(main())
+    assert stored == {'flow': 'buy', 'step': 2}
+    assert after is None
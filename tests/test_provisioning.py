@@ -0,0 +1,39 @@
+import asyncio
+
+from bot.db import execute_db, query_db
+from bot import provisioning
+
+
+def _order(status):
+    return execute_db(
+        "INSERT INTO orders (user_id, plan_id, status, timestamp) VALUES (900004, 1, ?, '')", (status,)
+    )
+
+
+def _cleanup(*order_ids):
+    for order_id in order_ids:
+        execute_db("DELETE FROM provisioning_jobs WHERE order_id = ?", (order_id,))
+        execute_db("DELETE FROM orders WHERE id = ?", (order_id,))
+
+
+def test_only_pending_orders_are_queued(migrated_db):
+    pending, approved, rejected = _order('pending'), _order('approved'), _order('rejected')
+    try:
+        assert asyncio.run(provisioning.enqueue_provisioning(pending, 'wallet', panel_id=99))
+        assert asyncio.run(provisioning.enqueue_provisioning(pending, 'wallet', panel_id=99)) is None
+        assert asyncio.run(provisioning.enqueue_provisioning(approved, 'wallet', panel_id=99)) is None
+        assert asyncio.run(provisioning.enqueue_provisioning(rejected, 'wallet', panel_id=99)) is None
+    finally:
+        _cleanup(pending, approved, rejected)
+
+
+def test_cancel_marks_queued_jobs_failed(migrated_db):
+    order_id = _order('pending')
+    try:
+        job_id = asyncio.run(provisioning.enqueue_provisioning(order_id, 'wallet', panel_id=99))
+        assert asyncio.run(provisioning.cancel_provisioning(order_id, 'order rejected')) == 1
+        job = query_db("SELECT status, last_error FROM provisioning_jobs WHERE id = ?", (job_id,), one=True)
+        assert job == {'status': 'failed', 'last_error': 'order rejected'}
+        assert asyncio.run(provisioning.cancel_provisioning(order_id)) == 0
+    finally:
+        _cleanup(order_id)
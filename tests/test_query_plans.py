@@ -0,0 +1,56 @@
+import ast
+import re
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+HANDLERS = Path(__file__).resolve().parent.parent / 'bot' / 'handlers'
+
+# Tables that grow with the user base; a full SCAN of one of these on a request path is a regression
+LARGE_TABLES = {'orders', 'wallet_transactions', 'tickets', 'ticket_messages', 'referrals', 'user_services'}
+
+# Statements that read the whole table on purpose (exports and totals), not per-request lookups
+INTENTIONAL_SCANS = {
+    "SELECT id, user_id, plan_id, status, marzban_username, timestamp, final_price, panel_id, panel_type, last_link, is_trial FROM orders ORDER BY id",
+    "SELECT COUNT(*) AS c FROM orders",
+}
+
+_SQL_START = re.compile(r'^\s*(SELECT|UPDATE|DELETE|INSERT|WITH)\b')
+_NAMED_PARAM = re.compile(r'[:@$]([A-Za-z_]\w*)')
+_SCAN = re.compile(r'\bSCAN (?:TABLE )?(\w+)')
+
+
+def _sql_literals():
+    for path in sorted(HANDLERS.glob('*.py')):
+        tree = ast.parse(path.read_text(encoding='utf-8'))
+        # Pieces of f-strings are not complete statements
+        fragments = {id(part) for node in ast.walk(tree) if isinstance(node, ast.JoinedStr) for part in node.values}
+        for node in ast.walk(tree):
+            if id(node) in fragments:
+                continue
+            if isinstance(node, ast.Constant) and isinstance(node.value, str) and _SQL_START.match(node.value):
+                yield pytest.param(node.value, id=f"{path.name}:{node.lineno}")
+
+
+def _bindings(sql: str):
+    names = _NAMED_PARAM.findall(sql)
+    if names:
+        return {name: None for name in names}
+    return (None,) * sql.count('?')
+
+
+@pytest.mark.parametrize('sql', list(_sql_literals()))
+def test_no_full_scan_of_large_tables(sql, migrated_db):
+    conn = sqlite3.connect(migrated_db)
+    try:
+        try:
+            plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", _bindings(sql)).fetchall()
+        except sqlite3.Error as e:
+            pytest.fail(f"query does not prepare against the migrated schema: {e}")
+    finally:
+        conn.close()
+    if ' '.join(sql.split()) in INTENTIONAL_SCANS:
+        return
+    scans = {m.group(1) for row in plan for m in [_SCAN.search(row[-1])] if m}
+    assert not scans & LARGE_TABLES, f"full scan of {sorted(scans & LARGE_TABLES)}: {[row[-1] for row in plan]}"
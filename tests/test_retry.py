@@ -0,0 +1,82 @@
+import asyncio
+import time
+
+import pytest
+
+from bot.retry import poll
+
+
+def _counter(results):
+    calls = []
+
+    async def fn():
+        calls.append(time.monotonic())
+        return results[min(len(calls), len(results)) - 1]
+
+    return fn, calls
+
+
+def test_returns_first_accepted_result():
+    fn, calls = _counter([None, [], ['cfg']])
+    assert asyncio.run(poll(fn, attempts=5, delay=0.01, jitter=0)) == ['cfg']
+    assert len(calls) == 3
+
+
+def test_returns_last_result_after_all_attempts():
+    fn, calls = _counter([0, 0, 0, 0, 0])
+    assert asyncio.run(poll(fn, attempts=3, delay=0.01, jitter=0)) == 0
+    assert len(calls) == 3
+
+
+def test_custom_accept():
+    fn, calls = _counter([{'ok': False}, {'ok': True}])
+    result = asyncio.run(poll(fn, attempts=4, delay=0.01, accept=lambda r: r['ok']))
+    assert result == {'ok': True}
+    assert len(calls) == 2
+
+
+def test_backoff_doubles_up_to_max_delay():
+    fn, calls = _counter([None])
+    asyncio.run(poll(fn, attempts=4, delay=0.02, max_delay=0.05, jitter=0))
+    gaps = [b - a for a, b in zip(calls, calls[1:])]
+    assert gaps[0] == pytest.approx(0.02, abs=0.015)
+    assert gaps[1] == pytest.approx(0.04, abs=0.015)
+    assert gaps[2] == pytest.approx(0.05, abs=0.015)
+
+
+def test_deadline_stops_retrying():
+    fn, calls = _counter([None])
+    start = time.monotonic()
+    asyncio.run(poll(fn, attempts=50, delay=0.1, max_delay=0.1, timeout=0.25, jitter=0))
+    elapsed = time.monotonic() - start
+    # Tries at 0, 0.1, 0.2 and a last one right at the deadline, never sleeping past it
+    assert elapsed < 0.4
+    assert 3 <= len(calls) <= 4
+
+
+def test_cancellation_interrupts_the_wait():
+    fn, calls = _counter([None])
+
+    async def main():
+        task = asyncio.create_task(poll(fn, attempts=5, delay=10))
+        await asyncio.sleep(0.05)
+        start = time.monotonic()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return time.monotonic() - start
+
+    assert asyncio.run(main()) < 0.1
+    assert len(calls) == 1
+
+
+def test_exceptions_are_not_retried():
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        raise RuntimeError('panel down')
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(poll(fn, attempts=3, delay=0.01))
+    assert len(calls) == 1
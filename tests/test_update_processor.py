@@ -0,0 +1,94 @@
+import asyncio
+import random
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+
+from bot import update_processor
+from bot.update_processor import PerUserUpdateProcessor
+
+ADMIN = 1
+
+
+def _update(update_id: int, user_id: int) -> Update:
+    message = Message(
+        message_id=update_id,
+        date=datetime.now(),
+        chat=Chat(user_id, Chat.PRIVATE),
+        from_user=User(user_id, 'user', False),
+        text='x',
+    )
+    return Update(update_id, message=message)
+
+
+def test_per_user_order_and_concurrency_bound(monkeypatch):
+    monkeypatch.setattr(update_processor, 'is_admin', lambda user_id: user_id == ADMIN)
+    users, per_user, limit = 60, 25, 8
+    seen = {}
+    running = {}
+    peak = 0
+    in_flight = 0
+
+    async def handle(user_id, seq):
+        nonlocal peak, in_flight
+        assert not running.get(user_id), f"two updates of user {user_id} ran at once"
+        running[user_id] = True
+        in_flight += 1
+        peak = max(peak, in_flight)
+        seen.setdefault(user_id, []).append(seq)
+        await asyncio.sleep(random.uniform(0, 0.002))
+        in_flight -= 1
+        running[user_id] = False
+
+    async def main():
+        processor = PerUserUpdateProcessor(max_concurrent=limit, admin_slots=2)
+        arrivals = [(uid, seq) for seq in range(per_user) for uid in range(100, 100 + users)]
+        # Interleave users randomly but keep each user's own updates in send order
+        random.shuffle(arrivals)
+        next_seq = {}
+        tasks = []
+        for n, (uid, _) in enumerate(arrivals):
+            seq = next_seq.get(uid, 0)
+            next_seq[uid] = seq + 1
+            tasks.append(asyncio.create_task(processor.process_update(_update(n, uid), handle(uid, seq))))
+        await asyncio.gather(*tasks)
+        return processor
+
+    processor = asyncio.run(main())
+    assert len(seen) == users
+    for uid, seqs in seen.items():
+        assert seqs == list(range(per_user)), f"user {uid} updates ran out of order"
+    assert peak <= limit
+    assert peak == limit  # the load was heavy enough to use every slot
+    assert processor._queues == {}
+
+
+def test_admin_gets_through_when_every_slot_is_busy(monkeypatch):
+    monkeypatch.setattr(update_processor, 'is_admin', lambda user_id: user_id == ADMIN)
+
+    async def main():
+        processor = PerUserUpdateProcessor(max_concurrent=4, admin_slots=1)
+        release = asyncio.Event()
+        started = []
+
+        async def stuck(uid):
+            started.append(uid)
+            await release.wait()
+
+        admin_done = asyncio.Event()
+
+        async def admin_update():
+            admin_done.set()
+
+        users = [asyncio.create_task(processor.process_update(_update(i, 100 + i), stuck(100 + i))) for i in range(20)]
+        await asyncio.sleep(0.01)
+        assert len(started) == 4  # every regular slot is taken, the rest of the users wait
+        admin = asyncio.create_task(processor.process_update(_update(99, ADMIN), admin_update()))
+        await asyncio.wait_for(admin_done.wait(), timeout=1)
+        await admin
+        assert len(started) == 4
+        release.set()
+        await asyncio.gather(*users)
+        assert len(started) == 20
+
+    asyncio.run(main())
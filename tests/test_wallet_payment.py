@@ -0,0 +1,122 @@
+import asyncio
+import time
+
+import pytest
+
+from bot.db import arun_transaction, execute_db, query_db
+from bot.handlers.purchase import _debit_wallet
+
+USER_ID = 900001
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def _p99(samples):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+
+
+@pytest.fixture
+def wallet(migrated_db):
+    def fund(balance):
+        execute_db("DELETE FROM wallet_transactions WHERE user_id = ?", (USER_ID,))
+        execute_db("INSERT OR REPLACE INTO user_wallets (user_id, balance) VALUES (?, ?)", (USER_ID, balance))
+    yield fund
+    execute_db("DELETE FROM wallet_transactions WHERE user_id = ?", (USER_ID,))
+    execute_db("DELETE FROM user_wallets WHERE user_id = ?", (USER_ID,))
+
+
+def _balance():
+    return query_db("SELECT balance FROM user_wallets WHERE user_id = ?", (USER_ID,), one=True)['balance']
+
+
+def _debits():
+    return query_db("SELECT COUNT(*) AS c FROM wallet_transactions WHERE user_id = ?", (USER_ID,), one=True)['c']
+
+
+def test_free_order_without_a_wallet_row(migrated_db):
+    user_id = 900003
+    execute_db("DELETE FROM user_wallets WHERE user_id = ?", (user_id,))
+    try:
+        assert run(arun_transaction(_debit_wallet, user_id, 0)) == 0
+        assert run(arun_transaction(_debit_wallet, user_id, 1)) is None
+    finally:
+        execute_db("DELETE FROM wallet_transactions WHERE user_id = ?", (user_id,))
+        execute_db("DELETE FROM user_wallets WHERE user_id = ?", (user_id,))
+
+
+def test_debit_refuses_short_balance(wallet):
+    wallet(50)
+    assert run(arun_transaction(_debit_wallet, USER_ID, 100)) is None
+    assert _balance() == 50 and _debits() == 0
+    assert run(arun_transaction(_debit_wallet, USER_ID, 50)) == 0
+    assert _balance() == 0 and _debits() == 1
+
+
+def test_concurrent_payments_never_overdraw(wallet):
+    wallet(1000)
+
+    async def pay_many():
+        return await asyncio.gather(*(arun_transaction(_debit_wallet, USER_ID, 100) for _ in range(40)))
+
+    results = run(pay_many())
+    assert sum(r is not None for r in results) == 10
+    assert _balance() == 0
+    assert _debits() == 10
+
+
+def _old_debit(user_id, amount):
+    # What pay_method_wallet did before: check, then three separate writes on the event loop
+    row = query_db("SELECT balance FROM user_wallets WHERE user_id = ?", (user_id,), one=True)
+    if (row or {}).get('balance', 0) < amount:
+        return None
+    execute_db("INSERT OR IGNORE INTO user_wallets (user_id, balance) VALUES (?, 0)", (user_id,))
+    execute_db("UPDATE user_wallets SET balance = balance - ? WHERE user_id = ?", (amount, user_id))
+    execute_db(
+        "INSERT INTO wallet_transactions (user_id, amount, direction, method, status, created_at) VALUES (?, ?, 'debit', 'wallet', 'approved', '')",
+        (user_id, amount),
+    )
+    return True
+
+
+async def _update_latencies(pay, payers: int = 200, pings: int = 200):
+    """Run `payers` wallet payments alongside `pings` trivial updates from other users and
+    return how long each trivial update waited for the event loop."""
+    latencies = []
+
+    async def other_user_update():
+        start = time.perf_counter()
+        await asyncio.sleep(0)
+        latencies.append(time.perf_counter() - start)
+
+    async def payer():
+        await pay()
+
+    tasks = []
+    for i in range(max(payers, pings)):
+        if i < payers:
+            tasks.append(asyncio.create_task(payer()))
+        if i < pings:
+            tasks.append(asyncio.create_task(other_user_update()))
+    await asyncio.gather(*tasks)
+    return latencies
+
+
+def test_p99_update_latency_under_wallet_load(wallet):
+    wallet(10 ** 9)
+
+    async def old_pay():
+        _old_debit(USER_ID, 1)
+
+    async def new_pay():
+        await arun_transaction(_debit_wallet, USER_ID, 1)
+
+    before = _p99(run(_update_latencies(old_pay)))
+    after = _p99(run(_update_latencies(new_pay)))
+    latencies = f"p99 latency of other users' updates: before {before * 1000:.2f} ms, after {after * 1000:.2f} ms"
+    assert after < before, latencies
+    # With the writes off the loop, other updates are only delayed by scheduling overhead
+    assert after < 0.05, latencies
+